@@ -0,0 +1,359 @@
+"""
+Benchmark harness for the Wabi Sabi obfuscator.
+
+Measures two things on a synthetic Lua corpus:
+1. Tool throughput: wall time of every WabiSabiObfuscator pass and of the full
+   obfuscate() call, plus peak Python memory (tracemalloc).
+2. Generated-code overhead: a static cost model over the output that counts
+   Ea() decryptions, Ma[...] environment lookups, string pool and number
+   table lookups and branches, each weighted by the loop depth it sits at.
+
+Results are written as JSON so regressions in either can be tracked in CI:
+    python bench.py --max-size 1MB --json bench.json
+
+--stress runs the scaling suite instead: generated pathological inputs
+(unterminated literals, deep nesting, huge lines and brackets) at sizes n, 2n
+and 4n, under several option sets. It fails (exit status 1) when doubling the
+input more than MAX_DOUBLING_RATIO-folds the time of any of them, as fitted over
+all the sizes:
+    python bench.py --stress --json stress.json
+"""
+import sys
+import json
+import math
+import time
+import random
+import argparse
+import tracemalloc
+
+from obf import WabiSabiObfuscator
+
+# Corpus sizes in bytes (10 KB -> 10 MB)
+SIZES = (10_000, 100_000, 1_000_000, 10_000_000)
+
+# Stress suite: base input size, doublings measured, best-of repeats per timing,
+# and the worst time growth accepted for twice the input (2.0 is linear; the rest
+# is headroom for timer noise and allocator effects). The growth is fitted over
+# every size, so one noisy timing does not fail a run. Runs faster than
+# STRESS_MIN_SECONDS at the largest size are too short to judge on a loaded
+# machine and pass.
+STRESS_SIZE = 20_000
+STRESS_DOUBLINGS = 2
+STRESS_REPEATS = 3
+MAX_DOUBLING_RATIO = 3.0
+STRESS_MIN_SECONDS = 0.25
+
+# Option sets the stress suite runs every shape under
+STRESS_OPTIONS = (
+    {},
+    {"flatten_functions": True, "minify": True, "hoist_globals": True, "string_pool": "lazy",
+     "loop_budget": True, "shared_junk": True, "lazy_functions": True},
+    {"incremental": True},
+)
+
+# A statement inside n loops is assumed to run LOOP_WEIGHT ** n times,
+# with n capped at MAX_WEIGHTED_DEPTH so deep synthetic nests stay comparable
+LOOP_WEIGHT = 10
+MAX_WEIGHTED_DEPTH = 4
+
+GLOBAL_CALLS = (
+    "print({v})", "math.floor({v})", "table.insert(list, {v})", "tostring({v})",
+    "Vector3.new({v}, 0, 1)", "task.wait()", "pcall(print, {v})", "string.rep(\"x\", 2)",
+)
+
+# =========================================================================
+# CORPUS
+# =========================================================================
+
+def _mixed_chunk(rng, n):
+    """A function with branches, a loop, literals and global calls."""
+    return f"""
+local function handler_{n}(value, list)
+    local label = "handler {n}: \\t" .. tostring(value)
+    if value > {rng.randint(1, 500)} then
+        print(label)
+    elseif value == {rng.randint(1, 500)} then
+        warn("edge case")
+    end
+    for i = 1, {rng.randint(2, 20)} do
+        local x = math.floor(i * {rng.random():.3f})
+        if x % 2 == 0 then
+            table.insert(list, x)
+        end
+    end
+    local enabled = {rng.choice(("true", "false"))}
+    return enabled, #list
+end
+"""
+
+def _deep_chunk(rng, n, depth=24):
+    """Deeply nested if/for/while blocks."""
+    lines = [f"local deep_{n} = 0"]
+    openers = []
+    for level in range(depth):
+        kind = level % 3
+        indent = "    " * level
+        if kind == 0:
+            lines.append(f"{indent}if deep_{n} >= {-level} then")
+        elif kind == 1:
+            lines.append(f"{indent}for i{level} = 1, 2 do")
+        else:
+            lines.append(f"{indent}while deep_{n} < {level} do")
+            lines.append(f"{indent}    deep_{n} = deep_{n} + 1")
+        openers.append(indent)
+    lines.append("    " * depth + f"deep_{n} = deep_{n} + {rng.randint(1, 9)}")
+    for indent in reversed(openers):
+        lines.append(f"{indent}end")
+    return "\n".join(lines) + "\n"
+
+def _strings_chunk(rng, n):
+    """Many string literals, including repeated ones and escapes."""
+    words = ("alpha", "beta", "gamma", "delta", "Player", "Enemy found", "Looping...")
+    out = []
+    for i in range(8):
+        word = rng.choice(words)
+        out.append(f'local s{n}_{i} = "{word} {rng.randint(0, 99999)}\\n"')
+    out.append(f"print(s{n}_0 .. \"{rng.choice(words)}\")")
+    return "\n".join(out) + "\n"
+
+def _globals_chunk(rng, n):
+    """Dense global calls, half of them inside a loop."""
+    out = [f"local list = {{}}"]
+    for i in range(6):
+        out.append(rng.choice(GLOBAL_CALLS).format(v=rng.randint(1, 999)))
+    out.append(f"for i = 1, {rng.randint(2, 9)} do")
+    for i in range(6):
+        out.append("    " + rng.choice(GLOBAL_CALLS).format(v="i"))
+    out.append("end")
+    return "\n".join(out) + "\n"
+
+SHAPES = {
+    "mixed": _mixed_chunk,
+    "deep_nesting": _deep_chunk,
+    "strings": _strings_chunk,
+    "globals": _globals_chunk,
+}
+
+# Pathological inputs: each builds roughly n bytes of one worst case
+STRESS_SHAPES = {
+    "unterminated_string": lambda n: 'local s = "' + 'ab\\"c ' * (n // 6),
+    "unterminated_long_comment": lambda n: "local x = 1\n--[==[" + "text ]] ]=] more\n" * (n // 18),
+    "unterminated_long_string": lambda n: "local x = [==[" + "text ]] ]=] [[ more\n" * (n // 20),
+    "quotes_per_line": lambda n: "print(\"a\\\\b\" .. 'c\\'d')\n" * (n // 24),
+    "long_line": lambda n: "local a = 1" + " + b" * (n // 4) + "\n",
+    "deep_brackets": lambda n: "local a = " + "(" * (n // 2) + "1" + ")" * (n // 2) + "\n",
+    "deep_tables": lambda n: "local t = " + "{" * (n // 2) + "1" + "}" * (n // 2) + "\n",
+    "many_globals": lambda n: "print(" + ", ".join(["math.floor(tostring)"] * (n // 22)) + ")\n",
+    "deep_ifs": lambda n: "".join(f"if x{i} then\n" for i in range(n // 30)) + "y = 1\n" + "end\n" * (n // 30),
+    "elseif_chain": lambda n: "if a == 0 then b = 0\n" + "".join(
+        f"elseif a == {i} then b = {i}\n" for i in range(1, n // 30)) + "end\n",
+    "deep_do": lambda n: "do\n" * (n // 10) + "x = 1\n" + "end\n" * (n // 10),
+    "deep_while": lambda n: "while x do\n" * (n // 20) + "x = 1\n" + "end\n" * (n // 20),
+    "repeat_until": lambda n: "repeat\n" * (n // 20) + "x = 1\n" + "until x\n" * (n // 20),
+    "deep_functions": lambda n: "".join(
+        f"local function f{i}(a)\nlocal v{i} = a\n" for i in range(n // 40)) + "return 1\n" + "end\n" * (n // 40),
+    "deep_ifs_in_function": lambda n: "local function f(x)\n" + "".join(
+        f"if x{i} then\n" for i in range(n // 30)) + "y = 1\n" + "end\n" * (n // 30) + "end\n",
+    "elseif_in_function": lambda n: "local function f(a)\nif a == 0 then b = 0\n" + "".join(
+        f"elseif a == {i} then b = {i}\n" for i in range(1, n // 30)) + "end\nend\n",
+}
+
+def generate_corpus(shape, size, seed=0):
+    """Deterministic synthetic Lua source of roughly `size` bytes."""
+    rng = random.Random(f"{shape}:{size}:{seed}")
+    chunk = SHAPES[shape]
+    parts = []
+    total = 0
+    n = 0
+    while total < size:
+        part = chunk(rng, n)
+        parts.append(part)
+        total += len(part)
+        n += 1
+    return "".join(parts)
+
+# =========================================================================
+# STATIC COST MODEL
+# =========================================================================
+
+def cost_model(obfuscator, code):
+    """
+    Counts the runtime constructs of generated (or plain) Lua, raw and weighted
+    by LOOP_WEIGHT ** loop depth (capped at MAX_WEIGHTED_DEPTH). Uses the
+    obfuscator's own lexer and loop analysis, so the dispatcher loop of that
+    run is not counted as a loop.
+    """
+    tokens = obfuscator._tokenize(code)
+    depths = obfuscator._loop_depths(tokens)
+    counts = {"ea_calls": 0, "env_lookups": 0, "pool_lookups": 0, "number_lookups": 0, "branches": 0}
+    weighted = dict.fromkeys(counts, 0)
+
+    for i, (kind, val) in enumerate(tokens):
+        next_val = tokens[i + 1][1] if i + 1 < len(tokens) else None
+        if kind == 'IDENT' and val == obfuscator.var_Ea and next_val == '(':
+            name = "ea_calls"
+        elif kind == 'IDENT' and val == obfuscator.var_Ma and next_val == '[':
+            name = "env_lookups"
+        elif kind == 'IDENT' and val == obfuscator.var_pool and next_val == '[':
+            name = "pool_lookups"
+        elif kind == 'IDENT' and val == obfuscator.var_numbers and next_val == '[':
+            name = "number_lookups"
+        elif kind == 'KEYWORD' and val in ('if', 'elseif'):
+            name = "branches"
+        else:
+            continue
+        counts[name] += 1
+        weighted[name] += LOOP_WEIGHT ** min(depths[i], MAX_WEIGHTED_DEPTH)
+
+    return {"counts": counts, "weighted": weighted}
+
+# =========================================================================
+# RUNNER
+# =========================================================================
+
+def bench_one(source, options, measure_memory=True):
+    """Times one obfuscation (per pass and overall) and models the output cost."""
+    obfuscator = WabiSabiObfuscator(profile=True, **options)
+    start = time.perf_counter()
+    output = obfuscator.obfuscate(source)
+    wall = time.perf_counter() - start
+    stats = obfuscator.stats
+
+    result = {
+        "input_size": len(source),
+        "output_size": len(output),
+        "expansion_ratio": stats.expansion_ratio,
+        "seconds": wall,
+        "throughput_mb_s": len(source) / wall / 1e6 if wall else 0.0,
+        "passes": {p.name: {"seconds": p.seconds, "tokens": p.tokens, "transforms": p.transforms}
+                   for p in stats.passes},
+        "output_cost": cost_model(obfuscator, output),
+        "input_cost": cost_model(obfuscator, source),
+    }
+
+    if measure_memory:
+        # Separate run: tracemalloc slows allocation-heavy code noticeably
+        tracemalloc.start()
+        WabiSabiObfuscator(**options).obfuscate(source)
+        result["peak_memory_bytes"] = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+    return result
+
+def _best_time(source, options):
+    """Fastest of STRESS_REPEATS obfuscations of source, in seconds."""
+    best = None
+    for _ in range(STRESS_REPEATS):
+        obfuscator = WabiSabiObfuscator(**options)
+        start = time.perf_counter()
+        obfuscator.obfuscate(source)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+def _fitted_growth(seconds):
+    """Time factor per doubling: 2 ** the least-squares slope of log2(seconds) over the doublings."""
+    points = [(k, math.log2(t)) for k, t in enumerate(seconds) if t > 0]
+    if len(points) < 2:
+        return 0.0
+    mean_k = sum(k for k, y in points) / len(points)
+    mean_y = sum(y for k, y in points) / len(points)
+    slope = (sum((k - mean_k) * (y - mean_y) for k, y in points)
+             / sum((k - mean_k) ** 2 for k, y in points))
+    return 2 ** slope
+
+def stress(base_size=STRESS_SIZE, shapes=None, seed=0):
+    """
+    Times every stress shape under every STRESS_OPTIONS set at base_size and
+    STRESS_DOUBLINGS doublings of it. A run passes when a doubling costs at
+    most MAX_DOUBLING_RATIO times the previous size, as fitted over all the
+    sizes (or the largest size is under STRESS_MIN_SECONDS). Returns the runs;
+    a run that raises is a failure too, with the error recorded.
+    """
+    runs = []
+    for options in STRESS_OPTIONS:
+        options = {"seed": seed, **options}
+        for shape in shapes or STRESS_SHAPES:
+            sizes = [base_size << k for k in range(STRESS_DOUBLINGS + 1)]
+            run = {"shape": shape, "options": options, "sizes": sizes, "seconds": [], "ratios": [], "growth": 0.0,
+                   "error": None}
+            try:
+                for size in sizes:
+                    run["seconds"].append(_best_time(STRESS_SHAPES[shape](size), options))
+            except Exception as e:
+                run["error"] = f"{type(e).__name__}: {e}"
+            seconds = run["seconds"]
+            run["ratios"] = [later / earlier if earlier else 0.0 for earlier, later in zip(seconds, seconds[1:])]
+            run["growth"] = _fitted_growth(seconds)
+            run["passed"] = run["error"] is None and (
+                seconds[-1] < STRESS_MIN_SECONDS or run["growth"] <= MAX_DOUBLING_RATIO)
+            runs.append(run)
+            print(f"{'ok' if run['passed'] else 'FAIL':>4} {shape:>26}  "
+                  + " ".join(f"{t:7.3f}s" for t in seconds)
+                  + "".join(f" x{r:.2f}" for r in run["ratios"])
+                  + f"  fit x{run['growth']:.2f}"
+                  + f"  {json.dumps({k: v for k, v in options.items() if k != 'seed'})}"
+                  + (f"  {run['error']}" if run["error"] else ""), file=sys.stderr)
+    return runs
+
+def _parse_size(text):
+    units = {"KB": 1_000, "MB": 1_000_000, "B": 1}
+    text = text.strip().upper()
+    for unit, factor in units.items():
+        if text.endswith(unit):
+            return int(float(text[:-len(unit)]) * factor)
+    return int(text)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Wabi Sabi obfuscator benchmarks")
+    parser.add_argument("--max-size", default="10MB", help="Largest corpus size (default: 10MB)")
+    parser.add_argument("--shapes", default=",".join(SHAPES), help="Comma-separated corpus shapes")
+    parser.add_argument("--seed", type=int, default=0, help="Seed for the corpus and the obfuscator")
+    parser.add_argument("--no-memory", action="store_true", help="Skip the tracemalloc peak-memory run")
+    parser.add_argument("--options", default="{}", help="JSON dict of WabiSabiObfuscator options")
+    parser.add_argument("--stress", action="store_true",
+                        help="Run the pathological-input scaling suite instead (exit status 1 on failure)")
+    parser.add_argument("--stress-size", default=str(STRESS_SIZE), help="Smallest stress input size")
+    parser.add_argument("--json", default=None, metavar="PATH", help="Write results as JSON ('-' for stdout)")
+    args = parser.parse_args(argv)
+
+    if args.stress:
+        shapes = args.shapes.split(",") if args.shapes != parser.get_default("shapes") else None
+        runs = stress(_parse_size(args.stress_size), shapes, args.seed)
+        _write_json(args.json, {"max_doubling_ratio": MAX_DOUBLING_RATIO, "runs": runs})
+        failed = [run for run in runs if not run["passed"]]
+        print(f"{len(runs) - len(failed)}/{len(runs)} stress runs scale linearly", file=sys.stderr)
+        sys.exit(1 if failed else 0)
+
+    max_size = _parse_size(args.max_size)
+    options = {"seed": args.seed, **json.loads(args.options)}
+    results = {"options": options, "loop_weight": LOOP_WEIGHT, "max_weighted_depth": MAX_WEIGHTED_DEPTH,
+               "runs": []}
+
+    for shape in args.shapes.split(","):
+        for size in SIZES:
+            if size > max_size:
+                break
+            source = generate_corpus(shape, size, args.seed)
+            run = bench_one(source, options, measure_memory=not args.no_memory)
+            run.update(shape=shape, target_size=size)
+            results["runs"].append(run)
+            print(f"{shape:>13} {size:>10,}B  {run['seconds']:8.3f}s  {run['throughput_mb_s']:6.2f} MB/s  "
+                  f"x{run['expansion_ratio']:.2f}  ea={run['output_cost']['weighted']['ea_calls']}",
+                  file=sys.stderr)
+
+    _write_json(args.json, results)
+
+def _write_json(path, results):
+    """Writes results as JSON to path ('-' for stdout; None writes nothing)."""
+    if not path:
+        return
+    text = json.dumps(results, indent=2)
+    if path == "-":
+        print(text)
+    else:
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(text)
+
+if __name__ == "__main__":
+    main()
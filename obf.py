@@ -2,61 +2,993 @@ import re
 import random
 import string
 import math
+import os
+import sys
+import json
+import hashlib
+import time
+import argparse
+from array import array
+from collections import OrderedDict
+from dataclasses import dataclass, field, asdict
+from concurrent.futures import ProcessPoolExecutor
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import threading
+
+# Globals virtualized by _mangle_globals (extend via WabiSabiObfuscator(extra_globals=...))
+DEFAULT_GLOBALS = (
+    "print", "warn", "error", "game", "workspace", "math", "table", "string", 
+    "task", "wait", "spawn", "getfenv", "setfenv", "pcall", "xpcall", 
+    "pairs", "ipairs", "next", "type", "tostring", "tonumber", "select", 
+    "unpack", "require", "Drawing", "Vector2", "Vector3", "CFrame", 
+    "Color3", "UDim2", "Instance", "Enum", "RaycastParams", "Random", 
+    "utf8", "os", "coroutine", "debug", "tick", "time", "delay", "defer",
+    "getgenv", "getrenv", "identifyexecutor", "setclipboard", "readfile", 
+    "writefile", "isfile", "delfile", "listfiles", "makefolder", "delfolder",
+    "iskeypressed", "mouse1click", "ismouse1pressed", "mouse2click", "ismouse2pressed",
+    "getscripthash", "isrbxactive", "keyrelease", "keypress", "mouse1press",
+    "mouse1release", "mouse2press", "mouse2release", "mousemoveabs", "mousemoverel",
+    "mousescroll", "run_secure", "setfflag", "getfflag", "loadstring", "decompile"
+)
+
+# Token kinds that need a separating space when they touch in _reconstruct
+WORD_KINDS = frozenset(('KEYWORD', 'IDENT', 'NUMBER'))
+
+# Reserved words the lexer reports as IDENT; they never name a variable
+NON_NAME_WORDS = frozenset(('and', 'or', 'not', 'return', 'break', 'in', 'nil', 'true', 'false', 'goto'))
+
+# Words that cannot end a statement; a line ending in one continues on the next line
+CONTINUATION_WORDS = frozenset(('and', 'or', 'not', 'return', 'in', 'local', 'function',
+                                'if', 'elseif', 'while', 'until', 'for'))
+
+# Reserved words; generated identifiers must avoid them
+LUA_KEYWORDS = frozenset(('and', 'break', 'do', 'else', 'elseif', 'end', 'false', 'for', 'function', 'goto',
+                          'if', 'in', 'local', 'nil', 'not', 'or', 'repeat', 'return', 'then', 'true',
+                          'until', 'while', 'continue'))
+
+# Hoisted global aliases are locals of the main chunk, and Lua allows 200 locals per
+# function, so MAX_MAIN_CHUNK_LOCALS leaves room for the header. Every function using
+# an alias also captures it as an upvalue, on top of the outer locals it already
+# captures, and Lua 5.1 allows 60 upvalues per function: globals that would take a
+# function over MAX_UPVALUES are not hoisted.
+MAX_HOISTED_GLOBALS = 32
+MAX_MAIN_CHUNK_LOCALS = 160
+MAX_UPVALUES = 60
+
+# Accepted values for WabiSabiObfuscator(string_pool=...)
+STRING_POOL_MODES = (None, 'lazy', 'eager')
+
+# Per-loop-depth transform rates used by WabiSabiObfuscator(loop_budget=True):
+# full treatment at top level, a quarter inside one loop, nothing deeper.
+DEFAULT_LOOP_BUDGET = (1.0, 0.25, 0.0)
+
+# Logic inversion recurses per nested if; Lua itself rejects nesting beyond ~200
+# levels, so anything deeper is malformed input and is copied verbatim.
+MAX_INVERSION_NESTING = 200
+# Inverting an if/elseif chain nests the rest of the chain one level deeper per
+# elseif; only this many are converted so output stays within Lua's nesting limit.
+MAX_ELSEIF_NESTING = 8
+
+# Function flattening hoists a function's locals to its top; bodies that would need
+# more than this many locals (parameters included) are left as they are.
+MAX_FLATTENED_LOCALS = 120
+# Function flattening recurses per nested function and per nested if of a flattened
+# body, and every level re-walks what it contains. Functions nested deeper than
+# this are copied as they are and deeper ifs stay inside their block, which keeps
+# the pass linear (and off Python's recursion limit) on pathological nesting.
+MAX_FLATTEN_NESTING = 16
+
+# Callbacks connected to these run every frame, so their bodies count as a loop level
+HOT_CALLBACK_EVENTS = frozenset(('RenderStepped', 'Heartbeat', 'Stepped', 'PreRender', 'PreAnimation',
+                                 'PreSimulation', 'PostSimulation', 'BindToRenderStep'))
+
+# First line of every output; the only comment minify=True keeps
+BANNER = "-- Generated by Wabi Sabi Obfuscator\n"
+
+# Longest parenthesized expression (in tokens) minify=True examines for unwrapping
+MAX_MINIFY_GROUP = 64
+
+# Locals of the header's Ea() function (renamed by minify=True)
+HEADER_LOCALS = ('ib', 'da', 'Vb', 'Zf', 'kd', 'key_char', 'str_char')
+
+# Routines in the shared junk/predicate library of WabiSabiObfuscator(shared_junk=True)
+JUNK_LIBRARY_SIZE = 8
+
+# Smallest function body (in source tokens) WabiSabiObfuscator(lazy_functions=True)
+# stores encrypted and compiles on first call; a stub and its environment proxy
+# take a few dozen tokens.
+LAZY_FUNCTION_MIN_TOKENS = 200
+# A lazy function's stub captures the header locals and the outer names its body
+# uses; bodies needing more than Lua 5.1's 60 upvalues stay inline.
+MAX_LAZY_UPVALUES = 60
+
+# Accepted values for WabiSabiObfuscator(cff_dispatch=...)
+CFF_DISPATCH_MODES = ('ladder', 'table')
+
+# Accepted values for WabiSabiObfuscator(target_runtime=...); selects the byte XOR
+# used by Ea() and how the header reaches the global environment
+TARGET_RUNTIMES = ('auto', 'luau', 'lua51', 'lua53')
+
+# Transformed top-level chunks kept by WabiSabiObfuscator(incremental=True),
+# least recently used dropped first
+CHUNK_CACHE_SIZE = 50_000
+
+# WabiSabiObfuscator(jobs=n): pending chunks smaller than this in total (tokens) are
+# transformed in-process, where starting a pool would cost more than it saves (as is
+# everything on a single CPU: the workers re-lex their chunks and the results are
+# pickled back, about 1.6x the in-process time); each worker gets this many
+# contiguous batches, to even out uneven chunk sizes
+PARALLEL_MIN_TOKENS = 50_000
+PARALLEL_BATCHES_PER_JOB = 4
+
+# Characters read per step by obfuscate_stream (grown while one statement is larger)
+STREAM_BLOCK_SIZE = 1 << 16
+
+# Profile builds (instrument=True): the global the counter dump is published as, and
+# the prefix of every dump line (profile_report() reads only those lines)
+PROFILE_DUMP_GLOBAL = "WabiSabiProfile"
+PROFILE_LINE_PREFIX = "WSPROF"
+
+# Daemon mode (--serve): jobs accepted per worker before answering 503, the largest
+# accepted request body, and the warm obfuscators each worker keeps (one per options)
+DAEMON_QUEUE_PER_WORKER = 4
+DAEMON_MAX_REQUEST_BYTES = 64 * 1024 * 1024
+DAEMON_MAX_OBFUSCATORS = 32
+# Options the daemon sets itself: workers always profile (for the stats in the
+# reply) and a job must not start its own pool inside a pool worker
+DAEMON_RESERVED_OPTIONS = ("profile", "jobs")
+
+@dataclass
+class PassStats:
+    """Measurements for one pipeline pass. Sizes are in characters of token text."""
+    name: str
+    seconds: float
+    input_size: int
+    output_size: int
+    tokens: int
+    transforms: dict = field(default_factory=dict)
+
+@dataclass
+class ObfuscationStats:
+    """Per-pass report of one obfuscate() call (WabiSabiObfuscator(profile=True))."""
+    input_size: int = 0
+    output_size: int = 0
+    seconds: float = 0.0
+    passes: list = field(default_factory=list)
+    functions: list = field(default_factory=list) # One FlatteningReport dict per flattened function
+    unminified_size: int = 0 # Output size without minify=True (0 when not minified)
+
+    @property
+    def expansion_ratio(self):
+        return self.output_size / self.input_size if self.input_size else 0.0
+
+    @property
+    def compression_ratio(self):
+        """Minified output size relative to the unminified output (1.0 when not minified)."""
+        return self.output_size / self.unminified_size if self.unminified_size else 1.0
+
+    def to_dict(self):
+        data = asdict(self)
+        data["expansion_ratio"] = self.expansion_ratio
+        data["compression_ratio"] = self.compression_ratio
+        return data
+
+    def to_json(self, indent=2):
+        return json.dumps(self.to_dict(), indent=indent)
+
+@dataclass
+class _ChunkResult:
+    """A top-level chunk after the per-chunk passes of incremental mode."""
+    tokens: list
+    global_counts: dict      # Uses of each virtualized global
+    assigned_globals: set    # Globals the chunk assigns to (never hoisted)
+    main_chunk_locals: int   # Locals the chunk declares outside functions
+    crowded_functions: list  # (room, globals) of the functions near the upvalue limit
+    idents: frozenset        # Identifiers in use, avoided by hoisting aliases
+
+@dataclass
+class FlatteningReport:
+    """
+    Cost of one function flattened by WabiSabiObfuscator(flatten_functions=n).
+    Every dispatcher step runs one loop test, on average compares_per_step
+    state comparisons and one state update; min_steps is the fewest steps a
+    call takes from entry to exit (or return).
+    """
+    name: str
+    granularity: int
+    blocks: int
+    locals_hoisted: int
+    min_steps: int
+    compares_per_step: float
+
+@dataclass
+class ProfileSite:
+    """
+    One counted construct of a profile build (WabiSabiObfuscator(instrument=True)),
+    as listed in its symbol_map: kind is 'decrypt' (an Ea() call), 'pool' (a
+    string pool lookup), 'global' (a Ma[...] lookup), 'dispatch' (a dispatcher
+    loop step), 'predicate' (an opaque predicate test) or 'junk' (a junk block
+    run); line is the source line it stands for (None for the main dispatcher).
+    """
+    id: int
+    kind: str
+    line: int
+    detail: str
+
+class _Unflattenable(Exception):
+    """A function body flattening cannot handle safely; it is left as it is."""
+
+def _stream_blocks(reader, size):
+    """Text pieces of a file object (read in blocks of size) or of an iterable of str."""
+    if hasattr(reader, 'read'):
+        while True:
+            block = reader.read(size)
+            if not block:
+                return
+            yield block
+    else:
+        yield from reader
+
+def _write_text(writer, text):
+    """Writes text and returns its length."""
+    writer.write(text)
+    return len(text)
+
+def _text_size(data):
+    """Size of a source string or of the text held by a token list."""
+    if isinstance(data, str):
+        return len(data)
+    return sum(len(val) for kind, val in data)
+
+# =========================================================================
+# LEXER
+# =========================================================================
+
+# Token kinds of the lexer. The index of a kind in this tuple is its kind code in
+# the compact TokenSpans form.
+TOKEN_KINDS = ('COMMENT', 'STRING', 'KEYWORD', 'IDENT', 'NUMBER', 'OP', 'NL', 'WS', 'MISC', 'UNFINISHED')
+
+# Words the lexer reports as KEYWORD (the block structure); other words are IDENT
+BLOCK_KEYWORDS = frozenset(('if', 'then', 'else', 'elseif', 'end', 'do', 'function',
+                            'repeat', 'until', 'while', 'for', 'local'))
+
+# The line-break token; shared by every token list instead of re-created
+NL_TOKEN = ('NL', '\n')
+
+class TokenSpans:
+    """
+    Compact lexer output for passes that only need structure: one kind code
+    (index into TOKEN_KINDS) and a start/end offset per token, with no copied
+    substrings. value(i) slices the text on demand; tokens() builds the usual
+    (kind, value) list. Comments and plain whitespace are not recorded.
+
+    Only obfuscate_stream uses it (_stream_chunks), to find chunk boundaries
+    and cut offsets in its read window. The whole-file pipeline keeps the
+    (kind, value) list of tokenize(): every pass compares token values and
+    splices generated tokens in, so spans would be sliced back into strings
+    right away. There, repeated tokens share one interned tuple instead.
+    """
+    __slots__ = ('source', 'kinds', 'starts', 'ends')
+
+    def __init__(self, source):
+        self.source = source
+        self.kinds = bytearray()
+        self.starts = array('l')
+        self.ends = array('l')
+
+    def __len__(self):
+        return len(self.kinds)
+
+    def kind(self, i):
+        return TOKEN_KINDS[self.kinds[i]]
+
+    def value(self, i):
+        return self.source[self.starts[i]:self.ends[i]]
+
+    def tokens(self):
+        source = self.source
+        nl, string_ = TOKEN_KINDS.index('NL'), TOKEN_KINDS.index('STRING')
+        interned = {}
+        out = []
+        for code, start, end in zip(self.kinds, self.starts, self.ends):
+            if code == nl:
+                out.append(NL_TOKEN)
+            elif code == string_:
+                out.append(('STRING', source[start:end]))
+            else:
+                value = source[start:end]
+                token = interned.get(value)
+                if token is None:
+                    token = interned[value] = (TOKEN_KINDS[code], value)
+                out.append(token)
+        return out
+
+class LuaLexer:
+    """
+    Lua lexer shared by the whole process (see LEXER). The master regex is built
+    and compiled on first use only, then reused by every call and every instance.
+
+    tokenize() is the fast path producing the pipeline's (kind, value) list in one
+    pass. Tokens with the same text are the same tuple object, so keywords,
+    operators and repeated identifiers cost one allocation per file, not per use.
+    """
+    # Alternatives are tried in order, most frequent first. Only the overlaps matter:
+    # NUMBER, COMMENT and STRING must precede OP ('.5', '--', '[['). Keywords are
+    # lexed as IDENT and told apart by BLOCK_KEYWORDS, which is cheaper than a
+    # keyword alternative tried at every position.
+    #
+    # Every alternative matches in time linear in what it consumes. Quoted strings
+    # use possessive repeats where the regex engine has them (Python 3.11+), so a
+    # long unterminated quote fails after one scan instead of backtracking through
+    # it; the older form is as linear, only several times slower on such input.
+    # Long brackets stay lazy: each ']' costs one look at the closing level.
+    if sys.version_info >= (3, 11):
+        QUOTED_STRING = r'"(?:[^"\\]++|\\.)*+"|\'(?:[^\'\\]++|\\.)*+\''
+    else:
+        QUOTED_STRING = r'"(?:[^"\\]|\\.)*"|\'(?:[^\'\\]|\\.)*\''
+    SPECIFICATION = (
+        ('WS',      r'[ \t\r\f\v]+'),              # Whitespace within a line
+        ('IDENT',   r'[A-Za-z_][A-Za-z0-9_]*'),    # Identifiers (and keywords)
+        ('NL',      r'[ \t\r\f\v]*\n\s*'),         # Whitespace containing a line break
+        # Matches Hex (0x...), Scientific (1e10), and Standard Numbers.
+        # Prevents splitting "1e10" into "1", "e", "10" which causes syntax errors in reconstruction.
+        # Listed before OP so a leading-dot literal (.5) is not split into '.' and '5'.
+        # A trailing-dot literal (3.) keeps its dot: it is a float in Lua 5.3.
+        ('NUMBER',  r'0[xX][0-9a-fA-F]+(?:(?:\.[0-9a-fA-F]*)?(?:[pP][+-]?\d+)?)?|(?<![\w.])\.\d+(?:[eE][+-]?\d+)?|\b\d+(?:\.\d*)?(?:[eE][+-]?\d+)?(?!\w)'),
+        ('COMMENT', r'--\[(?P<clevel>=*)\[.*?\](?P=clevel)\]|--(?!\[=*\[)[^\n]*'), # Matches --[[...]], --[==[...]==] or --...
+        ('STRING',  QUOTED_STRING + r'|(\[(?P<slevel>=*)\[.*?\](?P=slevel)\])'), # Strings
+        # A string or long comment that is never closed takes the rest of the text: the
+        # input is malformed, or (streaming) it was cut and continues in the next block
+        ('UNFINISHED', r'(?:--)?\[=*\[.*|["\'].*'),
+        ('OP',      r'[+\-*/%^#=~<>()\[\]{},;.]'), # Operators
+        ('MISC',    r'.'),                         # Any other char
+    )
+
+    _pattern = None      # Compiled master regex, shared by all instances
+    _group_kinds = None  # Regex group index -> kind code (None for inner groups)
+    _group_names = None  # Regex group index -> kind name
+
+    @classmethod
+    def _compiled(cls):
+        if cls._pattern is None:
+            pattern = re.compile('|'.join('(?P<%s>%s)' % pair for pair in cls.SPECIFICATION),
+                                 re.DOTALL | re.MULTILINE)
+            group_kinds = [None] * (pattern.groups + 1)
+            for name, index in pattern.groupindex.items():
+                if name in TOKEN_KINDS:
+                    group_kinds[index] = TOKEN_KINDS.index(name)
+            cls._group_kinds = tuple(group_kinds)
+            cls._group_names = tuple(None if code is None else TOKEN_KINDS[code] for code in group_kinds)
+            cls._pattern = pattern
+        return cls._pattern
+
+    def scan(self, code):
+        """Lexes code into a TokenSpans (kind codes and offsets only)."""
+        pattern = self._compiled()
+        group_kinds = self._group_kinds
+        comment, ws = TOKEN_KINDS.index('COMMENT'), TOKEN_KINDS.index('WS')
+        ident, keyword = TOKEN_KINDS.index('IDENT'), TOKEN_KINDS.index('KEYWORD')
+        spans = TokenSpans(code)
+        kinds, starts, ends = spans.kinds.append, spans.starts.append, spans.ends.append
+        for mo in pattern.finditer(code):
+            code_ = group_kinds[mo.lastindex]
+            if code_ == comment or code_ == ws:
+                continue
+            if code_ == ident and mo.group() in BLOCK_KEYWORDS:
+                code_ = keyword
+            kinds(code_)
+            starts(mo.start())
+            ends(mo.end())
+        return spans
+
+    def tokenize(self, code):
+        """Lexes code into the pipeline's list of (kind, value) tokens."""
+        pattern = self._compiled()
+        group_names = self._group_names
+        interned = {}
+        tokens = []
+        append = tokens.append
+        for mo in pattern.finditer(code):
+            kind = group_names[mo.lastindex]
+            if kind == 'WS' or kind == 'COMMENT':
+                continue
+            if kind == 'NL':
+                append(NL_TOKEN)
+            elif kind == 'STRING':
+                append((kind, mo.group())) # Rarely repeated and often long; not interned
+            else:
+                value = mo.group()
+                token = interned.get(value)
+                if token is None:
+                    if kind == 'IDENT' and value in BLOCK_KEYWORDS:
+                        kind = 'KEYWORD'
+                    token = interned[value] = (kind, value)
+                append(token)
+        return tokens
+
+    def tokenize_lines(self, code):
+        """
+        tokenize() for profile builds: every token value is a SourceText that
+        knows its 1-based source line. Nothing is interned, since equal tokens
+        on different lines differ.
+        """
+        pattern = self._compiled()
+        group_names = self._group_names
+        tokens = []
+        append = tokens.append
+        line = 1
+        for mo in pattern.finditer(code):
+            kind = group_names[mo.lastindex]
+            value = mo.group()
+            if kind == 'NL':
+                append(NL_TOKEN)
+            elif kind != 'WS' and kind != 'COMMENT':
+                if kind == 'IDENT' and value in BLOCK_KEYWORDS:
+                    kind = 'KEYWORD'
+                append((kind, SourceText(value, line)))
+            line += value.count('\n')
+        return tokens
+
+class SourceText(str):
+    """A token value that remembers the source line it was lexed from (see tokenize_lines)."""
+
+    def __new__(cls, value, line=None):
+        # (line is restored after __new__ when a token is unpickled in a worker)
+        text = super().__new__(cls, value)
+        text.line = line
+        return text
+
+class _LazyKeyword(SourceText):
+    """The 'function' keyword of a function lazy_functions loads on first call."""
+
+# The process-wide lexer instance
+LEXER = LuaLexer()
+
+class TokenTemplate:
+    """
+    A Lua snippet lexed once and re-used as tokens, for code the passes generate
+    (junk blocks, predicates, dispatcher lines). Holes are written $name and
+    filled by render(name=value): a str becomes an identifier, a number a
+    (possibly negative) literal, and a list of tokens is spliced in as is.
+    The snippet is lexed on its first render.
+    """
+    __slots__ = ('source', '_parts')
+
+    def __init__(self, source):
+        self.source = source
+        self._parts = None
+
+    def _lex(self):
+        tokens = LEXER.tokenize(self.source)
+        parts = []
+        i = 0
+        while i < len(tokens):
+            if tokens[i] == ('MISC', '$') and i + 1 < len(tokens):
+                parts.append(tokens[i + 1][1]) # A hole is stored as its bare name
+                i += 2
+            else:
+                parts.append(tokens[i])
+                i += 1
+        self._parts = parts
+        return parts
+
+    def render(self, **values):
+        parts = self._parts or self._lex()
+        filled = {name: _value_tokens(value) for name, value in values.items()}
+        out = []
+        for part in parts:
+            if part.__class__ is str:
+                out.extend(filled[part])
+            else:
+                out.append(part)
+        return out
+
+def _value_tokens(value):
+    """Tokens for a value filling a TokenTemplate hole."""
+    if isinstance(value, str):
+        return [('IDENT', value)]
+    if isinstance(value, (int, float)):
+        if value < 0:
+            return [('OP', '-'), ('NUMBER', str(-value))]
+        return [('NUMBER', str(value))]
+    return value
+
+def _is_field_name(tokens, i):
+    """True if the name at tokens[i] follows '.' (not '..') or ':', so it is not a variable."""
+    prev_val = tokens[i - 1][1] if i else None
+    return prev_val == ':' or (prev_val == '.' and (i < 2 or tokens[i - 2][1] != '.'))
+
+# Snippets generated by the passes (see TokenTemplate)
+JUNK_TEMPLATES = (
+    # Type 1: Useless Math Loop (NO WAIT)
+    TokenTemplate("local $a = 0; for i=1, $n do $a=$a+1; end"),
+    # Type 2: Table Junk
+    TokenTemplate("local $a = {}; $a[1] = $n;"),
+    # Type 3: Simple math
+    TokenTemplate("local $a = $n * $m;"),
+    # Type 4: Double variable junk
+    TokenTemplate("local $a = 1; local $b = 2; $a = $a + $b;"),
+)
+PREDICATE_TEMPLATES = (
+    # Square is always >= 0
+    (TokenTemplate("( ($a * $a) >= 0 )"), True),
+    # Absolute value check
+    # REMOVED: Strict equality check (==) which is dangerous with floats
+    # REPLACED WITH: Inequality check which is safer
+    (TokenTemplate("( math.abs(-$a) >= 0 )"), True),
+    # Impossible check
+    (TokenTemplate("( $a < -$a )"), False),
+    # Simple inequality - Changed from strict equality
+    (TokenTemplate("( $a + $b >= $a )"), True),
+)
+DISPATCH_STATE_INIT = TokenTemplate("local $state = $start")
+DISPATCH_TABLE_INIT = TokenTemplate("local $table = {}")
+DISPATCH_TABLE_ENTRY = TokenTemplate("$table[$id] = function($state, ...)")
+DISPATCH_TABLE_RETURN = TokenTemplate("return $state + ($target - $id)")
+DISPATCH_LOOP = TokenTemplate("while $state ~= 0 do")
+DISPATCH_TABLE_STEP = TokenTemplate("$state = $table[$state]($state, ...)")
+DISPATCH_RETURN_INIT = TokenTemplate("local $results local function $capture(...) "
+                                     "$results = {n = select('#', ...), ...} return 0 end")
+DISPATCH_RETURN_EXIT = TokenTemplate("if $results then return (table.unpack or unpack)($results, 1, $results.n) end")
+DISPATCH_LADDER_IF = TokenTemplate("if $state == $id then")
+DISPATCH_LADDER_ELSEIF = TokenTemplate("elseif $state == $id then")
+DISPATCH_LADDER_STEP = TokenTemplate("$state = $state + ($target - $id)")
+DISPATCH_YIELD = TokenTemplate("wait(0.001)")
+LIBRARY_INIT = TokenTemplate("local $library = {$routines}")
+LIBRARY_JUNK = TokenTemplate("function() $body end")
+LIBRARY_PREDICATE = TokenTemplate("function($a, $b) return $test end")
+LIBRARY_JUNK_CALL = TokenTemplate("$library[$handle]()")
+LIBRARY_PREDICATE_CALL = TokenTemplate("$library[$handle]($a, $b)")
+PROFILE_COUNT = TokenTemplate("$counter($id)")
+PROFILE_WRAP = TokenTemplate("$counter($id, $value)")
+LAZY_STUB = TokenTemplate("return ($cache[$id] or $load($id, $blob, $key, $env$values))($arguments)")
+LAZY_ENV = TokenTemplate("setmetatable({}, {__index = function($t, $k) $reads return $outer[$k] end, "
+                         "__newindex = function($t, $k, $v) $writes $outer[$k] = $v end})")
+LAZY_ENV_READ = TokenTemplate("if $k == $name then return $variable end")
+LAZY_ENV_WRITE = TokenTemplate("if $k == $name then $variable = $v return end")
+
+# =========================================================================
+# STRING ENCRYPTION
+# =========================================================================
+
+# Ea() starts reading the key at (kd - 93) % #key for the kd-th byte (1-based);
+# written as (kd-2053812/22084) and (8960-8867) in the generated header.
+ENCRYPT_KEY_OFFSET = 93
+
+# Key lengths drawn for each encrypted literal
+KEY_LENGTHS = (4, 5, 6, 7, 8)
+
+# Escaped form of every byte value, so rendering a ciphertext is one table lookup per byte
+ESCAPE_TABLE = tuple('\\%d' % b for b in range(256))
+
+# Escapes of Lua string literals: \ddd (decimal), \xXX, \u{XXX}, \z, an escaped
+# line break, or a single character (\n, \t, \\, \" ...)
+LUA_ESCAPE_RE = re.compile(r'\\(?:(\d{1,3})|x([0-9a-fA-F]{2})|u\{([0-9a-fA-F]+)\}|z\s*|(\r\n|\n\r|\n|\r)|(.))', re.DOTALL)
+LUA_SIMPLE_ESCAPES = {'a': b'\a', 'b': b'\b', 'f': b'\f', 'n': b'\n', 'r': b'\r', 't': b'\t', 'v': b'\v'}
+
+def _decode_lua_escape(mo):
+    decimal, hexa, codepoint, line_break, char = mo.groups()
+    if decimal is not None:
+        value = int(decimal)
+        if value > 255:
+            raise ValueError(f"escape sequence too large: \\{decimal}")
+        return bytes((value,))
+    if hexa is not None:
+        return bytes((int(hexa, 16),))
+    if codepoint is not None:
+        return chr(int(codepoint, 16)).encode('utf-8', 'surrogatepass')
+    if line_break is not None:
+        return b'\n'
+    if char is not None:
+        return LUA_SIMPLE_ESCAPES.get(char) or char.encode('utf-8')
+    return b'' # \z skips the whitespace that follows it
+
+def _decode_lua_string(body):
+    """
+    Bytes of a quoted Lua literal, given the text between its quotes.
+    Non-ASCII source characters are taken as UTF-8, as Lua reads them.
+    Raises ValueError for an escape Lua would reject (\\256 and up).
+    """
+    if '\\' not in body:
+        return body.encode('utf-8')
+    out = bytearray()
+    pos = 0
+    for mo in LUA_ESCAPE_RE.finditer(body):
+        out += body[pos:mo.start()].encode('utf-8')
+        out += _decode_lua_escape(mo)
+        pos = mo.end()
+    out += body[pos:].encode('utf-8')
+    return bytes(out)
+
+def _key_stream(key, length):
+    """The key bytes Ea() XORs against the first `length` bytes of a literal."""
+    start = (1 - ENCRYPT_KEY_OFFSET) % len(key)
+    rotated = key[start:] + key[:start]
+    return (rotated * (length // len(key) + 1))[:length]
+
+def _xor_bulk(plaintexts, keys):
+    """
+    Encrypts many literals at once: all plaintexts and their key streams are
+    concatenated and XORed as two big integers, then split again.
+    Returns the escaped ciphertext of each literal.
+    """
+    data = b''.join(plaintexts)
+    stream = b''.join(_key_stream(key, len(text)) for text, key in zip(plaintexts, keys))
+    cipher = (int.from_bytes(data, 'little') ^ int.from_bytes(stream, 'little')).to_bytes(len(data), 'little')
+    escape = ESCAPE_TABLE.__getitem__
+    out = []
+    pos = 0
+    for text in plaintexts:
+        end = pos + len(text)
+        out.append(''.join(map(escape, cipher[pos:end])))
+        pos = end
+    return out
+
+# Shortest spelling of every byte in a quoted literal (minify=True), per quote
+# character: printable ASCII as is, the one-letter escapes, else \ddd without
+# leading zeros (padded to three digits only when a digit follows).
+SHORT_ESCAPES = {'\n': '\\n', '\t': '\\t', '\r': '\\r', '\a': '\\a', '\b': '\\b', '\f': '\\f',
+                 '\v': '\\v', '\\': '\\\\', "'": "\\'", '"': '\\"'}
+SHORT_ESCAPE_TABLES = {
+    quote: tuple(chr(b) if 32 <= b < 127 and chr(b) not in (quote, '\\') else SHORT_ESCAPES.get(chr(b), '\\%d' % b)
+                 for b in range(256))
+    for quote in ("'", '"')
+}
+
+def _shortest_literal(data):
+    """The shortest quoted Lua literal (quotes included) for a byte string."""
+    quote = "'" if data.count(b"'") <= data.count(b'"') else '"'
+    table = SHORT_ESCAPE_TABLES[quote]
+    out = [quote]
+    last = len(data) - 1
+    for i, b in enumerate(data):
+        text = table[b]
+        if len(text) < 4 and text[-1].isdigit() and i < last and 48 <= data[i + 1] <= 57:
+            text = '\\%03d' % b # The next byte is a digit; do not let it extend the escape
+        out.append(text)
+    out.append(quote)
+    return ''.join(out)
+
+def _short_identifiers():
+    """Lua identifiers shortest first: one character, then two, and so on."""
+    first = string.ascii_letters + '_'
+    rest = first + string.digits
+    names = list(first)
+    while True:
+        yield from names
+        names = [name + char for name in names for char in rest]
+
+# =========================================================================
+# NUMBER ENCODING
+# =========================================================================
+
+# Encodings of numeric literals and what each costs per evaluation at runtime.
+# The folding forms are constant expressions, which the Lua 5.x and Luau compilers
+# evaluate at compile time, so only the constant table has a runtime cost; it is
+# used where code runs once (top level, outside loops and functions).
+NUMBER_ENCODING_COSTS = {
+    'table': 2,     # Na[i]: an upvalue (or local) read plus a table index
+    'additive': 0,  # (r + o), folded
+    'xor': 0,       # (a ~ b), folded; integers on target_runtime='lua53' only
+    'plain': 0,     # The literal itself, when no form reproduces it exactly
+}
+
+# Distinct literals kept in the constant table; Lua 5.1 caps the constants of
+# one function (the header is part of the main chunk) at 2^18.
+MAX_NUMBER_TABLE = 4096
+
+# Integers beyond this are doubles in Lua 5.1 / Luau and may not survive arithmetic
+MAX_EXACT_INTEGER = 2 ** 53
+
+def _lua_number_value(text):
+    """
+    The int or float a Lua numeric literal stands for, keeping Lua 5.3's
+    distinction (1e3 and 2.0 are floats), or None for literals left as
+    written: hex floats, non-finite values and integers beyond 2^53.
+    """
+    lowered = text.lower()
+    if lowered.startswith('0x'):
+        if '.' in lowered or 'p' in lowered:
+            return None
+        value = int(lowered, 16)
+    elif '.' in lowered or 'e' in lowered:
+        value = float(lowered)
+        return value if math.isfinite(value) else None
+    else:
+        value = int(lowered)
+    return value if value < MAX_EXACT_INTEGER else None
 
 class WabiSabiObfuscator:
-    def __init__(self):
+    def __init__(self, extra_globals=(), seed=None, rng=None, string_pool=None, hoist_globals=False,
+                 cff_dispatch='ladder', cff_yield=True, loop_budget=None, profile=False,
+                 target_runtime='auto', incremental=False, flatten_functions=None, minify=False,
+                 instrument=False, shared_junk=None, jobs=None, max_input_size=None, time_limit=None,
+                 lazy_functions=None):
+        """
+        extra_globals: additional global names to virtualize alongside DEFAULT_GLOBALS.
+        seed:          makes output reproducible; every obfuscate() call restarts from it.
+        rng:           a random.Random to draw from instead of a private one.
+        string_pool:   None emits an Ea(...) call at every use site. 'lazy' / 'eager'
+                       encrypt each distinct literal once into a constant pool that is
+                       decrypted on first use / at load time, referenced as Ka[index].
+        hoist_globals: resolve the most used virtualized globals once into local
+                       aliases at the top of the chunk. True hoists up to
+                       MAX_HOISTED_GLOBALS names; an int sets a lower cap.
+        cff_dispatch:  'ladder' (if/elseif chain) or 'table' (O(1) closure table).
+        cff_yield:     call wait() after every dispatcher step.
+        loop_budget:   per-loop-depth transform rates, e.g. (1.0, 0.25, 0.0): index 0 is
+                       top-level code, index n is code nested in n loops (the last entry
+                       covers anything deeper). Logic inversion, predicate injection and
+                       number mangling are applied with that probability. True uses
+                       DEFAULT_LOOP_BUDGET; None applies every transform everywhere.
+        profile:       record an ObfuscationStats report in self.stats on every
+                       obfuscate() call (time, sizes, tokens and transform counts per pass).
+        target_runtime: runtime the output is for, which picks the XOR behind Ea().
+                       'luau' calls bit32.bxor directly, 'lua51' indexes a 256x256
+                       table built on first use, 'lua53' uses the native ~ operator
+                       (and _ENV instead of getfenv). 'auto' uses bit32 when present
+                       and the table otherwise.
+        incremental:   transform every top-level statement separately and cache the
+                       result by its fingerprint, so re-obfuscating an edited file only
+                       redoes the changed statements. Chunks draw from their own RNG
+                       (seed + fingerprint), so the output differs from non-incremental
+                       mode but is still reproducible with a seed.
+        flatten_functions: split function bodies into basic blocks of this many
+                       statements (True = 1) run by a per-function dispatcher, with
+                       their locals hoisted to the top of the function. None disables
+                       it. With profile=True every flattened function is reported in
+                       stats.functions (blocks, dispatch steps and compares).
+        minify:        shrink the final output (header included): no line breaks,
+                       shortest string escapes, no grouping-only parentheses around
+                       names and literals, shortest names for the generated variables.
+                       Layout only: repeated lookups (Ma[Ea(...)], Na[k]) are not
+                       aliased and the encrypted payload does not shrink, so expect
+                       about 0.85-0.9 of the plain size. With profile=True,
+                       stats.compression_ratio tells the gain.
+        instrument:    emit a profile build: every Ea() decryption, string pool and
+                       Ma[...] lookup, dispatcher step, opaque predicate and junk block
+                       bumps a counter (Pk(id, value)), and the time spent in Ea() is
+                       measured with os.clock. The dump is printed when the main chunk
+                       ends and is returned by the global WabiSabiProfile() at any time.
+                       self.symbol_map lists every counted site with its source line;
+                       profile_report() ranks them. The map holds plaintext literals:
+                       keep it with the sources. Not available with incremental=True
+                       or obfuscate_stream().
+        shared_junk:   generate a library of junk routines and opaque predicate
+                       functions once per output (True: JUNK_LIBRARY_SIZE of them, an
+                       int: that many) and turn every junk block and predicate into a
+                       call through a numeric handle, Ja[n]() or Ja[n](a, b), instead
+                       of a fresh inline snippet. None inlines at every site.
+        jobs:          split the file at top-level statements and run the per-chunk
+                       passes (steps 2-3 and 5-8) in a pool of this many worker
+                       processes, then link the chunks under one header and
+                       dispatcher. This is the incremental pipeline, so the output
+                       is the same as with incremental=True, for any number of jobs
+                       (1 included). At most os.cpu_count() workers are started, and
+                       none for a single CPU or under PARALLEL_MIN_TOKENS of changed
+                       chunks. None runs the whole-file pipeline.
+        max_input_size: refuse (ValueError) input longer than this many characters
+                       before any work is done. None accepts any size.
+        time_limit:    seconds an obfuscate() or obfuscate_stream() call may take;
+                       past it the call stops with TimeoutError at the next check
+                       (between passes, chunks and flattened functions). Every pass
+                       is linear in its input, so a check is never far away. None
+                       runs without a limit.
+        lazy_functions: store the body of every function with at least this many
+                       source tokens (True: LAZY_FUNCTION_MIN_TOKENS), defined outside
+                       any other function or loop, as a blob encrypted like a string.
+                       A stub decrypts and compiles it with loadstring on the first
+                       call and calls the cached closure from then on, so loading
+                       the script only compiles the code that runs. The body reaches
+                       the variables around it through an environment proxy, which
+                       makes those accesses slower than upvalues. None compiles
+                       everything at load time.
+        """
+        if string_pool not in STRING_POOL_MODES:
+            raise ValueError(f"string_pool must be one of {STRING_POOL_MODES}, got {string_pool!r}")
+        if cff_dispatch not in CFF_DISPATCH_MODES:
+            raise ValueError(f"cff_dispatch must be one of {CFF_DISPATCH_MODES}, got {cff_dispatch!r}")
+        if target_runtime not in TARGET_RUNTIMES:
+            raise ValueError(f"target_runtime must be one of {TARGET_RUNTIMES}, got {target_runtime!r}")
+        if flatten_functions is not None and flatten_functions is not True and int(flatten_functions) < 1:
+            raise ValueError(f"flatten_functions must be a positive number of statements, got {flatten_functions!r}")
+        if shared_junk is not None and shared_junk is not True and int(shared_junk) < 2:
+            raise ValueError(f"shared_junk must be at least 2 routines (one junk, one predicate), got {shared_junk!r}")
+        if jobs is not None and int(jobs) < 1:
+            raise ValueError(f"jobs must be a positive number of worker processes, got {jobs!r}")
+        if lazy_functions is not None and lazy_functions is not True and int(lazy_functions) < 1:
+            raise ValueError(f"lazy_functions must be a positive number of tokens, got {lazy_functions!r}")
+        if max_input_size is not None and int(max_input_size) < 0:
+            raise ValueError(f"max_input_size must not be negative, got {max_input_size!r}")
+        if time_limit is not None and not float(time_limit) > 0:
+            raise ValueError(f"time_limit must be a positive number of seconds, got {time_limit!r}")
+        if instrument and (incremental or jobs is not None):
+            raise ValueError("instrument=True needs the whole file at once; it cannot be combined with "
+                             "incremental=True or jobs")
+        # Constructor arguments, to build the same obfuscator in a worker process (jobs)
+        self._options = dict(extra_globals=tuple(extra_globals), string_pool=string_pool,
+                             hoist_globals=hoist_globals, cff_dispatch=cff_dispatch, cff_yield=cff_yield,
+                             loop_budget=loop_budget, profile=profile, target_runtime=target_runtime,
+                             flatten_functions=flatten_functions, minify=minify, shared_junk=shared_junk,
+                             lazy_functions=lazy_functions)
         self.var_Ma = "Ma"  # The global environment proxy
         self.var_Ea = "Ea"  # The string decryptor
         self.var_Ta = "Ta"  # The table holding code blocks
+        self.var_results = "Ra" # Values returned by the main chunk (table dispatch)
+        self.var_capture = "Rb" # Stores the returned values in Ra, returns the exit state
+        self.var_junk = "Ja" # The shared junk/predicate library (shared_junk mode)
+        self.var_lazy = "La" # Lazy function closures by stub id, once compiled (lazy_functions mode)
+        self.var_lazy_load = "Lb" # Decrypts, compiles and caches a lazy function body
         self.var_string_char = "Q"
         self.var_string_byte = "Ca"
         self.var_bit_xor = "ed"
+        self.var_table_concat = "Xa"
+        self.var_pool = "Ka"      # Decrypted string pool (cache)
+        self.var_pool_data = "Pa" # Encrypted string pool: key/value pairs, flattened
+        self.string_pool = string_pool
+        self._pool_index = {}     # decoded literal bytes -> 1-based pool index
+        self._pool_entries = []   # (encrypted, key) per pool index
+        self.var_numbers = "Na"   # Constant table of top-level numeric literals
+        self._number_index = {}   # (is float, value) -> 1-based constant table index
+        self._number_entries = [] # Literal text per constant table index (None: no table)
+        self.var_profile = "Pk"   # Profile build: counts one run of a site, returns its other arguments
+        self.var_profile_counts = "Pc"  # Profile build: site id -> count
+        self.var_profile_start = "Pt"   # Profile build: os.clock() at load time
+        self.var_profile_decrypt = "Pe" # Profile build: seconds spent in Ea()
+        self.var_profile_dump = "Pd"    # Profile build: returns the dump text
+        self.profile = profile
+        self.stats = None
+        self._counts = {}         # Transform counters of the running pass
+        self.cff_dispatch = cff_dispatch
+        self._dispatch_vars = set() # State variables of the emitted dispatcher loops
+        self.loop_budget = DEFAULT_LOOP_BUDGET if loop_budget is True else (
+            tuple(loop_budget) if loop_budget is not None else None)
+        self.cff_yield = cff_yield
+        self.target_runtime = target_runtime
+        self.incremental = incremental
+        self.jobs = int(jobs) if jobs is not None else None
+        self.minify = minify
+        self.instrument = instrument
+        self.shared_junk = JUNK_LIBRARY_SIZE if shared_junk is True else (int(shared_junk) if shared_junk else None)
+        self._junk_library = []   # Function tokens per library handle (from 1)
+        self._junk_handles = []   # Handles of the junk routines
+        self._predicate_handles = [] # (handle, value) of the predicate functions
+        self.symbol_map = None    # Profile build: one ProfileSite dict per counted site, ids from 1
+        self.max_input_size = int(max_input_size) if max_input_size is not None else None
+        self.time_limit = float(time_limit) if time_limit is not None else None
+        self._deadline = None     # perf_counter() value the running call must finish by (time_limit)
+        self.lazy_functions = LAZY_FUNCTION_MIN_TOKENS if lazy_functions is True else (
+            int(lazy_functions) if lazy_functions else None)
+        self._lazy_ids = 0        # Lazy function stubs emitted by the running call
+        self.flatten_functions = 1 if flatten_functions is True else (
+            int(flatten_functions) if flatten_functions else None)
+        self._chunk_cache = OrderedDict() # chunk fingerprint -> _ChunkResult
+        self._chunk_regions = None # (source, [(start, end, fingerprint)]) of the last incremental call
+        self._chunk_salt = seed if seed is not None else os.urandom(8).hex()
+        self._symbolic = False    # Emit POOLREF / GLOBALREF / NUMREF tokens, resolved at link time
+        self.hoist_globals = MAX_HOISTED_GLOBALS if hoist_globals is True else int(hoist_globals)
+        self._hoisted_globals = [] # (alias, value tokens) emitted by the header
+        self.global_targets = frozenset(DEFAULT_GLOBALS).union(extra_globals)
+        # Every random choice goes through this instance, never the module-level random
+        self.seed = seed
+        self.rng = rng if rng is not None else random.Random(seed)
         
     def _generate_random_string(self, length=6):
-        return ''.join(random.choices(string.ascii_letters, k=length))
+        return ''.join(self.rng.choices(string.ascii_letters, k=length))
 
     def _xor_encrypt(self, text, key):
         """
         Encrypts a string for the Ea() function.
+        text is the literal's bytes (a str is taken as UTF-8); returns it as \\ddd escapes.
         """
-        encrypted_chars = []
-        key_len = len(key)
-        
-        # The Lua math noise: (kd-2053812/22084)%#da
-        # 2053812 / 22084 approx 93. So (kd - 93) % key_len.
-        OFFSET_VAL = 93 
-        
-        for i, char in enumerate(text):
-            kd = i + 1 # Lua uses 1-based indexing
-            lua_mod_index = (kd - OFFSET_VAL) % key_len
-            key_char_code = ord(key[int(lua_mod_index)])
-            char_code = ord(char)
-            enc_code = char_code ^ key_char_code
-            encrypted_chars.append(f"\\{enc_code}")
-            
-        return "".join(encrypted_chars)
+        if isinstance(text, str):
+            text = text.encode('utf-8')
+        return _xor_bulk([text], [key.encode('ascii')])[0]
 
-    def _mangle_number(self, num_str):
-        try:
-            val = float(num_str)
-            if val == 0: return "((10-10)*5)"
-            
-            # Revised Strategy: Additive Splitting for Precision
-            # Previous Multiplicative strategy (val / factor * factor) caused float precision errors
-            # (e.g. 9.999999 instead of 10) which broke table indices and equality checks.
-            # Additive (val - offset + offset) is safe for integers up to 2^53.
-            
-            offset = random.randint(100, 10000)
-            
-            # If it looks like an integer, keep it cleaner to avoid float casting in Lua
-            if val.is_integer():
-                remainder = int(val) - offset
-                return f"({remainder} + {offset})"
+    def _generate_keys(self, count):
+        """Draws `count` encryption keys with two RNG calls instead of two per key."""
+        lengths = self.rng.choices(KEY_LENGTHS, k=count)
+        letters = ''.join(self.rng.choices(string.ascii_letters, k=sum(lengths)))
+        keys = []
+        pos = 0
+        for length in lengths:
+            keys.append(letters[pos:pos + length])
+            pos += length
+        return keys
+
+    def _signed_number_tokens(self, value):
+        """Tokens for a numeric literal that may be negative (the lexer has no signed numbers)."""
+        if value < 0:
+            return [('OP', '-'), ('NUMBER', str(-value))]
+        return [('NUMBER', str(value))]
+
+    def _mangle_number(self, num_str, run_once=False):
+        """
+        Returns the token list of an expression evaluating to the literal: a
+        constant table lookup for code that runs once (run_once), otherwise a
+        form the Lua compiler folds back into the constant (NUMBER_ENCODING_COSTS).
+        Floats stay floats and every form is checked to reproduce the value
+        exactly; literals no form reproduces are left as written.
+        """
+        value = _lua_number_value(num_str)
+        if value is None:
+            return [('NUMBER', num_str)], 'plain'
+        if run_once and self._number_entries is not None:
+            if self._symbolic:
+                return [('NUMREF', (num_str, value))], 'table' # Indexed at link time
+            reference = self._number_reference(num_str, value)
+            if reference is not None:
+                return reference, 'table'
+
+        if isinstance(value, int) and self.target_runtime == 'lua53' and 0 <= value < 1 << 31 \
+                and self.rng.random() < 0.5:
+            key = self.rng.randint(1, (1 << 31) - 1)
+            return [('OP', '('), ('NUMBER', str(value ^ key)), ('OP', '~'), ('NUMBER', str(key)),
+                    ('OP', ')')], 'xor'
+
+        # Additive splitting (val - offset + offset). The earlier multiplicative form
+        # (val / factor * factor) caused float precision errors (9.999999 instead of
+        # 10) which broke table indices and equality checks. Integers are exact up
+        # to 2^53. A fraction gets an offset within [val/2, val], which makes the
+        # remainder exact (Sterbenz); a float remainder is only used if it adds
+        # back to the exact value.
+        for _ in range(4):
+            if isinstance(value, float) and not value.is_integer():
+                offset = value * self.rng.uniform(0.5, 1.0)
             else:
-                remainder = val - offset
-                return f"({remainder} + {offset})"
-        except:
-            return num_str
+                offset = self.rng.randint(100, 10000)
+            remainder = value - offset
+            # Literals are written with repr(), which Lua reads back as the same double
+            if isinstance(value, int) or remainder + offset == value:
+                return [('OP', '('), *self._signed_number_tokens(remainder),
+                        ('OP', '+'), ('NUMBER', repr(offset)), ('OP', ')')], 'additive'
+        return [('NUMBER', num_str)], 'plain'
+
+    def _number_reference(self, num_str, value):
+        """Na[i] tokens for a literal, adding it to the constant table; None once the table is full."""
+        key = (isinstance(value, float), value)
+        index = self._number_index.get(key)
+        if index is None:
+            if len(self._number_entries) >= MAX_NUMBER_TABLE:
+                return None
+            self._number_entries.append(num_str)
+            index = self._number_index[key] = len(self._number_entries)
+        return [('IDENT', self.var_numbers), ('OP', '['), ('NUMBER', str(index)), ('OP', ']')]
+
+    def _function_mask(self, tokens):
+        """1 for every token inside a function (header, body or end), 0 elsewhere."""
+        nesting = [0] * (len(tokens) + 1) # Functions opened (+) and closed (-) at each index
+        for opener, markers in self._parse_blocks(tokens).items():
+            if tokens[opener][1] == 'function':
+                nesting[opener] += 1
+                nesting[markers[-1] + 1] -= 1
+        mask = bytearray(len(tokens))
+        depth = 0
+        for i in range(len(tokens)):
+            depth += nesting[i]
+            if depth:
+                mask[i] = 1
+        return mask
+
+    def _mangle_numbers(self, tokens):
+        """
+        Replaces every NUMBER token with its mangled expression (within the loop
+        budget). Literals at top level outside loops and functions run once and
+        go to the constant table; the rest get a form that costs nothing at runtime.
+        """
+        depths = self._loop_depths(tokens)
+        in_function = self._function_mask(tokens)
+        budgeted = self.loop_budget is not None
+        transformed_tokens = []
+        for i, token in enumerate(tokens):
+            if token[0] == 'NUMBER' and (not budgeted or self._within_budget(depths[i])):
+                encoded, encoding = self._mangle_number(token[1], run_once=not depths[i] and not in_function[i])
+                transformed_tokens.extend(encoded)
+                self._count('numbers_mangled')
+                self._count(f'numbers_{encoding}')
+            else:
+                transformed_tokens.append(token)
+        return transformed_tokens
 
     def _mangle_boolean(self, val):
         """
@@ -73,120 +1005,390 @@ class WabiSabiObfuscator:
         the number mangling step in the pipeline will handle these integers later.
         This avoids issues with scientific notation being generated prematurely
         and then incorrectly re-mangled by the pipeline's number pattern.
+
+        Returns the expression as a token list.
         """
         if val:
             # True case: not(not X) where X is truthy (a non-zero number)
             # This double negation always evaluates to true for truthy values
             # Alternative: simple comparison like (50 > 20)
-            strategy = random.choice(['double_not', 'comparison'])
+            strategy = self.rng.choice(['double_not', 'comparison'])
             if strategy == 'double_not':
                 # Use a raw integer; it will be mangled by the pipeline later
-                num = random.randint(1, 999)
-                return "not(not {})".format(num)
+                num = self.rng.randint(1, 999)
+                return [('IDENT', 'not'), ('OP', '('), ('IDENT', 'not'), ('NUMBER', str(num)), ('OP', ')')]
             else:
                 # Comparison that always evaluates to true
-                a = random.randint(50, 500)
-                b = random.randint(1, 49)
-                return "({} > {})".format(a, b)
+                a = self.rng.randint(50, 500)
+                b = self.rng.randint(1, 49)
+                return [('OP', '('), ('NUMBER', str(a)), ('OP', '>'), ('NUMBER', str(b)), ('OP', ')')]
         else:
             # False case: not(X) where X is truthy
             # Single negation of a truthy value always evaluates to false
             # Use a raw integer; it will be mangled by the pipeline later
-            num = random.randint(1, 999)
-            return "not({})".format(num)
+            num = self.rng.randint(1, 999)
+            return [('IDENT', 'not'), ('OP', '('), ('NUMBER', str(num)), ('OP', ')')]
 
-    def _mangle_booleans(self, lua_code):
+    def _count(self, name, n=1):
+        """Bumps a transform counter of the running pass (reported with profile=True)."""
+        self._counts[name] = self._counts.get(name, 0) + n
+
+    def _mangle_booleans(self, tokens):
         """
         MoonVeil Logic Gate Booleans - Code Processing:
         Finds all 'true' and 'false' literals in the code and replaces them
         with logic gate expressions that evaluate to the same boolean value.
         
-        Uses word boundary matching to avoid replacing partial words like 'istrue' or 'falsehood'.
-        Also avoids replacing booleans inside strings by using a tokenizer approach.
+        Works on the token stream, so partial words like 'istrue' or 'falsehood'
+        and booleans inside strings are never touched.
         """
-        tokens = self._tokenize(lua_code)
         transformed_tokens = []
         
         for kind, val in tokens:
             # Only transform IDENT tokens that are exactly 'true' or 'false'
             # This avoids touching strings, comments, or partial matches
+            if kind == 'IDENT' and val in ('true', 'false'):
+                self._count('booleans_mangled')
             if kind == 'IDENT' and val == 'true':
                 # Replace 'true' with a logic gate expression
                 mangled = self._mangle_boolean(True)
                 # Wrap in parens for safety in complex expressions
                 transformed_tokens.append(('OP', '('))
-                # Re-tokenize the mangled expression and add it
-                mangled_tokens = self._tokenize(mangled)
-                transformed_tokens.extend(mangled_tokens)
+                transformed_tokens.extend(mangled)
                 transformed_tokens.append(('OP', ')'))
             elif kind == 'IDENT' and val == 'false':
                 # Replace 'false' with a logic gate expression
                 mangled = self._mangle_boolean(False)
                 # Wrap in parens for safety in complex expressions
                 transformed_tokens.append(('OP', '('))
-                mangled_tokens = self._tokenize(mangled)
-                transformed_tokens.extend(mangled_tokens)
+                transformed_tokens.extend(mangled)
                 transformed_tokens.append(('OP', ')'))
             else:
                 transformed_tokens.append((kind, val))
         
-        return self._reconstruct(transformed_tokens)
+        return transformed_tokens
 
     def _mangle_string(self, text):
-        """Wraps string in Ea('encrypted', 'key')"""
-        
-        # FIX: Interpret escape sequences like \n, \t into actual characters
-        # before encryption. `re` gives us raw strings like "Line1\\nLine2".
-        # We need "Line1\nLine2" for the XOR loop to encrypt the newline byte (10)
-        # instead of encrypting backslash (92) and n (110).
-        try:
-            # bytes(text, "utf-8").decode("unicode_escape") handles standard escapes
-            decoded_text = bytes(text, "utf-8").decode("unicode_escape")
-        except:
-            # Fallback if decoding fails (e.g. complex unicode), use original
-            decoded_text = text
-            
-        key = self._generate_random_string(random.randint(4, 8))
-        encrypted = self._xor_encrypt(decoded_text, key)
-        # Added spaces around the function call to prevent token merging
-        return f" {self.var_Ea}('{encrypted}','{key}') "
+        """Wraps string in Ea('encrypted', 'key') and returns the call as tokens."""
+        return self._encrypt_literals([_decode_lua_string(text)])[0]
+
+    def _encrypt_literals(self, literals):
+        """
+        Returns the replacement tokens of each decoded literal (bytes): an
+        Ea('encrypted', 'key') call, or Ka[index] in string pool mode. Keys are
+        drawn and every literal not pooled yet is encrypted in one batch.
+        In incremental mode a pooled literal is a POOLREF token until link time.
+        """
+        if self.string_pool is not None and self._symbolic:
+            # Pool indices are assigned for the whole file at link time
+            return [[('POOLREF', text)] for text in literals]
+        if self.string_pool is not None:
+            # Each distinct literal is encrypted once, however often it is used
+            pending = [text for text in dict.fromkeys(literals) if text not in self._pool_index]
+        else:
+            pending = literals
+        keys = self._generate_keys(len(pending))
+        encrypted = _xor_bulk(pending, [key.encode('ascii') for key in keys])
+
+        if self.string_pool is None:
+            return [[('IDENT', self.var_Ea), ('OP', '('), ('STRING', f"'{enc}'"),
+                     ('OP', ','), ('STRING', f"'{key}'"), ('OP', ')')]
+                    for enc, key in zip(encrypted, keys)]
+
+        for text, enc, key in zip(pending, encrypted, keys):
+            self._pool_entries.append((enc, key))
+            self._pool_index[text] = len(self._pool_entries)
+        if pending:
+            self._count('strings_pooled', len(pending))
+        return [[('IDENT', self.var_pool), ('OP', '['), ('NUMBER', str(self._pool_index[text])), ('OP', ']')]
+                for text in literals]
+
+    def _mangle_strings(self, tokens):
+        """
+        Encrypts every quoted STRING token. Long bracket strings are left as they are.
+        Escapes are decoded the way Lua reads them (decimal \\ddd, \\x, \\z, \\u{...}),
+        so the bytes Ea() returns are exactly the original literal's.
+        """
+        sites = []
+        literals = []
+        for i, (kind, val) in enumerate(tokens):
+            if kind == 'STRING' and val[0] in '"\'':
+                try:
+                    literals.append(_decode_lua_string(val[1:-1]))
+                except ValueError:
+                    continue # Lua rejects this literal itself; leave it as written
+                sites.append(i)
+        if not sites:
+            return tokens
+
+        replacements = dict(zip(sites, self._encrypt_literals(literals)))
+        self._count('strings_mangled', len(sites))
+        if self.instrument:
+            kind = 'decrypt' if self.string_pool is None else 'pool'
+            for i in sites:
+                val = tokens[i][1]
+                detail = str(val) if len(val) <= 40 else val[:37] + '...'
+                replacements[i] = self._profile_wrap(replacements[i], kind, getattr(val, 'line', None), detail)
+        transformed_tokens = []
+        for i, token in enumerate(tokens):
+            replacement = replacements.get(i)
+            if replacement is None:
+                transformed_tokens.append(token)
+            else:
+                transformed_tokens.extend(replacement)
+        return transformed_tokens
+
+    def _global_sites(self, tokens):
+        """Indices of the IDENT tokens _mangle_globals rewrites."""
+        targets = self.global_targets
+        sites = []
+        for i, (kind, val) in enumerate(tokens):
+            # Skip 'local' declarations, '.property' accesses and ':method' names
+            # ('..' concatenation is fine)
+            if (kind == 'IDENT' and val in targets and (not i or tokens[i - 1][1] != 'local')
+                    and not _is_field_name(tokens, i)):
+                sites.append(i)
+        return sites
+
+    def _count_main_chunk_locals(self, tokens):
+        """
+        Counts local names declared outside any function body. Hoisted aliases live
+        in the main chunk too, and Lua allows at most 200 active locals per function.
+        """
+        blocks = self._parse_blocks(tokens)
+        count = 0
+        i = 0
+        while i < len(tokens):
+            kind, val = tokens[i]
+            if kind == 'KEYWORD' and val == 'function' and i in blocks:
+                i = blocks[i][-1] + 1 # Skip the function body
+                continue
+            if kind == 'KEYWORD' and val == 'local':
+                count += 1
+                j = i + 2
+                while j + 1 < len(tokens) and tokens[j][1] == ',' and tokens[j + 1][0] == 'IDENT':
+                    count += 1
+                    j += 2
+            i += 1
+        return count
+
+    def _fresh_name(self, used):
+        """Random identifier that is not a Lua keyword and not in used (which it is added to)."""
+        while True:
+            name = self._generate_random_string(4)
+            if name not in used and name not in LUA_KEYWORDS:
+                used.add(name)
+                return name
+
+    def _loop_depths(self, tokens):
+        """
+        Loop nesting depth of every token: bodies (and conditions) of while/for/
+        repeat count one level each, as do functions passed to a per-frame event
+        (RenderStepped:Connect(function ...), BindToRenderStep(..., function ...)).
+        The dispatcher loops emitted by control flow flattening run each block
+        once per pass through the code they replace, so they do not count.
+        """
+        blocks = self._parse_blocks(tokens)
+        depths = [0] * len(tokens)
+        closing = {}        # End index of an open loop level -> levels it closes
+        depth = 0
+        for i, (kind, val) in enumerate(tokens):
+            depth -= closing.pop(i, 0)
+            if kind == 'KEYWORD' and i in blocks:
+                if val in ('while', 'for'):
+                    is_loop = not (val == 'while' and i + 1 < len(tokens) and tokens[i + 1][1] in self._dispatch_vars)
+                elif val == 'repeat':
+                    is_loop = True
+                elif val == 'function':
+                    is_loop = False
+                    for j in range(i - 1, max(-1, i - 9), -1):
+                        prev_kind, prev_val = tokens[j]
+                        if prev_kind in ('NL', 'KEYWORD'):
+                            break
+                        if prev_val in HOT_CALLBACK_EVENTS:
+                            is_loop = True
+                            break
+                else:
+                    is_loop = False
+                if is_loop:
+                    depth += 1
+                    end = blocks[i][-1]
+                    closing[end] = closing.get(end, 0) + 1
+            depths[i] = depth
+        return depths
+
+    def _within_budget(self, depth):
+        """Rolls whether a costly transform may be applied at the given loop depth."""
+        if self.loop_budget is None:
+            return True
+        rate = self.loop_budget[min(depth, len(self.loop_budget) - 1)]
+        return rate >= 1 or (rate > 0 and self.rng.random() < rate)
+
+    def _global_usage(self, tokens, sites):
+        """
+        Use count of every global at the given sites (in first-appearance order) and
+        the globals the script assigns to or declares with 'function name'.
+        """
+        counts = {}
+        assigned = set()
+        for i in sites:
+            name = tokens[i][1]
+            counts[name] = counts.get(name, 0) + 1
+            if self._assigns_global(tokens, i):
+                assigned.add(name)
+        return counts, assigned
+
+    def _assigns_global(self, tokens, i):
+        """True if the global at tokens[i] is assigned to ('name =') or declared ('function name')."""
+        next_val = tokens[i + 1][1] if i + 1 < len(tokens) else None
+        after_val = tokens[i + 2][1] if i + 2 < len(tokens) else None
+        return (next_val == '=' and after_val != '=') or (i > 0 and tokens[i - 1][1] == 'function')
+
+    def _choose_hoisted_globals(self, counts, assigned, main_chunk_locals, used, crowded=()):
+        """
+        Picks the globals to hoist and draws a fresh alias for each (avoiding the
+        identifiers in used). Fills self._hoisted_globals; returns {name: alias}.
+        crowded lists the functions near the upvalue limit (_crowded_functions);
+        a global that would take one of them over it is skipped.
+        """
+        limit = min(self.hoist_globals, MAX_HOISTED_GLOBALS,
+                    max(0, MAX_MAIN_CHUNK_LOCALS - main_chunk_locals))
+        room = [free for free, names in crowded]
+        holders = {} # Global -> indices of the crowded functions reading it
+        for index, (free, names) in enumerate(crowded):
+            for name in names:
+                holders.setdefault(name, []).append(index)
+        candidates = []
+        # Most used first; ties keep first-appearance order (dicts are ordered)
+        for name in sorted((name for name in counts if name not in assigned), key=lambda name: -counts[name]):
+            if len(candidates) == limit:
+                break
+            functions = holders.get(name, ())
+            if any(room[index] == 0 for index in functions):
+                continue
+            for index in functions:
+                room[index] -= 1
+            candidates.append(name)
+
+        used = set(used)
+        used.update((self.var_Ma, self.var_Ea, self.var_Ta, self.var_results, self.var_capture, self.var_string_char, self.var_string_byte,
+                     self.var_bit_xor, self.var_table_concat, self.var_pool, self.var_pool_data))
+        aliases = {}
+        for name in candidates:
+            alias = self._fresh_name(used)
+            aliases[name] = alias
+            self._hoisted_globals.append((alias, [('IDENT', self.var_Ma), ('OP', '['),
+                                                  *self._mangle_string(name), ('OP', ']')]))
+        return aliases
+
+    def _crowded_functions(self, tokens):
+        """
+        The functions that could go over MAX_UPVALUES if every global they read
+        were hoisted, as (room, globals) pairs: room is how many aliases the
+        function can still capture, globals the hoisting candidates it reads.
+        A function captures every outer local it or a nested function uses,
+        plus the header locals mangled globals and strings read (Ma, Ea, Ka, Pk).
+
+        Names are resolved by _scope_events. Each open function collects the
+        outer declarations and globals used in it; when it ends, its own
+        declarations are dropped and the smaller of its set and its parent's is
+        merged into the larger, so deep nesting costs O(n log n), not a rescan
+        per level.
+        """
+        targets = self.global_targets
+        reserved = (self.var_Ma, self.var_Ea, self.var_pool, self.var_profile)
+        functions = []  # [end index, names used, globals read, own declaration ids] per open function
+        crowded = []
+        for event in self._scope_events(tokens):
+            if event[0] == 'use':
+                if functions:
+                    name, ident = event[1], event[2]
+                    functions[-1][1].add(name if ident is None else ident)
+                    if ident is None and name in targets:
+                        functions[-1][2].add(name)
+            elif event[0] == 'declare':
+                if functions:
+                    functions[-1][3].append(event[2])
+            elif event[0] == 'function':
+                functions.append([event[1], set(), set(), []])
+            else:
+                self._close_function_upvalues(functions, targets, reserved, crowded)
+        return crowded
+
+    def _close_function_upvalues(self, functions, targets, reserved, crowded):
+        """Ends the innermost open function of _crowded_functions: records it if crowded, merges it into its parent."""
+        end, used, globals_read, own = functions.pop()
+        used.difference_update(own)
+        others = len(used) - len(globals_read) + sum(1 for name in reserved if name not in used)
+        room = MAX_UPVALUES - others
+        if len(globals_read) > room:
+            crowded.append((max(0, room), frozenset(globals_read)))
+        if functions:
+            parent = functions[-1]
+            if len(parent[1]) < len(used):
+                parent[1], used = used, parent[1]
+            parent[1].update(used)
+            if len(parent[2]) < len(globals_read):
+                parent[2], globals_read = globals_read, parent[2]
+            parent[2].update(globals_read)
 
-    def _mangle_globals(self, lua_code):
+    def _mangle_globals(self, tokens):
         """
         Replaces global function calls with Ma[Ea('print')]...
+
+        Single pass: every IDENT token is looked up once in the target frozenset,
+        so the cost no longer grows with the number of targets.
+
+        With hoist_globals, the most used globals are instead resolved once into
+        locals at the top of the chunk (local Ab=Ma[Ea('print')]) and every use
+        site becomes a plain local access. Globals the script assigns to or
+        declares with 'function name' keep the Ma[...] form, and so do globals
+        that would take a function over Lua 5.1's upvalue limit.
+
+        In a profile build every other Ma[...] read is wrapped in Pk(id, ...).
+
+        In incremental mode hoisting is decided for the whole file at link time,
+        so every site becomes a GLOBALREF token carrying its Ma[...] form.
         """
-        targets = [
-            "print", "warn", "error", "game", "workspace", "math", "table", "string", 
-            "task", "wait", "spawn", "getfenv", "setfenv", "pcall", "xpcall", 
-            "pairs", "ipairs", "next", "type", "tostring", "tonumber", "select", 
-            "unpack", "require", "Drawing", "Vector2", "Vector3", "CFrame", 
-            "Color3", "UDim2", "Instance", "Enum", "RaycastParams", "Random", 
-            "utf8", "os", "coroutine", "debug", "tick", "time", "delay", "defer",
-            "getgenv", "getrenv", "identifyexecutor", "setclipboard", "readfile", 
-            "writefile", "isfile", "delfile", "listfiles", "makefolder", "delfolder",
-            "iskeypressed", "mouse1click", "ismouse1pressed", "mouse2click", "ismouse2pressed",
-            "getscripthash", "isrbxactive", "keyrelease", "keypress", "mouse1press",
-            "mouse1release", "mouse2press", "mouse2release", "mousemoveabs", "mousemoverel",
-            "mousescroll", "run_secure", "setfflag", "getfflag", "loadstring", "decompile"
-        ]
-        
-        targets.sort(key=len, reverse=True)
+        sites = self._global_sites(tokens)
+        aliases = {}
 
-        for target in targets:
-            # Lookbehind to ensure not a property, Group 1 for local check, Group 2 for word
-            pattern = r'(?<!\.)(\blocal\s+)?\b(' + re.escape(target) + r')\b'
-            
-            def replace_match(match):
-                prefix = match.group(1) # 'local ' or None
-                word = match.group(2)   # The target global name
-                if prefix:
-                    return f"{prefix}{word}"
-                # Added spaces here as well for safety, though \b usually protects globals.
-                return f"{self.var_Ma}[{self._mangle_string(word)}]"
-            
-            lua_code = re.sub(pattern, replace_match, lua_code)
-            
-        return lua_code
+        if not self._symbolic:
+            self._hoisted_globals = []
+            if self.hoist_globals and sites:
+                counts, assigned = self._global_usage(tokens, sites)
+                used = {val for kind, val in tokens if kind == 'IDENT'}
+                aliases = self._choose_hoisted_globals(counts, assigned, self._count_main_chunk_locals(tokens), used,
+                                                       self._crowded_functions(tokens))
+            self._count('globals_hoisted', len(aliases))
+
+        self._count('globals_mangled', len(sites))
+        transformed_tokens = []
+        site_iter = iter(sites)
+        next_site = next(site_iter, None)
+        for i, token in enumerate(tokens):
+            if i != next_site:
+                transformed_tokens.append(token)
+                continue
+            next_site = next(site_iter, None)
+            alias = aliases.get(token[1])
+            if alias is not None:
+                transformed_tokens.append(('IDENT', alias))
+                continue
+            lookup = [('IDENT', self.var_Ma), ('OP', '['), *self._mangle_string(token[1]), ('OP', ']')]
+            if self._symbolic:
+                transformed_tokens.append(('GLOBALREF', (token[1], tuple(lookup))))
+            elif self.instrument and not self._assigns_global(tokens, i):
+                # Profile build: count the lookups of every use site
+                transformed_tokens.extend(self._profile_wrap(lookup, 'global', getattr(token[1], 'line', None), str(token[1])))
+            else:
+                transformed_tokens.extend(lookup)
+
+        return transformed_tokens
+
+    def _generate_hoisted_globals(self):
+        """Emits the local aliases chosen by _mangle_globals (hoist_globals mode only)."""
+        return "".join(f"local {alias}={self._reconstruct(value)}\n" for alias, value in self._hoisted_globals)
 
     # =========================================================================
     # OPAQUE PREDICATE & LOGIC INVERSION SYSTEM (Strategies A & B)
@@ -196,224 +1398,507 @@ class WabiSabiObfuscator:
         """
         Generates garbage Lua code that is syntactically valid but does nothing useful.
         REMOVED wait() to prevent UI throttling.
+
+        Returns tokens, rendered from the pre-lexed JUNK_TEMPLATES. With
+        shared_junk the block is a call to a library routine instead: Ja[n]().
         """
+        if self._junk_handles:
+            handle = self._junk_handles[self.rng.randrange(len(self._junk_handles))]
+            self._count('library_calls')
+            return LIBRARY_JUNK_CALL.render(library=self.var_junk, handle=handle)
+        return self._inline_junk_code()
+
+    def _inline_junk_code(self):
+        """A fresh junk snippet (_generate_junk_code without the library)."""
         var_name = self._generate_random_string(4)
         var_name_2 = self._generate_random_string(4)
         
-        junk_types = [
-            # Type 1: Useless Math Loop (NO WAIT)
-            f"local {var_name} = 0; for i=1, {random.randint(2, 5)} do {var_name}={var_name}+1; end",
-            # Type 2: Table Junk
-            f"local {var_name} = {{}}; {var_name}[1] = {random.randint(1,99)};",
-            # Type 3: Simple math
-            f"local {var_name} = {random.randint(10,999)} * {random.randint(2,9)};",
-            # Type 4: Double variable junk
-            f"local {var_name} = 1; local {var_name_2} = 2; {var_name} = {var_name} + {var_name_2};"
+        # Draw every template's numbers, so the random sequence does not depend on the pick
+        values = [
+            {'n': self.rng.randint(2, 5)},
+            {'n': self.rng.randint(1, 99)},
+            {'n': self.rng.randint(10, 999), 'm': self.rng.randint(2, 9)},
+            {'b': var_name_2},
         ]
-        return random.choice(junk_types)
+        index = self.rng.randrange(len(JUNK_TEMPLATES))
+        return JUNK_TEMPLATES[index].render(a=var_name, **values[index])
 
     def _generate_opaque_predicate(self):
         """
         Generates a Contextual Opaque Predicate (Strategy B).
-        Returns a tuple: (Condition String, Boolean Value)
-        Example: ('(5 * 5 >= 0)', True)
+        Returns a tuple: (Condition tokens, Boolean Value)
+        Example: (tokens of '(5 * 5 >= 0)', True)
+
+        With shared_junk the condition calls a library predicate instead:
+        Ja[n](a, b), a and b being fresh positive numbers.
         """
+        if self._predicate_handles:
+            handle, value = self._predicate_handles[self.rng.randrange(len(self._predicate_handles))]
+            self._count('library_calls')
+            call = LIBRARY_PREDICATE_CALL.render(library=self.var_junk, handle=handle,
+                                                 a=self.rng.randint(10, 500), b=self.rng.randint(10, 500))
+            return call, value
         
         # Strategy: Math Tautologies
         # We use raw numbers here; they will be mangled later by _mangle_number in the main pipeline.
         
-        val_a = random.randint(10, 500)
-        val_b = random.randint(10, 500)
-        
-        predicates = [
-            # Square is always >= 0
-            (f"( ({val_a} * {val_a}) >= 0 )", True),
-            # Absolute value check
-            # REMOVED: Strict equality check (==) which is dangerous with floats
-            # REPLACED WITH: Inequality check which is safer
-            (f"( math.abs({-val_a}) >= 0 )", True),
-            # Impossible check
-            (f"( {val_a} < {-val_a} )", False),
-            # Simple inequality - Changed from strict equality
-            (f"( {val_a} + {val_b} >= {val_a} )", True)
-        ]
+        val_a = self.rng.randint(10, 500)
+        val_b = self.rng.randint(10, 500)
         
-        return random.choice(predicates)
+        template, value = PREDICATE_TEMPLATES[self.rng.randrange(len(PREDICATE_TEMPLATES))]
+        return template.render(a=val_a, b=val_b), value
+
+    def _build_junk_library(self, rng):
+        """
+        Draws the shared junk/predicate library of shared_junk mode from rng:
+        half junk routines, half predicate functions (each one of the
+        PREDICATE_TEMPLATES over its two parameters), in shuffled handle order.
+        Incremental mode passes an RNG of its own so every cached chunk keeps
+        calling the same library.
+        """
+        self._junk_library, self._junk_handles, self._predicate_handles = [], [], []
+        if not self.shared_junk:
+            return
+        saved_rng = self.rng
+        self.rng = rng
+        try:
+            kinds = ['junk'] * (self.shared_junk - self.shared_junk // 2) + ['predicate'] * (self.shared_junk // 2)
+            rng.shuffle(kinds)
+            for handle, kind in enumerate(kinds, 1):
+                if kind == 'junk':
+                    self._junk_library.append(LIBRARY_JUNK.render(body=self._inline_junk_code()))
+                    self._junk_handles.append(handle)
+                else:
+                    template, value = PREDICATE_TEMPLATES[rng.randrange(len(PREDICATE_TEMPLATES))]
+                    a, b = self._generate_random_string(4), self._generate_random_string(4)
+                    self._junk_library.append(LIBRARY_PREDICATE.render(a=a, b=b, test=template.render(a=a, b=b)))
+                    self._predicate_handles.append((handle, value))
+        finally:
+            self.rng = saved_rng
+
+    def _prepend_junk_library(self, tokens):
+        """
+        Declares the shared library ahead of the dispatcher, where the passes
+        that follow (booleans, numbers, strings, globals) obfuscate its routines
+        like any other code: local Ja = {function() ... end, function(a, b) ... end}
+        """
+        if not self._junk_library:
+            return tokens
+        self._count('library_routines', len(self._junk_library))
+        routines = []
+        for routine in self._junk_library:
+            if routines:
+                routines.append(('OP', ','))
+            routines.extend(routine)
+        return LIBRARY_INIT.render(library=self.var_junk, routines=routines) + [NL_TOKEN] + tokens
 
     def _tokenize(self, code):
         """
         Splits code into a list of (type, value) tokens for safe AST traversal.
         Does NOT simplify logic.
+
+        This is the shared intermediate representation of the pipeline: every pass
+        reads and returns a token list. Comments are dropped here and line breaks
+        are kept as NL tokens so statement-level passes can still see lines.
+        Lexing is done by the shared, compiled-once LEXER; equal tokens (except
+        strings) are one shared tuple. The offset-only TokenSpans form is for
+        the stream splitter, not for the passes.
         """
-        token_specification = [
-            ('COMMENT', r'--\[\[.*?\]\]|--[^\n]*'), # Matches --[[...]] or --...
-            ('STRING',  r'("([^"\\]|\\.)*")|(\'([^\'\\]|\\.)*\')|(\[\[.*?\]\])'), # Strings
-            ('KEYWORD', r'\b(if|then|else|elseif|end|do|function|repeat|until|while|for|local)\b'), # Keywords for blocking
-            ('IDENT',   r'[A-Za-z_][A-Za-z0-9_]*'),    # Identifiers
-            ('OP',      r'[+\-*/%^#=~<>()\[\]{},;.]'), # Operators
-            # UPDATED: Matches Hex (0x...), Scientific (1e10), and Standard Numbers.
-            # Prevents splitting "1e10" into "1", "e", "10" which causes syntax errors in reconstruction.
-            ('NUMBER',  r'0[xX][0-9a-fA-F]+(?:(?:\.[0-9a-fA-F]*)?(?:[pP][+-]?\d+)?)?|\b\d+(?:\.\d*)?(?:[eE][+-]?\d+)?\b'), 
-            ('WS',      r'\s+'),                       # Whitespace
-            ('MISC',    r'.'),                         # Any other char
-        ]
-        tok_regex = '|'.join('(?P<%s>%s)' % pair for pair in token_specification)
-        tokens = []
-        for mo in re.finditer(tok_regex, code, re.DOTALL | re.MULTILINE):
-            kind = mo.lastgroup
-            value = mo.group()
-            if kind == 'WS': continue 
-            tokens.append((kind, value))
-        return tokens
+        return LEXER.tokenize(code)
+
+    def _needs_space(self, prev, token):
+        """True if two adjacent tokens would merge into something else when joined."""
+        prev_kind, prev_val = prev
+        kind, val = token
+        if prev_kind in WORD_KINDS and kind in WORD_KINDS:
+            return True
+        if prev_val == '-' and val[0] == '-':
+            return True # '- -x' must not become a '--' comment
+        if prev_val == '[' and val[0] == '[':
+            return True # '[ [' must not open a long bracket
+        if val[0] == '.' and (prev_kind == 'NUMBER' or (kind == 'NUMBER' and prev_val == '.')):
+            return True # '1 ..' and '.. .5' must not lex as malformed numbers
+        return False
 
     def _reconstruct(self, tokens):
         """Rebuilds string from tokens (simple concatenation with spacing safety)."""
         # A simple join is often enough if we kept whitespace, but we stripped it.
         # We need to insert spaces between keywords/idents.
         out = []
-        for i, (kind, val) in enumerate(tokens):
-            if i > 0:
-                prev_kind = tokens[i-1][0]
-                # Add space if needed
-                if (prev_kind in ['KEYWORD', 'IDENT', 'NUMBER'] and kind in ['KEYWORD', 'IDENT', 'NUMBER']):
+        prev = None
+        for token in tokens:
+            if token[0] == 'NL':
+                out.append('\n')
+            else:
+                if prev is not None and prev[0] != 'NL' and self._needs_space(prev, token):
                     out.append(' ')
-            out.append(val)
+                out.append(token[1])
+            prev = token
         return "".join(out)
 
-    def _process_logic_inversion(self, lua_code):
+    def _parse_blocks(self, tokens):
         """
-        AST Traversal & Logic Inversion (Strategy A).
-        Finds 'if A then B end' and converts to 'if not (A) then JUNK else B end'.
-        This plays it safe: only inverts simple if-blocks with no else/elseif to avoid breaking logic.
+        Block-structure parser: matches every block opener with its keywords in
+        one O(n) pass. Returns {opener index: [marker indices]}:
+        - if:             then, (elseif, then)*, else?, end
+        - while / for:    do, end
+        - function / do:  end
+        - repeat:         until
+        Blocks that are never closed (malformed input) are left out.
         """
-        tokens = self._tokenize(lua_code)
-        
-        # We will rebuild the code token by token.
-        # When we hit an 'if', we try to scan ahead to see if it's a candidate for inversion.
-        
-        transformed_tokens = []
+        blocks = {}
+        stack = [] # (opener index, keyword, markers)
+        for i, (kind, val) in enumerate(tokens):
+            if kind != 'KEYWORD':
+                continue
+            if val in ('if', 'while', 'for', 'function', 'repeat'):
+                stack.append((i, val, []))
+            elif val == 'do':
+                if stack and stack[-1][1] in ('while', 'for') and not stack[-1][2]:
+                    stack[-1][2].append(i) # 'do' of a while/for header
+                else:
+                    stack.append((i, 'do', []))
+            elif val in ('then', 'elseif', 'else'):
+                if stack and stack[-1][1] == 'if':
+                    stack[-1][2].append(i)
+            elif val == 'end':
+                if stack and stack[-1][1] != 'repeat':
+                    opener, _, markers = stack.pop()
+                    markers.append(i)
+                    blocks[opener] = markers
+            elif val == 'until':
+                if stack and stack[-1][1] == 'repeat':
+                    opener, _, markers = stack.pop()
+                    markers.append(i)
+                    blocks[opener] = markers
+        return blocks
+
+    def _scope_events(self, tokens, parameters=()):
+        """
+        Resolves every name in tokens to its declaration in one pass, for the
+        passes that need to know what a function captures. Yields:
+        - ('declare', name, id):  a local, parameter or loop variable comes into scope
+        - ('use', name, id):      a variable is read or written; id None for a free name
+        - ('function', end):      a function body starts (at its parameter list)
+        - ('end', index):         the innermost started function ends at tokens[index]
+        Declarations are tracked per block; the names of a 'local' statement
+        count from the next statement keyword on, so 'local x = x' still uses
+        the outer x. parameters are declared up front (tokens is a function body).
+        """
+        blocks = self._parse_blocks(tokens)
+        declared = {}   # Name -> declaration ids in scope, innermost last
+        scopes = [[]]   # Names declared per open block
+        ends = []       # End index per started function
+        pending = None     # (scope depth, names) of a 'local' statement not yet in scope
+        loop_names = None  # (scope depth, names) of a for header, in scope from its 'do'
+        opening = None     # The 'function' whose parameter list is next
+        method = in_parameters = False
+        next_id = 0
+
+        def declare(names):
+            nonlocal next_id
+            for name in names:
+                declared.setdefault(name, []).append(next_id)
+                scopes[-1].append(name)
+                yield ('declare', name, next_id)
+                next_id += 1
+
+        def close_scope():
+            if len(scopes) > 1:
+                for name in scopes.pop():
+                    declared[name].pop()
+
+        yield from declare(parameters)
         i = 0
         while i < len(tokens):
-            token = tokens[i]
-            
-            # Look for 'if'
-            if token[0] == 'KEYWORD' and token[1] == 'if':
-                
-                # Check scanning ahead
-                # We need to find 'then', capture condition, then find 'end' ensuring balanced nesting.
-                # If we encounter 'else' or 'elseif' at the current depth, we ABORT inversion for this block.
-                
-                scan_i = i + 1
-                condition_tokens = []
-                
-                # Scan Condition
-                while scan_i < len(tokens) and tokens[scan_i][1] != 'then':
-                    condition_tokens.append(tokens[scan_i])
-                    scan_i += 1
-                
-                if scan_i < len(tokens) and tokens[scan_i][1] == 'then':
-                    # Found 'then', consume it
-                    scan_i += 1 
-                    
-                    # Scan Body
-                    body_tokens = []
-                    depth = 1 # We are inside the 'if'
-                    
-                    valid_candidate = True
-                    
-                    body_start_index = scan_i
-                    
-                    while scan_i < len(tokens):
-                        t_kind, t_val = tokens[scan_i]
-                        
-                        if t_val == 'if' or t_val == 'do' or t_val == 'function' or t_val == 'repeat':
-                            depth += 1
-                        elif t_val == 'end' or t_val == 'until':
-                            depth -= 1
-                        elif (t_val == 'else' or t_val == 'elseif') and depth == 1:
-                            # Found an else/elseif at the same level! Logic Inversion is unsafe/complex here.
-                            valid_candidate = False
-                            break
-                        
-                        if depth == 0:
-                            # Found the closing 'end'
+            kind, val = tokens[i]
+            if pending is not None and pending[0] == len(scopes) and (
+                    val in ('return', 'break', ';') or
+                    (kind == 'KEYWORD' and val in ('local', 'if', 'for', 'while', 'do', 'repeat'))):
+                yield from declare(pending[1])
+                pending = None
+            if kind == 'KEYWORD':
+                if val == 'local' and i + 2 < len(tokens) and tokens[i + 1] == ('KEYWORD', 'function'):
+                    yield from declare([tokens[i + 2][1]]) # Visible in its own body
+                elif val in ('local', 'for'):
+                    names = []
+                    j = i + 1
+                    while j < len(tokens) and tokens[j][0] == 'IDENT' and tokens[j][1] != 'in':
+                        names.append(tokens[j][1])
+                        j += 1
+                        if j < len(tokens) and tokens[j][1] == '<':
+                            j += 3 # Lua 5.4 attribute: <const>, <close>
+                        if j < len(tokens) and tokens[j][1] == ',':
+                            j += 1
+                        else:
                             break
-                            
-                        body_tokens.append(tokens[scan_i])
-                        scan_i += 1
-                    
-                    if valid_candidate and depth == 0:
-                        # We successfully identified a simple if..then..end block.
-                        # APPLY STRATEGY A: LOGIC INVERSION
-                        # Structure: if not (CONDITION) then JUNK else BODY end
-                        
-                        junk_code_str = self._generate_junk_code()
-                        # Tokenize junk code to add it to stream
-                        junk_tokens = self._tokenize(junk_code_str)
-                        
-                        transformed_tokens.append(('KEYWORD', 'if'))
-                        transformed_tokens.append(('KEYWORD', 'not'))
-                        transformed_tokens.append(('OP', '('))
-                        transformed_tokens.extend(condition_tokens)
-                        transformed_tokens.append(('OP', ')'))
-                        transformed_tokens.append(('KEYWORD', 'then'))
-                        transformed_tokens.extend(junk_tokens)
-                        transformed_tokens.append(('KEYWORD', 'else'))
-                        transformed_tokens.extend(body_tokens)
-                        transformed_tokens.append(('KEYWORD', 'end'))
-                        
-                        i = scan_i + 1 # Skip past the consumed tokens (including 'end')
-                        continue
-
-            # If not transformed, append original
-            transformed_tokens.append(token)
+                    if val == 'local':
+                        pending = (len(scopes), names)
+                    else:
+                        loop_names = (len(scopes), names)
+                    i = j
+                    continue
+                elif val == 'function':
+                    scopes.append([])
+                    opening = i
+                    method = False
+                elif val in ('do', 'then', 'repeat'):
+                    depth = len(scopes)
+                    scopes.append([])
+                    if val == 'do' and loop_names is not None and loop_names[0] == depth:
+                        yield from declare(loop_names[1])
+                        loop_names = None
+                elif val in ('else', 'elseif', 'end', 'until'):
+                    close_scope()
+                    if val == 'else':
+                        scopes.append([])
+                    if pending is not None and pending[0] > len(scopes):
+                        pending = None
+                    if ends and ends[-1] == i:
+                        ends.pop()
+                        yield ('end', i)
+            elif kind == 'OP':
+                if opening is not None and val == ':':
+                    method = True
+                elif opening is not None and val == '(':
+                    # The function starts at its parameters: 'function M.f' uses M outside it
+                    if opening in blocks:
+                        ends.append(blocks[opening][-1])
+                        yield ('function', ends[-1])
+                    opening = None
+                    in_parameters = True
+                    if method:
+                        yield from declare(['self'])
+                elif in_parameters and val == ')':
+                    in_parameters = False
+            elif kind == 'IDENT':
+                if in_parameters:
+                    yield from declare([val])
+                elif val not in LUA_KEYWORDS and not _is_field_name(tokens, i):
+                    ids = declared.get(val)
+                    yield ('use', val, ids[-1] if ids else None)
             i += 1
-            
-        return self._reconstruct(transformed_tokens)
 
-    def _inject_contextual_predicates(self, lua_code):
+    def _is_if_chain(self, tokens, markers):
+        """Checks that if-markers read then, (elseif, then)*, else?, end."""
+        if len(markers) < 2 or tokens[markers[0]][1] != 'then' or tokens[markers[-1]][1] != 'end':
+            return False
+        i = 1
+        while tokens[markers[i]][1] == 'elseif':
+            if i + 1 >= len(markers) or tokens[markers[i + 1]][1] != 'then':
+                return False
+            i += 2
+        if tokens[markers[i]][1] == 'else':
+            i += 1
+        return i == len(markers) - 1
+
+    def _process_logic_inversion(self, tokens):
         """
-        Strategy B: Wraps arbitrary valid statements in Opaque Predicates.
-        if (TrueMath) then [Original] else [Junk] end
+        AST Traversal & Logic Inversion (Strategy A).
+        Finds 'if A then B end' and converts to 'if not (A) then JUNK else B end'.
+
+        The block structure is parsed once (_parse_blocks) and the inversion is
+        applied at every nesting level, in linear time:
+        - if A then B end               -> if not (A) then JUNK else B end
+        - if A then B else C end        -> if not (A) then C else B end
+        - if A then B elseif ... end    -> if not (A) then (if ... end) else B end,
+          where the rest of the chain is itself a candidate for inversion.
+        With a loop budget, blocks inside loops are inverted less often (or never).
         """
-        lines = lua_code.split('\n')
-        out_lines = []
-        
-        for line in lines:
-            stripped = line.strip()
+        depths = self._loop_depths(tokens) if self.loop_budget is not None else None
+        blocks = self._parse_blocks(tokens)
+        transformed_tokens = []
+        self._emit_inverted_range(tokens, blocks, depths, 0, len(tokens), transformed_tokens, 0)
+        return transformed_tokens
+
+    def _emit_inverted_range(self, tokens, blocks, depths, start, stop, out, nesting):
+        """Copies tokens[start:stop] to out, inverting every complete if-statement in it."""
+        i = start
+        while i < stop:
+            token = tokens[i]
+            markers = blocks.get(i) if token[1] == 'if' else None
+            if markers is not None and markers[-1] < stop and self._is_if_chain(tokens, markers):
+                self._emit_if(tokens, blocks, depths, i, markers, out, nesting)
+                i = markers[-1] + 1
+            else:
+                out.append(token)
+                i += 1
+
+    def _emit_if_plain(self, tokens, blocks, depths, start, markers, out, nesting):
+        """Emits an if-statement unchanged, but still inverts the ifs nested in it."""
+        out.append(('KEYWORD', 'if'))
+        prev = start
+        for marker in markers:
+            self._emit_inverted_range(tokens, blocks, depths, prev + 1, marker, out, nesting + 1)
+            out.append(tokens[marker])
+            prev = marker
+
+    def _emit_if(self, tokens, blocks, depths, start, markers, out, nesting, chain=0):
+        """
+        Emits the if-statement starting at tokens[start] ('if', or an 'elseif' that
+        begins the rest of a chain) whose markers are given, inverted if allowed.
+        chain counts the elseifs already turned into nested ifs on this path.
+        """
+        if nesting > MAX_INVERSION_NESTING:
+            # Far deeper than valid Lua allows; copy verbatim rather than recurse
+            out.append(('KEYWORD', 'if'))
+            out.extend(tokens[start + 1:markers[-1] + 1])
+            return
+
+        then_i, next_i = markers[0], markers[1]
+        if depths is not None and not self._within_budget(depths[start]):
+            self._emit_if_plain(tokens, blocks, depths, start, markers, out, nesting)
+            return
+
+        # APPLY STRATEGY A: LOGIC INVERSION
+        self._count('ifs_inverted')
+        out.append(('KEYWORD', 'if'))
+        out.append(('KEYWORD', 'not'))
+        out.append(('OP', '('))
+        self._emit_inverted_range(tokens, blocks, depths, start + 1, then_i, out, nesting + 1)
+        out.append(('OP', ')'))
+        out.append(('KEYWORD', 'then'))
+
+        next_kw = tokens[next_i][1]
+        if next_kw == 'end':
+            # if not (CONDITION) then JUNK else BODY end
+            junk_tokens = self._generate_junk_code()
+            if self.instrument:
+                junk_tokens = self._profile_count('junk', self._source_line(tokens, start), 'inverted if') + junk_tokens
+            out.extend(junk_tokens)
+        elif next_kw == 'else':
+            # if not (CONDITION) then ELSE_BODY else BODY end
+            self._emit_inverted_range(tokens, blocks, depths, next_i + 1, markers[-1], out, nesting + 1)
+        elif chain < MAX_ELSEIF_NESTING:
+            # if not (CONDITION) then <rest of the chain as its own if> else BODY end
+            self._emit_if(tokens, blocks, depths, next_i, markers[2:], out, nesting + 1, chain + 1)
+        else:
+            # Every converted elseif adds a nesting level; keep the rest of a long chain flat
+            self._emit_if_plain(tokens, blocks, depths, next_i, markers[2:], out, nesting + 1)
+
+        out.append(('KEYWORD', 'else'))
+        self._emit_inverted_range(tokens, blocks, depths, then_i + 1, next_i, out, nesting + 1)
+        out.append(('KEYWORD', 'end'))
+
+    def _split_lines(self, tokens):
+        """Groups a token stream into lines (lists of tokens), splitting on NL tokens."""
+        lines = [[]]
+        for token in tokens:
+            if token[0] == 'NL':
+                lines.append([])
+            else:
+                lines[-1].append(token)
+        return lines
+
+    def _is_simple_statement(self, line, prev_line, next_line):
+        """
+        Checks that a line is one complete assignment or void call that is safe to
+        move inside an if-block: no keywords (so no block openers and no 'local',
+        whose scope would end with the wrapper), balanced brackets, and nothing on
+        the neighbouring lines that could continue the expression.
+        """
+        if not line or line[0][0] != 'IDENT' or line[0][1] in NON_NAME_WORDS:
+            return False
+
+        # Name ( ('.' | ':') Name )* followed by '=' or '('
+        i = 1
+        while i + 1 < len(line) and line[i][1] in ('.', ':') and line[i + 1][0] == 'IDENT':
+            i += 2
+        if i >= len(line):
+            return False
+        is_assignment = line[i][1] == '=' and (i + 1 >= len(line) or line[i + 1][1] != '=')
+        is_void_call = line[i][1] == '(' and line[-1][1] == ')'
+        if not (is_assignment or is_void_call):
+            return False
+
+        depth = 0
+        for kind, val in line:
+            if kind == 'KEYWORD':
+                return False
+            if val in ('(', '[', '{'):
+                depth += 1
+            elif val in (')', ']', '}'):
+                depth -= 1
+                if depth < 0:
+                    return False
+        if depth != 0:
+            return False
+
+        last_kind, last_val = line[-1]
+        if (last_kind == 'OP' and last_val not in (')', ']', '}')) or last_val in ('and', 'or', 'not'):
+            return False # The expression continues on the next line
+        if prev_line:
+            prev_kind, prev_val = prev_line[-1]
+            if (prev_kind == 'OP' and prev_val not in (')', ']', '}', ';')) or prev_val in CONTINUATION_WORDS:
+                return False # This line continues the previous one
+        if next_line:
+            next_kind, next_val = next_line[0]
+            if next_kind not in ('IDENT', 'KEYWORD') or next_val in ('and', 'or'):
+                return False # The next line continues this one
+        return True
+
+    def _inject_contextual_predicates(self, tokens):
+        """
+        Strategy B: Wraps arbitrary valid statements in Opaque Predicates.
+        if (TrueMath) then [Original] else [Junk] end
+        """
+        lines = self._split_lines(tokens)
+        transformed_tokens = []
+
+        # Loop depth of each line (its first token), for the loop budget
+        line_depths = []
+        if self.loop_budget is not None:
+            depths = self._loop_depths(tokens)
+            pos = 0
+            for line in lines:
+                line_depths.append(depths[pos] if pos < len(depths) else 0)
+                pos += len(line) + 1
+        
+        for idx, line in enumerate(lines):
+            if idx > 0:
+                transformed_tokens.append(('NL', '\n'))
             # Safety check: Only wrap lines that look like complete statements (variable assignments, function calls)
             # Avoid wrapping 'end', 'else', or start of blocks if not careful.
             # Best to target variable assignments or void function calls.
+            prev_line = lines[idx - 1] if idx > 0 else None
+            next_line = lines[idx + 1] if idx + 1 < len(lines) else None
             
-            is_assignment = re.match(r'^(local\s+)?[a-zA-Z_0-9.]+\s*=[^=]', stripped)
-            is_void_call = re.match(r'^[a-zA-Z_0-9.:]+\(.*\)$', stripped)
-            
-            if (is_assignment or is_void_call) and not stripped.endswith('do') and not stripped.endswith('then'):
+            if self._is_simple_statement(line, prev_line, next_line):
                 # 30% chance to wrap in opaque predicate
-                if random.random() < 0.3:
-                    pred_str, is_true = self._generate_opaque_predicate()
-                    junk = self._generate_junk_code()
+                if self.rng.random() < 0.3 and self._within_budget(line_depths[idx] if line_depths else 0):
+                    self._count('predicates_injected')
+                    pred_tokens, is_true = self._generate_opaque_predicate()
+                    junk_tokens = self._generate_junk_code()
+                    if self.instrument:
+                        line_number = self._source_line(line)
+                        pred_tokens = self._profile_wrap(pred_tokens, 'predicate', line_number,
+                                                         self._reconstruct(pred_tokens))
+                        junk_tokens = self._profile_count('junk', line_number, 'predicate') + junk_tokens
                     
+                    transformed_tokens.append(('KEYWORD', 'if'))
+                    transformed_tokens.extend(pred_tokens)
+                    transformed_tokens.append(('KEYWORD', 'then'))
                     if is_true:
                         # if (True) then Real else Junk
-                        new_block = f"if {pred_str} then {line} else {junk} end"
-                        out_lines.append(new_block)
+                        transformed_tokens.extend(line)
+                        transformed_tokens.append(('KEYWORD', 'else'))
+                        transformed_tokens.extend(junk_tokens)
                     else:
                         # if (False) then Junk else Real
-                        new_block = f"if {pred_str} then {junk} else {line} end"
-                        out_lines.append(new_block)
-                else:
-                    out_lines.append(line)
-            else:
-                out_lines.append(line)
+                        transformed_tokens.extend(junk_tokens)
+                        transformed_tokens.append(('KEYWORD', 'else'))
+                        transformed_tokens.extend(line)
+                    transformed_tokens.append(('KEYWORD', 'end'))
+                    continue
+            transformed_tokens.extend(line)
                 
-        return "\n".join(out_lines)
+        return transformed_tokens
 
     # =========================================================================
     # CONTROL FLOW FLATTENING (The "Maze")
     # =========================================================================
 
-    def _apply_control_flow_flattening(self, lua_code):
+    def _apply_control_flow_flattening(self, tokens):
         """
         Applies MoonVeil-Style Control Flow Flattening (CFF).
         
@@ -424,14 +1909,20 @@ class WabiSabiObfuscator:
         2.  **State Machine**: Wraps blocks in a 'while state != 0 do' loop.
         
         3.  **Arithmetic Transitions**: Uses 'state = state + delta' instead of 'state = X'.
+
+        cff_dispatch selects the dispatcher: 'ladder' tests the state against each
+        block in an if/elseif chain, 'table' looks the block closure up in Ta in
+        constant time. cff_yield=False drops the wait() after every step.
+
+        In table mode the real block runs inside a closure, so its top-level
+        'return's are routed through Rb (see _route_main_returns) and the chunk
+        returns their values once the loop has exited.
         """
         
         # NOTE: A full robust AST parser is needed for perfect CFF on complex nested structures.
         # We will implement a simplified version that targets sequential blocks of code 
         # to demonstrate the technique without breaking the complex nested logic of the input script.
         # We will wrap the MAIN execution flow into a flattened dispatcher.
-
-        tokens = self._tokenize(lua_code)
         
         # We'll identify "chunks". A chunk is separated by logical boundaries.
         # For simplicity in this regex-based/token-based approach:
@@ -448,72 +1939,643 @@ class WabiSabiObfuscator:
         
         # Let's build the "Maze" wrapper.
         
-        real_block_id = random.randint(10000, 99999)
+        real_block_id = self.rng.randint(10000, 99999)
         exit_block_id = 0
         
         # Generate some fake blocks
         fake_blocks = []
         for _ in range(3):
-            fake_id = random.randint(10000, 99999)
-            while fake_id == real_block_id: fake_id = random.randint(10000, 99999)
+            fake_id = self.rng.randint(10000, 99999)
+            while fake_id == real_block_id: fake_id = self.rng.randint(10000, 99999)
             fake_content = self._generate_junk_code()
             fake_blocks.append((fake_id, fake_content))
             
         # The Dispatcher Variable
         var_state = self._generate_random_string(4)
+        self._dispatch_vars.add(var_state)
         
         # Start State
         start_state = real_block_id
         
-        # Construct the Dispatcher
-        # while var_state ~= 0 do
-        
-        dispatcher_code = []
-        dispatcher_code.append(f"local {var_state} = {start_state}")
-        dispatcher_code.append(f"while {var_state} ~= 0 do")
-        
         # Create a shuffled list of blocks (Real + Fake)
+        # Each entry: (block id, content tokens, target state)
         all_blocks = []
         
         # 1. The Real Block
         # We wrap the original code in a block.
-        # Important: If original code uses 'return', it might break the loop. 
-        # But for a main chunk, it's usually fine.
-        # To leave the loop, we set state = 0 at the end of the real block.
-        
-        # Arithmetic transition to 0: state = state + (0 - current)
-        transition_to_end = f"{var_state} = {var_state} + ({exit_block_id} - {real_block_id})"
-        
-        real_block_content = f"{lua_code}\n{transition_to_end}"
-        all_blocks.append((real_block_id, real_block_content))
+        # Important: If original code uses 'return', it might break the loop.
+        # With the ladder it returns from the main chunk directly; a table
+        # dispatch closure has to hand it over to the chunk instead.
+        # To leave the loop, the real block transitions to state 0.
+        if self.cff_dispatch == 'table':
+            tokens = self._route_main_returns(tokens)
+        all_blocks.append((real_block_id, tokens, exit_block_id))
         
         # 2. Add Fake Blocks
         for fid, fcontent in fake_blocks:
             # Fake blocks jump to another fake block or end to simulate flow
             target = 0
-            # Arithmetic jump
-            trans = f"{var_state} = {var_state} + ({target} - {fid})"
-            all_blocks.append((fid, fcontent + "\n" + trans))
+            all_blocks.append((fid, fcontent, target))
             
-        # Shuffle them for the if/elseif ladder
-        random.shuffle(all_blocks)
+        # Shuffle them for the if/elseif ladder / table layout
+        self.rng.shuffle(all_blocks)
+        self._count('dispatch_blocks', len(all_blocks))
         
-        # Build the if/elseif ladder
-        for i, (bid, content) in enumerate(all_blocks):
-            check_stmt = "if" if i == 0 else "elseif"
-            
-            # Opaque Predicate for the state check? 
-            # state == bid
-            # We can leave it simple for the switch, or obfuscate the constants later with _mangle_number.
-            
-            dispatcher_code.append(f"    {check_stmt} {var_state} == {bid} then")
-            dispatcher_code.append(f"        {content}")
-            
-        dispatcher_code.append("    end")
-        dispatcher_code.append("    wait(0.001)") # Safety wait for the loop
-        dispatcher_code.append("end")
+        # Construct the Dispatcher
+        # Each entry is one line of the dispatcher, as a token list.
+        dispatcher_code = []
+        dispatcher_code.append(DISPATCH_STATE_INIT.render(state=var_state, start=start_state))
+
+        if self.cff_dispatch == 'table':
+            # Table dispatch: every block is a closure keyed by its state id that
+            # returns the next state, so a transition is one table index + call
+            # instead of a walk down the if/elseif ladder. Blocks receive the
+            # chunk's varargs so top-level '...' keeps working.
+            dispatcher_code.append(DISPATCH_RETURN_INIT.render(results=self.var_results, capture=self.var_capture))
+            dispatcher_code.append(DISPATCH_TABLE_INIT.render(table=self.var_Ta))
+            for bid, content, target in all_blocks:
+                dispatcher_code.append(DISPATCH_TABLE_ENTRY.render(table=self.var_Ta, id=bid, state=var_state))
+                dispatcher_code.append(content)
+                # Arithmetic transition: state + (target - current)
+                dispatcher_code.append(DISPATCH_TABLE_RETURN.render(state=var_state, target=target, id=bid))
+                dispatcher_code.append([('KEYWORD', 'end')])
+            dispatcher_code.append(DISPATCH_LOOP.render(state=var_state))
+            if self.instrument:
+                dispatcher_code.append(self._profile_count('dispatch', None, 'main chunk'))
+            dispatcher_code.append(DISPATCH_TABLE_STEP.render(state=var_state, table=self.var_Ta))
+            if self.cff_yield:
+                dispatcher_code.append(DISPATCH_YIELD.render()) # Safety wait for the loop
+            dispatcher_code.append([('KEYWORD', 'end')])
+            dispatcher_code.append(DISPATCH_RETURN_EXIT.render(results=self.var_results))
+        else:
+            # while var_state ~= 0 do
+            dispatcher_code.append(DISPATCH_LOOP.render(state=var_state))
+            if self.instrument:
+                dispatcher_code.append(self._profile_count('dispatch', None, 'main chunk'))
+        
+            # Build the if/elseif ladder
+            for i, (bid, content, target) in enumerate(all_blocks):
+                check_stmt = DISPATCH_LADDER_IF if i == 0 else DISPATCH_LADDER_ELSEIF
+                
+                # Opaque Predicate for the state check? 
+                # state == bid
+                # We can leave it simple for the switch, or obfuscate the constants later with _mangle_number.
+                
+                dispatcher_code.append(check_stmt.render(state=var_state, id=bid))
+                dispatcher_code.append(content)
+                # Arithmetic transition: state = state + (target - current)
+                dispatcher_code.append(DISPATCH_LADDER_STEP.render(state=var_state, target=target, id=bid))
+                
+            dispatcher_code.append([('KEYWORD', 'end')])
+            if self.cff_yield:
+                dispatcher_code.append(DISPATCH_YIELD.render()) # Safety wait for the loop
+            dispatcher_code.append([('KEYWORD', 'end')])
         
-        return "\n".join(dispatcher_code)
+        transformed_tokens = []
+        for line in dispatcher_code:
+            if transformed_tokens:
+                transformed_tokens.append(('NL', '\n'))
+            transformed_tokens.extend(line)
+        return transformed_tokens
+
+    def _route_main_returns(self, tokens):
+        """
+        Rewrites every 'return <values>' of the main chunk (outside any function
+        body) into 'return Rb(<values>)'. Under table dispatch the code runs in
+        a block closure, where a plain 'return' would hand its values to the
+        dispatcher as the next state; Rb keeps them in Ra and returns the exit
+        state 0, and the chunk returns them after the loop.
+        """
+        if not any(token == ('IDENT', 'return') for token in tokens):
+            return tokens
+        blocks = self._parse_blocks(tokens)
+        out = []
+        i = 0
+        while i < len(tokens):
+            kind, val = tokens[i]
+            if kind == 'KEYWORD' and val == 'function' and i in blocks:
+                end = blocks[i][-1] + 1
+                out.extend(tokens[i:end])
+                i = end
+                continue
+            out.append(tokens[i])
+            i += 1
+            if kind != 'IDENT' or val != 'return':
+                continue
+            # The value list runs up to the end of the enclosing block: return
+            # is always the last statement, at most followed by a ';'
+            end = i
+            depth = 0
+            while end < len(tokens):
+                kind, val = tokens[end]
+                if kind == 'KEYWORD':
+                    if val == 'function' and end in blocks:
+                        end = blocks[end][-1]
+                    elif depth == 0 and val in ('end', 'else', 'elseif', 'until'):
+                        break
+                elif val in ('(', '[', '{'):
+                    depth += 1
+                elif val in (')', ']', '}'):
+                    depth -= 1
+                elif depth == 0 and val == ';':
+                    break
+                end += 1
+            self._count('main_returns_routed', 1)
+            out.extend((('IDENT', self.var_capture), ('OP', '(')))
+            out.extend(tokens[i:end])
+            out.append(('OP', ')'))
+            i = end
+        return out
+
+    # =========================================================================
+    # FUNCTION FLATTENING (Basic blocks)
+    # =========================================================================
+
+    def _flatten_functions(self, tokens):
+        """
+        Basic-block control flow flattening of function bodies.
+
+        Each function body is cut into blocks of flatten_functions top-level
+        statements; an if/elseif/else statement becomes a block that only picks
+        the next state, and its branches are laid out the same way. The blocks
+        are shuffled into an if/elseif ladder inside 'while S ~= 0 do' and move
+        between each other with arithmetic transitions (S = S + (target - id)).
+        The ladder is used whatever cff_dispatch says: a 'return' in a block
+        must still return from the function, not from a dispatch closure.
+
+        Locals declared at a flattened level would go out of scope between
+        blocks, so they are hoisted: declared once at the top of the function,
+        their 'local' statements becoming plain assignments. Loop bodies are
+        never split, so a hoisted local still gets one fresh variable per call.
+        Bodies that cannot be hoisted safely (goto, a name declared twice or
+        used outside its original scope, too many locals) are left as they are.
+
+        Inner functions are flattened first; functions in loops are subject to
+        the loop budget like the other costly transforms.
+        """
+        blocks = self._parse_blocks(tokens)
+        depths = self._loop_depths(tokens) if self.loop_budget is not None else None
+        transformed_tokens = []
+        self._emit_flattened_range(tokens, blocks, depths, 0, len(tokens), transformed_tokens)
+        return transformed_tokens
+
+    def _emit_flattened_range(self, tokens, blocks, depths, start, stop, out, nesting=0):
+        """
+        Copies tokens[start:stop] to out, flattening every function defined in it
+        (nesting: how many functions enclose the range). Functions more than
+        MAX_FLATTEN_NESTING deep are copied as they are.
+        """
+        i = start
+        while i < stop:
+            token = tokens[i]
+            end = blocks[i][-1] if token == ('KEYWORD', 'function') and i in blocks else None
+            close = self._parameters_end(tokens, i, end) if end is not None and end < stop else None
+            if close is None:
+                out.append(token)
+                i += 1
+                continue
+            if nesting >= MAX_FLATTEN_NESTING:
+                out.extend(tokens[i:end + 1])
+                i = end + 1
+                continue
+            self._check_deadline()
+            out.extend(tokens[i:close + 1])
+            body = []
+            self._emit_flattened_range(tokens, blocks, depths, close + 1, end, body, nesting + 1)
+            flattened = None
+            if depths is None or self._within_budget(depths[i]):
+                header = [val for kind, val in tokens[i + 1:close]]
+                name = "".join(header[:header.index('(')]) or "<anonymous>"
+                parameters = sum(1 for kind, val in tokens[i + 1:close] if kind == 'IDENT')
+                flattened = self._flatten_body(body, name, parameters, getattr(token[1], 'line', None))
+            out.extend(flattened if flattened is not None else body)
+            out.append(tokens[end])
+            i = end + 1
+
+    def _parameters_end(self, tokens, function_index, end):
+        """Index of the ')' closing the parameter list of the function at function_index."""
+        for j in range(function_index + 1, end):
+            kind, val = tokens[j]
+            if val == ')':
+                return j
+            if kind not in ('IDENT', 'OP', 'MISC'):
+                return None
+        return None
+
+    def _flatten_body(self, body, name, parameters, line=None):
+        """The flattened token list of one function body (defined at source line), or None to keep it as is."""
+        for i, (kind, val) in enumerate(body):
+            if val == 'goto' or (val == ':' and i + 1 < len(body) and body[i + 1][1] == ':'):
+                return None # Labels cannot be jumped to across dispatcher blocks
+        flat = {
+            'state': self._fresh_name({val for kind, val in body if kind == 'IDENT'}),
+            'blocks_map': self._parse_blocks(body),
+            'blocks': [],          # (id, content tokens, successor ids, returns)
+            'ids': {0},
+            'scopes': {},          # Hoisted name -> (visible from, scope end)
+            'declarations': set(), # Indices of the names declared by hoisted statements
+        }
+        try:
+            entry = self._layout_sequence(body, 0, len(body), 0, flat)
+        except _Unflattenable:
+            return None
+        scopes = flat['scopes']
+        all_blocks = flat['blocks']
+        if len(all_blocks) < 2 or len(scopes) + parameters > MAX_FLATTENED_LOCALS:
+            return None
+
+        # Hoisting widens every scope to the whole function, so a hoisted name
+        # must not be used where it meant an outer variable or a global
+        declarations = flat['declarations']
+        for i, (kind, val) in enumerate(body):
+            if kind == 'IDENT' and val in scopes and i not in declarations and not _is_field_name(body, i):
+                visible_from, scope_end = scopes[val]
+                if not visible_from <= i < scope_end:
+                    return None
+
+        var_state = flat['state']
+        self._dispatch_vars.add(var_state)
+        self.rng.shuffle(all_blocks)
+        lines = []
+        if scopes:
+            declaration = [('KEYWORD', 'local')]
+            for hoisted_name in scopes:
+                if len(declaration) > 1:
+                    declaration.append(('OP', ','))
+                declaration.append(('IDENT', hoisted_name))
+            lines.append(declaration)
+        lines.append(DISPATCH_STATE_INIT.render(state=var_state, start=entry))
+        lines.append(DISPATCH_LOOP.render(state=var_state))
+        if self.instrument:
+            lines.append(self._profile_count('dispatch', line, name))
+        for n, (bid, content, successors, returns) in enumerate(all_blocks):
+            check_stmt = DISPATCH_LADDER_IF if n == 0 else DISPATCH_LADDER_ELSEIF
+            lines.append(check_stmt.render(state=var_state, id=bid))
+            lines.append(content)
+        lines.append([('KEYWORD', 'end')])
+        lines.append([('KEYWORD', 'end')])
+
+        self._count('functions_flattened')
+        self._count('blocks_flattened', len(all_blocks))
+        self._count('locals_hoisted', len(scopes))
+        if self.stats is not None:
+            self.stats.functions.append(asdict(FlatteningReport(
+                name=name,
+                granularity=self.flatten_functions,
+                blocks=len(all_blocks),
+                locals_hoisted=len(scopes),
+                min_steps=self._min_dispatch_steps(all_blocks, entry),
+                compares_per_step=(len(all_blocks) + 1) / 2,
+            )))
+
+        flattened = []
+        for line in lines:
+            flattened.append(NL_TOKEN)
+            flattened.extend(line)
+        flattened.append(NL_TOKEN)
+        return flattened
+
+    def _new_block_id(self, flat):
+        """Unused random state id for a flattened block."""
+        while True:
+            bid = self.rng.randint(1, 99999)
+            if bid not in flat['ids']:
+                flat['ids'].add(bid)
+                return bid
+
+    def _layout_sequence(self, body, start, stop, exit_id, flat, nesting=0):
+        """
+        Lays out the statements of body[start:stop] as dispatcher blocks that end
+        by moving to exit_id and appends them to flat['blocks']. Returns the id
+        of the first block (exit_id if there are no statements). The range is
+        nested in `nesting` laid out ifs; past MAX_FLATTEN_NESTING an if is kept
+        whole inside its block like a loop.
+        """
+        blocks_map = flat['blocks_map']
+        groups = [] # ('if', if index) or ('plain', [(statement ranges, returns), ...])
+        plain = []
+        for chunk_start, chunk_end in self._top_level_bounds(body[start:stop]):
+            chunk_start += start
+            chunk_end += start
+            markers = blocks_map.get(chunk_start) \
+                if body[chunk_start] == ('KEYWORD', 'if') and nesting < MAX_FLATTEN_NESTING else None
+            if markers and markers[-1] == chunk_end - 1 and self._is_if_chain(body, markers):
+                if plain:
+                    groups.append(('plain', plain))
+                    plain = []
+                groups.append(('if', chunk_start))
+                continue
+            statements, returns = self._split_statements(body, chunk_start, chunk_end, blocks_map)
+            plain.append((statements, returns))
+            # Nothing may follow a return in its block
+            if len(plain) >= self.flatten_functions or returns:
+                groups.append(('plain', plain))
+                plain = []
+        if plain:
+            groups.append(('plain', plain))
+
+        # Laid out back to front, so every block knows the id it moves to
+        target = exit_id
+        for kind, group in reversed(groups):
+            bid = self._new_block_id(flat)
+            if kind == 'if':
+                content, successors = self._layout_branches(body, group, target, bid, flat, nesting)
+                flat['blocks'].append((bid, content, successors, False))
+            else:
+                content = []
+                for statements, returns in group:
+                    if content:
+                        content.append(NL_TOKEN)
+                    for n, (statement_start, statement_end) in enumerate(statements):
+                        if n:
+                            content.append(('OP', ';'))
+                        content.extend(self._hoist_locals(body, statement_start, statement_end, stop, flat))
+                if returns:
+                    flat['blocks'].append((bid, content, [], True))
+                else:
+                    content.append(NL_TOKEN)
+                    content.extend(DISPATCH_LADDER_STEP.render(state=flat['state'], target=target, id=bid))
+                    flat['blocks'].append((bid, content, [target], False))
+            target = bid
+        return target
+
+    def _split_statements(self, body, start, stop, blocks_map):
+        """
+        Splits the statements in body[start:stop] at top-level ';' into
+        (start, end) ranges and tells whether they end with a return. Raises
+        _Unflattenable for what a dispatcher block cannot hold: a 'break' (it
+        would leave the dispatcher loop) or a 'local' that does not start one
+        of the ranges.
+        """
+        ranges = []
+        statement_start = start
+        brackets = 0
+        returns = False
+        i = start
+        while i < stop:
+            kind, val = body[i]
+            if kind == 'KEYWORD' and i in blocks_map:
+                i = blocks_map[i][-1] + 1 # Nested block
+                continue
+            if kind == 'OP':
+                if val in '([{':
+                    brackets += 1
+                elif val in ')]}':
+                    brackets -= 1
+                elif val == ';' and brackets == 0:
+                    if i > statement_start:
+                        ranges.append((statement_start, i))
+                    statement_start = i + 1
+            elif val == 'return':
+                returns = True
+            elif val == 'break' or (val == 'local' and i != statement_start):
+                raise _Unflattenable(val)
+            i += 1
+        if stop > statement_start:
+            ranges.append((statement_start, stop))
+        return ranges, returns
+
+    def _hoist_locals(self, body, start, stop, scope_end, flat):
+        """
+        body[start:stop] with a leading 'local' statement turned into an
+        assignment to hoisted locals, recording their scopes in flat.
+        """
+        if body[start] != ('KEYWORD', 'local'):
+            return body[start:stop]
+        scopes = flat['scopes']
+        if body[start + 1] == ('KEYWORD', 'function'):
+            # local function f ... -> f = function ... (f is visible inside its body)
+            name = body[start + 2]
+            if name[0] != 'IDENT' or name[1] in scopes:
+                raise _Unflattenable(name[1])
+            scopes[name[1]] = (start + 2, scope_end)
+            flat['declarations'].add(start + 2)
+            return [name, ('OP', '='), body[start + 1]] + body[start + 3:stop]
+
+        # local a, b = e -> a, b = e ; local a -> a = nil
+        assignment = []
+        j = start + 1
+        while j < stop and body[j][0] == 'IDENT' and body[j][1] not in scopes:
+            scopes[body[j][1]] = (stop, scope_end)
+            flat['declarations'].add(j)
+            assignment.append(body[j])
+            j += 1
+            if j < stop and body[j] == ('OP', ','):
+                assignment.append(body[j])
+                j += 1
+            else:
+                break
+        if j == stop and assignment[-1][0] == 'IDENT':
+            return assignment + [('OP', '='), ('IDENT', 'nil')]
+        if j < stop and body[j] == ('OP', '=') and assignment and assignment[-1][0] == 'IDENT':
+            return assignment + body[j:stop]
+        raise _Unflattenable('local') # Attributes (<const>), a redeclared name, ...
+
+    def _layout_branches(self, body, if_index, join_id, bid, flat, nesting=0):
+        """
+        The block replacing an if statement: the same conditions, each branch
+        only moving to the first block of its laid out body. Returns the block's
+        content and successor ids.
+        """
+        markers = flat['blocks_map'][if_index]
+        content = [body[if_index]]
+        successors = []
+        prev = if_index
+        has_else = False
+        for n, marker in enumerate(markers[:-1]):
+            keyword = body[marker][1]
+            if keyword == 'then':
+                content.extend(body[prev + 1:marker + 1]) # Condition
+            else:
+                content.append(body[marker])
+                has_else = has_else or keyword == 'else'
+            if keyword != 'elseif':
+                branch_id = self._layout_sequence(body, marker + 1, markers[n + 1], join_id, flat, nesting + 1)
+                successors.append(branch_id)
+                content.extend(DISPATCH_LADDER_STEP.render(state=flat['state'], target=branch_id, id=bid))
+            prev = marker
+        if not has_else:
+            content.append(('KEYWORD', 'else'))
+            content.extend(DISPATCH_LADDER_STEP.render(state=flat['state'], target=join_id, id=bid))
+            successors.append(join_id)
+        content.append(body[markers[-1]])
+        return content, successors
+
+    def _min_dispatch_steps(self, blocks, entry):
+        """Fewest dispatcher steps from entry to leaving the loop (breadth-first search)."""
+        graph = {bid: (successors, returns) for bid, content, successors, returns in blocks}
+        steps = {entry: 1}
+        queue = [entry]
+        for bid in queue:
+            successors, returns = graph[bid]
+            if returns or 0 in successors:
+                return steps[bid]
+            for successor in successors:
+                if successor not in steps:
+                    steps[successor] = steps[bid] + 1
+                    queue.append(successor)
+        return 0
+
+    # =========================================================================
+    # LAZY FUNCTIONS (lazy_functions)
+    # =========================================================================
+
+    def _mark_lazy_functions(self, tokens):
+        """
+        Marks the functions whose body lazy_functions loads on first call: those
+        with at least lazy_functions body tokens, defined outside any function
+        or loop (so their definition runs once and one cached closure serves
+        every call). Their 'function' keyword becomes a _LazyKeyword, which the
+        passes carry along to _emit_lazy_stubs. Nested functions go with the
+        body they are in.
+        """
+        blocks = self._parse_blocks(tokens)
+        marked = None
+        i = 0
+        while i < len(tokens):
+            kind, val = tokens[i]
+            if kind == 'KEYWORD' and i in blocks and val in ('while', 'for', 'repeat', 'function'):
+                end = blocks[i][-1]
+                if val == 'function':
+                    close = self._parameters_end(tokens, i, end)
+                    if close is not None and end - close - 1 >= self.lazy_functions:
+                        marked = marked or list(tokens)
+                        marked[i] = ('KEYWORD', _LazyKeyword(val, getattr(val, 'line', None)))
+                i = end + 1 # Loops may run a definition many times
+                continue
+            i += 1
+        return marked or tokens
+
+    def _emit_lazy_stubs(self, tokens):
+        """
+        Replaces the body of every marked function with a stub:
+
+            return (La[id] or Lb(id, 'blob', 'key', env, Ea, Ma, ...))(a, b)
+
+        The blob is the obfuscated body, wrapped as a chunk returning the
+        function and encrypted like a string:
+
+            local _ENV, Ea, Ma, ... = ...
+            return function(a, b) <body> end
+
+        Lb decrypts it with Ea, compiles it, runs it with the environment
+        (setfenv, or the _ENV local in Lua 5.2+) and the header locals the body
+        uses, and caches the closure in La. env is Ma when the body uses no
+        outer names, else a proxy whose __index/__newindex read and write the
+        outer variables themselves (see _lazy_environment).
+        """
+        blocks = self._parse_blocks(tokens)
+        header_names = self._header_names()
+        out = []
+        i = 0
+        while i < len(tokens):
+            token = tokens[i]
+            if token[1].__class__ is _LazyKeyword and i in blocks:
+                end = blocks[i][-1]
+                close = self._parameters_end(tokens, i, end)
+                stub = self._lazy_stub(tokens, i, close, end, header_names) if close is not None else None
+                if stub is not None:
+                    self._check_deadline()
+                    out.extend(tokens[i:close + 1])
+                    out.extend(stub)
+                    out.append(tokens[end])
+                    i = end + 1
+                    continue
+            out.append(token)
+            i += 1
+        return out
+
+    def _lazy_stub(self, tokens, function_index, close, end, header_names):
+        """The stub tokens for the function at function_index, or None to leave it inline."""
+        open_index = next(j for j in range(function_index + 1, close) if tokens[j] == ('OP', '('))
+        parameters = tokens[open_index + 1:close]
+        if any(val == ':' for kind, val in tokens[function_index + 1:open_index]):
+            parameters = [('IDENT', 'self')] + ([('OP', ',')] if parameters else []) + parameters
+        body = tokens[close + 1:end]
+
+        names = self._lazy_free_names(body, [val for kind, val in parameters if kind == 'IDENT'])
+        values = [name for name in names if name in header_names]
+        outer = [name for name in names if name not in header_names]
+        if len(values) + len(outer) + 3 > MAX_LAZY_UPVALUES: # + La, Lb and Ma
+            return None
+
+        if self.minify:
+            body = self._minify_tokens(body)
+        prologue = ",".join(['_ENV'] + values)
+        chunk = f"local {prologue}=...\nreturn function({self._reconstruct(parameters)})\n{self._reconstruct(body)}\nend"
+        key = self._generate_keys(1)[0]
+        # Spelled with the shortest escapes whatever minify says: the blob is what
+        # the main chunk still has to lex
+        blob = _shortest_literal(_decode_lua_string(_xor_bulk([chunk.encode('utf-8')], [key.encode('ascii')])[0]))
+        self._lazy_ids += 1
+        self._count('functions_lazy')
+        self._count('lazy_bytes', len(chunk))
+
+        value_tokens = []
+        for name in values:
+            value_tokens.extend((('OP', ','), ('IDENT', name)))
+        return [NL_TOKEN] + LAZY_STUB.render(
+            cache=self.var_lazy, load=self.var_lazy_load, id=self._lazy_ids,
+            blob=[('STRING', blob)], key=[('STRING', f"'{key}'")],
+            env=self._lazy_environment(outer, body), values=value_tokens, arguments=parameters) + [NL_TOKEN]
+
+    def _lazy_environment(self, outer, body):
+        """
+        The environment of a lazy function body: Ma, or when the body uses outer
+        names a proxy built at the stub (on the first call only). Its closures
+        see what the original function saw, so reads and writes of those names
+        reach the same upvalues or globals; anything else goes to Ma.
+        """
+        if not outer:
+            return [('IDENT', self.var_Ma)]
+        used = set(outer)
+        used.update(val for kind, val in body if kind == 'IDENT')
+        t, k, v = self._fresh_name(used), self._fresh_name(used), self._fresh_name(used)
+        reads = []
+        writes = []
+        for name in outer:
+            literal = [('STRING', f'"{name}"')]
+            reads.extend(LAZY_ENV_READ.render(k=k, name=literal, variable=name))
+            writes.extend(LAZY_ENV_WRITE.render(k=k, name=literal, variable=name, v=v))
+        return LAZY_ENV.render(t=t, k=k, v=v, reads=reads, writes=writes, outer=self.var_Ma)
+
+    def _lazy_free_names(self, body, parameters):
+        """
+        Names a lazy function body may use from outside it (upvalues, globals and
+        header locals), in order of first use: its free names as _scope_events
+        resolves them, so 'local x = x' still reports the outer x. Reporting a
+        name the body declares itself is harmless: the proxy branch is never taken.
+        """
+        free = {}
+        for event in self._scope_events(body, parameters):
+            if event[0] == 'use' and event[2] is None:
+                free[event[1]] = None
+        return list(free)
+
+    def _generate_lazy_loader(self):
+        """
+        Emits La (compiled lazy functions by stub id) and Lb, which decrypts,
+        compiles and caches one, per target_runtime: loadstring and setfenv for
+        Lua 5.1 / Luau, load for 5.3 (the chunk declares its own _ENV), and
+        whichever exists for 'auto'.
+        """
+        if not self.lazy_functions:
+            return ""
+        if self.target_runtime == 'lua53':
+            compile_chunk, bind = "load", ""
+        elif self.target_runtime in ('luau', 'lua51'):
+            compile_chunk, bind = "loadstring", "setfenv(f,env) "
+        else:
+            compile_chunk, bind = "(loadstring or load)", "if setfenv then setfenv(f,env) end "
+        cache = self.var_lazy
+        return f"""local {cache}={{}}
+local {self.var_lazy_load}=function(id,blob,key,env,...)
+    local f=assert({compile_chunk}({self.var_Ea}(blob,key)))
+    {bind}f=f(env,...)
+    {cache}[id]=f
+    return f
+end
+"""
 
     # =========================================================================
     # CORE PIPELINE
@@ -527,93 +2589,1397 @@ class WabiSabiObfuscator:
         - Instead of iterating 1 to N, we iterate from Offset to N + (Offset-1)
         - Inside the loop, we use (kd-Zf+1) inline to get the real 1-based index
         - This is effective against simple deobfuscators that expect standard 1-to-N loops
-        - The offset value (8960-8867) = 93 is used for obfuscation (matches OFFSET_VAL in _xor_encrypt)
+        - The offset value (8960-8867) = 93 is used for obfuscation (matches ENCRYPT_KEY_OFFSET)
         - Note: We inline the index calc to avoid per-iteration local variable allocation overhead
+        - Decrypted characters go into a buffer joined once with table.concat, so
+          decryption is linear in the string length
+
+        The constant table of top-level numeric literals follows Ea. In string
+        pool mode the encrypted pool and its decrypting cache come next, then the
+        hoisted global aliases (which may reference the pool) and the loader of
+        lazy functions.
         """
-        return f"""-- Generated by Wabi Sabi Obfuscator
-local {self.var_Ma}=(getfenv())
-local {self.var_string_char},{self.var_string_byte},{self.var_bit_xor}=(string.char),(string.byte),(bit32 and bit32.bxor or function(a,b) local p,c=1,0 while a>0 and b>0 do local ra,rb=a%2,b%2 if ra~=rb then c=c+p end a,b,p=(a-ra)/2,(b-rb)/2,p*2 end if a<b then a=b end while a>0 do local ra=a%2 if ra>0 then c=c+p end a,p=(a-ra)/2,p*2 end return c end)
+        env = "_ENV" if self.target_runtime == 'lua53' else "getfenv()"
+        return f"""{BANNER}local {self.var_Ma}=({env})
+local {self.var_string_char},{self.var_string_byte},{self.var_bit_xor}=(string.char),(string.byte),({self._generate_xor_function()})
+local {self.var_table_concat}=(table.concat)
 local {self.var_Ea}=function(ib,da)
-    local Vb=''
+    local Vb={{}}
     local Zf=(8960-8867)
     for kd=Zf,#ib+(Zf-1) do
         local key_char = {self.var_string_byte}(da, ((kd-Zf+1)-2053812/22084)%#da + 1)
         local str_char = {self.var_string_byte}(ib, kd-Zf+1)
-        Vb=Vb..{self.var_string_char}({self.var_bit_xor}(str_char, key_char))
+        Vb[kd-Zf+1]={self.var_string_char}({self.var_bit_xor}(str_char, key_char))
     end
-    return Vb
+    return {self.var_table_concat}(Vb)
 end
-"""
+{self._generate_profile_runtime()}{self._generate_number_table()}{self._generate_string_pool()}{self._generate_hoisted_globals()}{self._generate_lazy_loader()}"""
 
-    def _remove_comments(self, source):
-        pattern = r'(?s)("(?:[^"\\]|\\.)*"|\'(?:[^\'\\]|\\.)*\')|(\[(=*)\[.*?\]\3\])|(--\[(=*)\[.*?\]\5\]|--[^\n\r]*)'
-        def replacer(match):
-            if match.group(4): return " "
-            return match.group(0)
-        return re.sub(pattern, replacer, source)
+    def _generate_xor_function(self):
+        """
+        Lua expression for the byte XOR used by Ea(), per target_runtime.
+
+        Without bit32 the XOR is a lookup in a 256x256 table, built on the first
+        call by doubling: for n = 1, 2, 4 .. 128 the known n x n block gives the
+        three neighbouring blocks (x xor n). That is 64K assignments once, instead
+        of a bit loop of up to 8 iterations for every decrypted byte.
+        """
+        if self.target_runtime == 'luau':
+            return "bit32.bxor"
+        if self.target_runtime == 'lua53':
+            return "function(a,b) return a ~ b end"
+        table_xor = ("(function() local X return function(a,b) if not X then X={0} local n=1 "
+                     "while n<256 do for i=0,n-1 do for j=0,n-1 do local v=X[i*256+j+1] "
+                     "X[(i+n)*256+j+1]=v+n X[i*256+j+n+1]=v+n X[(i+n)*256+j+n+1]=v end end n=n*2 end end "
+                     "return X[a*256+b+1] end end)()")
+        if self.target_runtime == 'lua51':
+            return table_xor
+        return f"bit32 and bit32.bxor or {table_xor}"
+
+    def _generate_number_table(self):
+        """Emits the constant table of numeric literals (empty when nothing uses it)."""
+        if not self._number_entries:
+            return ""
+        return f"local {self.var_numbers}={{{','.join(self._number_entries)}}}\n"
+
+    def _generate_string_pool(self):
+        """Emits the encrypted constant pool and its decrypted cache (string pool mode only)."""
+        if self.string_pool is None:
+            return ""
+        data = ",".join(f"'{encrypted}','{key}'" for encrypted, key in self._pool_entries)
+        pool, pool_data = self.var_pool, self.var_pool_data
+        if self.string_pool == 'eager':
+            # Decrypt everything once at load time
+            return f"""local {pool_data}={{{data}}}
+local {pool}={{}}
+for i=1,#{pool_data}/2 do {pool}[i]={self.var_Ea}({pool_data}[2*i-1],{pool_data}[2*i]) end
+"""
+        # Decrypt on first use; afterwards Ka[i] is a plain table hit
+        return f"""local {pool_data}={{{data}}}
+local {pool}=setmetatable({{}},{{__index=function(t,i) local v={self.var_Ea}({pool_data}[2*i-1],{pool_data}[2*i]) t[i]=v return v end}})
+"""
 
     def obfuscate(self, lua_source):
         """
         Pipeline:
-        1. Clean (Remove Comments)
+        1. Lex (once) into the shared token stream - comments are dropped here
         2. AST Logic Inversion (Strategy A)
         3. Contextual Predicates (Strategy B)
+           (flatten_functions: basic-block flattening of every function body)
         4. Control Flow Flattening (The Maze)
+           (shared_junk: the junk/predicate library goes ahead of the dispatcher)
         5. Logic Gate Booleans (MoonVeil) - Replaces true/false with logic expressions
         6. Mangle Numbers (including those generated in 2/3/4/5)
         7. Mangle Strings
         8. Virtualize Globals
+           (lazy_functions: the bodies marked after lexing become encrypted blobs
+           behind loading stubs)
+        9. Reconstruct (once) and prepend the header
+
+        Every step reads and returns the token list; the source text is only
+        rebuilt at the very end.
+
+        With a seed, identical input produces byte-identical output.
         """
+        self._start_guard()
+        self._check_input_size(len(lua_source))
+        if self.seed is not None:
+            self.rng.seed(self.seed)
+        self._pool_index = {}
+        self._pool_entries = []
+        self._number_index = {}
+        self._number_entries = []
+        self._dispatch_vars = set()
+        self._lazy_ids = 0
+        self.symbol_map = [] if self.instrument else None
+        chunked = self.incremental or self.jobs is not None
+        self._build_junk_library(random.Random(f"{self._chunk_salt}:library") if chunked else self.rng)
+        self.stats = ObfuscationStats(input_size=len(lua_source)) if self.profile else None
+        started = time.perf_counter()
         
-        # 1. Clean
-        lua_source = self._remove_comments(lua_source)
+        if chunked:
+            # 1-8 per top-level chunk (cached, or spread over worker processes), then linked into
+            # one unit; only the text around what changed since the last call is lexed again
+            tokens = self._run_pass('incremental', self._obfuscate_incremental, lua_source)
+            if self.lazy_functions:
+                tokens = self._run_pass('lazy_functions', self._emit_lazy_stubs, tokens)
+            return self._finish(tokens, started)
+
+        # 1. Lex (a profile build keeps the source line of every token)
+        tokens = self._run_pass('tokenize', LEXER.tokenize_lines if self.instrument else self._tokenize, lua_source)
+        if self.lazy_functions:
+            tokens = self._run_pass('lazy_marks', self._mark_lazy_functions, tokens)
 
         # 2. Strategy A: Logic Inversion (AST Traversal)
-        lua_source = self._process_logic_inversion(lua_source)
+        tokens = self._run_pass('logic_inversion', self._process_logic_inversion, tokens)
         
         # 3. Strategy B: Contextual Predicates (Injection)
-        lua_source = self._inject_contextual_predicates(lua_source)
+        tokens = self._run_pass('contextual_predicates', self._inject_contextual_predicates, tokens)
+
+        # 3b. Basic-block flattening of function bodies (optional)
+        if self.flatten_functions:
+            tokens = self._run_pass('function_flattening', self._flatten_functions, tokens)
 
         # 4. Control Flow Flattening (The Maze)
         # We wrap the processed code in the maze structure.
-        lua_source = self._apply_control_flow_flattening(lua_source)
+        tokens = self._run_pass('control_flow_flattening', self._apply_control_flow_flattening, tokens)
+
+        # 4b. The shared junk/predicate library the transforms above call (optional)
+        if self.shared_junk:
+            tokens = self._run_pass('junk_library', self._prepend_junk_library, tokens)
 
         # 5. Logic Gate Booleans (MoonVeil)
         # Replaces 'true' and 'false' literals with logic gate expressions
         # Must be done BEFORE number mangling so the numbers inside get obfuscated too
-        lua_source = self._mangle_booleans(lua_source)
+        tokens = self._run_pass('booleans', self._mangle_booleans, tokens)
 
         # 6. Mangle Numbers
         # This will now also mangle the constants inside our Opaque Predicates and State Transitions
         # e.g., state = state + (-84379) -> state = state + ((10-94883) + ...)
-        # UPDATED: Regex to support hex/scientific numbers so they aren't split by mangle_number
-        number_pattern = r'0[xX][0-9a-fA-F]+(?:(?:\.[0-9a-fA-F]*)?(?:[pP][+-]?\d+)?)?|\b\d+(?:\.\d*)?(?:[eE][+-]?\d+)?\b'
-        def replace_number(match):
-            return self._mangle_number(match.group(0))
-        
-        protected_code = re.sub(number_pattern, replace_number, lua_source)
+        # Only NUMBER tokens are touched, so digits inside strings and identifiers are safe.
+        tokens = self._run_pass('numbers', self._mangle_numbers, tokens)
         
         # 7. Mangle Strings
-        string_pattern = r'("([^"]*)"|\'([^\']*)\')'
-        def replace_string(match):
-            if match.group(2) is not None:
-                content = match.group(2)
-            else:
-                content = match.group(3)
-            return self._mangle_string(content)
-
-        protected_code = re.sub(string_pattern, replace_string, protected_code)
+        tokens = self._run_pass('strings', self._mangle_strings, tokens)
 
         # 8. Mangle Globals
-        protected_code = self._mangle_globals(protected_code)
+        tokens = self._run_pass('globals', self._mangle_globals, tokens)
+
+        # 8b. Encrypted function bodies compiled on first call (optional)
+        if self.lazy_functions:
+            tokens = self._run_pass('lazy_functions', self._emit_lazy_stubs, tokens)
+
+        return self._finish(tokens, started)
 
-        # 9. Header
-        final_code = self._generate_header() + "\n" + protected_code
+    def _finish(self, tokens, started):
+        """9. Header: reconstructs the final token stream and completes the stats."""
+        if self.minify:
+            final_code = self._run_pass('minify', self._minify, tokens)
+            if self.stats is not None:
+                self.stats.unminified_size = len(self._assemble(tokens))
+        else:
+            final_code = self._run_pass('reconstruct', self._assemble, tokens)
+
+        if self.stats is not None:
+            self.stats.output_size = len(final_code)
+            self.stats.seconds = time.perf_counter() - started
         
         return final_code
 
-# --- Usage ---
-if __name__ == "__main__":
+    def _assemble(self, tokens):
+        """Prepends the header to the reconstructed token stream (and appends the profile trailer)."""
+        return self._generate_header() + "\n" + self._reconstruct(tokens) + self._generate_profile_trailer()
+
+    def _run_pass(self, name, func, data):
+        """Runs one pipeline pass, recording a PassStats entry when profiling."""
+        self._check_deadline()
+        self._counts = {}
+        if self.stats is None:
+            return func(data)
+        start = time.perf_counter()
+        result = func(data)
+        elapsed = time.perf_counter() - start
+        self.stats.passes.append(PassStats(
+            name=name,
+            seconds=elapsed,
+            input_size=_text_size(data),
+            output_size=_text_size(result),
+            tokens=len(result) if isinstance(result, list) else len(data),
+            transforms=dict(self._counts),
+        ))
+        return result
+
+    # =========================================================================
+    # INPUT GUARDS (max_input_size / time_limit)
+    # =========================================================================
+
+    def _start_guard(self):
+        """Starts the time_limit clock of an obfuscate() or obfuscate_stream() call."""
+        self._deadline = time.perf_counter() + self.time_limit if self.time_limit is not None else None
+
+    def _check_input_size(self, size):
+        """Raises ValueError once the input read so far is over max_input_size."""
+        if self.max_input_size is not None and size > self.max_input_size:
+            raise ValueError(f"input is over max_input_size ({size} > {self.max_input_size} characters)")
+
+    def _check_deadline(self):
+        """Raises TimeoutError when the running call is past its time_limit."""
+        if self._deadline is not None and time.perf_counter() > self._deadline:
+            raise TimeoutError(f"obfuscation took longer than time_limit ({self.time_limit:g}s)")
+
+    # =========================================================================
+    # PROFILE BUILD (instrument=True)
+    # =========================================================================
+
+    def _profile_site(self, kind, line, detail):
+        """Adds a counted site to self.symbol_map and returns its id."""
+        site_id = len(self.symbol_map) + 1
+        self.symbol_map.append(asdict(ProfileSite(id=site_id, kind=kind, line=line, detail=detail)))
+        self._count('sites_instrumented')
+        return site_id
+
+    def _profile_count(self, kind, line, detail):
+        """Statement tokens counting every run of a new site: Pk(id)."""
+        return PROFILE_COUNT.render(counter=self.var_profile, id=self._profile_site(kind, line, detail))
+
+    def _profile_wrap(self, value, kind, line, detail):
+        """Expression tokens counting every evaluation of value (tokens) and returning it: Pk(id, value)."""
+        return PROFILE_WRAP.render(counter=self.var_profile, id=self._profile_site(kind, line, detail), value=value)
+
+    def _source_line(self, tokens, start=0):
+        """Source line of the first lexed token from tokens[start] on (None if there is none)."""
+        for i in range(start, len(tokens)):
+            line = getattr(tokens[i][1], 'line', None)
+            if line is not None:
+                return line
+        return None
+
+    def _generate_profile_runtime(self):
+        """
+        The counters of a profile build, emitted right after Ea(): Pk() counts a
+        site and passes its other arguments through, Ea() is wrapped to add its
+        own time to Pe, and Pd() (published as the global WabiSabiProfile)
+        returns the dump: a clock line, then one 'WSPROF id count' line per site.
+        """
+        if not self.instrument:
+            return ""
+        Pk, Pc, Pt, Pe, Pd = (self.var_profile, self.var_profile_counts, self.var_profile_start,
+                              self.var_profile_decrypt, self.var_profile_dump)
+        return f"""local {Pc},{Pe},{Pt}={{}},0,os.clock()
+local function {Pk}(id,...) {Pc}[id]=({Pc}[id] or 0)+1 return ... end
+do local f={self.var_Ea} {self.var_Ea}=function(a,b) local t=os.clock() local v=f(a,b) {Pe}={Pe}+(os.clock()-t) return v end end
+local function {Pd}()
+    local out={{"{PROFILE_LINE_PREFIX} clock "..(os.clock()-{Pt}).." decrypt "..{Pe}}}
+    for id,n in pairs({Pc}) do out[#out+1]="{PROFILE_LINE_PREFIX} "..id.." "..n end
+    return table.concat(out,"\\n")
+end
+{self.var_Ma}.{PROFILE_DUMP_GLOBAL}={Pd}
+"""
+
+    def _generate_profile_trailer(self):
+        """Prints the dump once the main chunk has run (profile builds only)."""
+        return f"\nprint({self.var_profile_dump}())" if self.instrument else ""
+
+    # =========================================================================
+    # MINIFICATION
+    # =========================================================================
+
+    def _minify(self, tokens):
+        """
+        Final step with minify=True, in place of _assemble: the header is lexed
+        into the token stream, which is then minified (_minify_tokens), its
+        generated variables renamed (_shorten_names) and reconstructed. Only the
+        banner comment is kept. Nothing is factored out: a lookup repeated at
+        many sites is written out at each of them.
+        """
+        header = self._minify_tokens(self._tokenize(self._generate_header()))
+        tokens = header + self._minify_tokens(tokens + self._tokenize(self._generate_profile_trailer()))
+        return BANNER + self._reconstruct(self._shorten_names(tokens, len(header)))
+
+    def _minify_text(self, prefix, tokens):
+        """prefix (generated Lua text) followed by tokens, minified when minify=True (streaming)."""
+        if not self.minify:
+            return prefix + self._reconstruct(tokens)
+        return self._reconstruct(self._minify_tokens(self._tokenize(prefix) + tokens))
+
+    def _minify_tokens(self, tokens):
+        """
+        Token-level minification, in one pass:
+        - Line breaks are dropped. With comments gone Lua only needs whitespace
+          between words, which _reconstruct inserts. (A line starting with '('
+          continues the previous statement as a call in Lua 5.2+, with or
+          without the break; Lua 5.1 rejects such input to begin with.)
+        - Quoted strings are respelled with the shortest escapes (_shortest_literal).
+        - Parentheses that only group are dropped around a single name, field
+          chain (a.b.c) or literal, and around another parenthesized expression.
+          Parentheses around calls and varargs stay: they cut the results to one.
+        """
+        out = []
+        groups = []        # Output index of each open '(' that groups, None for the others
+        last_group = None  # (open, close) output indices of the last parentheses kept
+        postfix = ('(', '[', ':', '{')
+        for i, token in enumerate(tokens):
+            kind, val = token
+            if kind == 'NL':
+                continue
+            if kind == 'STRING' and val[0] != '[':
+                token = self._shortest_string(token)
+            elif kind == 'OP' and val == '(':
+                prev = out[-1] if out else None
+                call = prev is not None and (prev[1] in (')', ']', '}', 'function') or prev[0] == 'STRING' or
+                                             (prev[0] == 'IDENT' and prev[1] not in LUA_KEYWORDS))
+                groups.append(None if call else len(out)) # (Parameter lists count as calls)
+            elif kind == 'OP' and val == ')' and groups:
+                start = groups.pop()
+                if start is not None and self._redundant_group(out, start, last_group, tokens, i, postfix):
+                    if len(out) - start <= 8:
+                        del out[start]
+                    else:
+                        out[start] = None # Cheaper than shifting a long expression
+                    self._count('parens_removed')
+                    continue
+                last_group = (start, len(out))
+            out.append(token)
+        return [token for token in out if token is not None]
+
+    def _redundant_group(self, out, start, last_group, tokens, close, postfix):
+        """True if the parentheses from out[start] to tokens[close] can be dropped."""
+        size = len(out) - start - 1
+        following = [token for token in tokens[close + 1:close + 4] if token[0] != 'NL']
+        next_val = following[0][1] if following else None
+        if size == 1 and (out[-1][0] in ('NUMBER', 'STRING') or out[-1][1] in ('true', 'false', 'nil')):
+            # A literal, unless something is indexed or called on it: ("x"):rep(2)
+            if next_val == '.':
+                return len(following) > 1 and following[1][1] == '.' # '..' concatenation
+            return next_val not in postfix and not (following and following[0][0] == 'STRING')
+        if size <= MAX_MINIFY_GROUP and self._is_variable(out, start + 1):
+            return True # A name, field or index: one value, already a prefix expression
+        if last_group == (start + 1, len(out) - 1):
+            return True # ((expr)): the inner parentheses already group
+        # An operator expression where any expression fits: after '=', ',', 'return'
+        # or an opening bracket, and followed by a separator or the next statement
+        prev = out[start - 1] if start else None
+        if prev is None or size > MAX_MINIFY_GROUP:
+            return False
+        if prev[1] == '=':
+            if start < 2 or out[start - 2] is None or out[start - 2][1] in ('=', '~', '<', '>'):
+                return False # ==, ~=, <=, >=
+        elif prev[1] not in (',', '(', '[', '{', 'return', ';'):
+            return False
+        if following and not (next_val in (',', ')', ']', '}', ';') or following[0][0] == 'KEYWORD' or
+                              (following[0][0] == 'IDENT' and next_val not in ('and', 'or'))):
+            return False
+        return self._has_operator(out, start + 1)
+
+    def _is_variable(self, out, start):
+        """True if out[start:] is a name followed by .field and [index] suffixes only."""
+        first = out[start]
+        if first is None or first[0] != 'IDENT' or first[1] in LUA_KEYWORDS:
+            return False
+        j = start + 1
+        while j < len(out):
+            token = out[j]
+            if token is None:
+                return False
+            if token[1] == '.' and j + 1 < len(out) and out[j + 1] is not None and \
+                    out[j + 1][0] == 'IDENT' and out[j + 1][1] not in LUA_KEYWORDS:
+                j += 2
+            elif token[1] == '[':
+                depth = 0
+                while j < len(out):
+                    val = out[j][1] if out[j] is not None else None
+                    if val == '[':
+                        depth += 1
+                    elif val == ']':
+                        depth -= 1
+                        if depth == 0:
+                            break
+                    j += 1
+                j += 1
+            else:
+                return False
+        return True
+
+    def _has_operator(self, out, start):
+        """True if out[start:] has a unary or binary operator outside brackets (so it is one value)."""
+        depth = 0
+        dots = 0 # '.' field access, '..' concatenation, '...' varargs
+        for token in out[start:] + [None]:
+            if token is None:
+                if dots == 2 and depth == 0:
+                    return True
+                dots = 0
+                continue
+            kind, val = token
+            if val == '.':
+                dots += 1
+                continue
+            if dots == 2 and depth == 0:
+                return True
+            dots = 0
+            if val in ('(', '[', '{'):
+                depth += 1
+            elif val in (')', ']', '}'):
+                depth -= 1
+            elif depth == 0 and (kind == 'OP' and val in '+-*/%^#<>~=' or val in ('and', 'or', 'not')):
+                return True
+            elif kind == 'KEYWORD' and val == 'function':
+                return False # Operators of a function body say nothing about the group
+        return False
+
+    def _shortest_string(self, token):
+        """A quoted STRING token respelled with the shortest escapes, if that is shorter."""
+        try:
+            literal = _shortest_literal(_decode_lua_string(token[1][1:-1]))
+        except ValueError:
+            return token
+        if len(literal) >= len(token[1]):
+            return token
+        self._count('string_bytes_saved', len(token[1]) - len(literal))
+        return ('STRING', literal)
+
+    def _header_names(self):
+        """The variables the obfuscator declares for the whole chunk (header locals, Ta, Ja, aliases)."""
+        return {self.var_Ma, self.var_Ea, self.var_Ta, self.var_results, self.var_capture, self.var_junk, self.var_string_char, self.var_string_byte,
+                self.var_bit_xor, self.var_table_concat, self.var_pool, self.var_pool_data,
+                self.var_numbers, self.var_profile, self.var_profile_counts, self.var_profile_start,
+                self.var_profile_decrypt, self.var_profile_dump, self.var_lazy, self.var_lazy_load,
+                *(alias for alias, value in self._hoisted_globals)}
+
+    def _shorten_names(self, tokens, header_size):
+        """
+        Renames the variables the obfuscator introduced (header locals, hoisted
+        global aliases, dispatcher states) to the shortest identifiers the output
+        does not use anywhere, the most frequent first; tokens[:header_size] is
+        the header. Field names (a.Ma) are left alone. A name that also appears
+        where it could be a table key ({Ma = 1}) is not renamed at all, nor is a
+        local of Ea() the code after the header uses (it may be a global there).
+        """
+        generated = {*self._header_names(), *HEADER_LOCALS, *self._dispatch_vars}
+        used = set()
+        counts = {}
+        excluded = set()
+        brackets = []
+        for i, (kind, val) in enumerate(tokens):
+            if kind == 'OP':
+                if val in '([{':
+                    brackets.append(val)
+                elif val in ')]}' and brackets:
+                    brackets.pop()
+            elif kind == 'IDENT':
+                used.add(val)
+                if val in generated and not _is_field_name(tokens, i):
+                    counts[val] = counts.get(val, 0) + 1
+                    if brackets and brackets[-1] == '{' and i + 1 < len(tokens) and tokens[i + 1][1] == '=':
+                        excluded.add(val)
+                    if i >= header_size and val in HEADER_LOCALS:
+                        excluded.add(val)
+
+        renames = {}
+        fresh = (name for name in _short_identifiers() if name not in used and name not in LUA_KEYWORDS)
+        short = None
+        for name in sorted(counts, key=lambda name: (-counts[name], name)):
+            if name in excluded:
+                continue
+            short = short or next(fresh)
+            if len(short) < len(name):
+                renames[name] = short
+                short = None
+        if not renames:
+            return tokens
+        self._count('names_shortened', len(renames))
+
+        renamed = []
+        for i, token in enumerate(tokens):
+            if token[0] == 'IDENT' and token[1] in renames and not _is_field_name(tokens, i):
+                token = ('IDENT', renames[token[1]])
+            renamed.append(token)
+        return renamed
+
+    # =========================================================================
+    # INCREMENTAL MODE
+    # =========================================================================
+
+    def _source_chunks(self, source):
+        """
+        The top-level chunks of source for the chunked pipeline, as (fingerprint,
+        tokens, text) triples. In incremental mode a chunk whose raw text is
+        unchanged since the last call is not lexed or split again (tokens and
+        text are None; its result is in the cache): the chunk regions of the
+        previous source are compared from the front and from the back, and only
+        the text in between is lexed, together with the last unchanged chunk
+        before it and the first one after it. The split is trusted only if those
+        two come out of it as the same chunks as before (the edit neither joins
+        onto them nor swallows them, say with an unfinished long comment);
+        otherwise the whole source is lexed again.
+        """
+        chunks = None
+        if self.incremental and self._chunk_regions is not None:
+            chunks, regions = self._relex_changed(source, *self._chunk_regions)
+        if chunks is None:
+            chunks, regions = self._lex_chunks(source, 0, len(source))
+        self._chunk_regions = (source, regions) if self.incremental else None
+        return chunks
+
+    def _lex_chunks(self, source, start, stop):
+        """
+        Lexes and splits source[start:stop] into top-level chunks. Returns the
+        (fingerprint, tokens, text) triples and the chunk regions: (start, end,
+        fingerprint) offsets into source, each region running up to the next
+        chunk (or stop).
+        """
+        spans = LEXER.scan(source[start:stop])
+        tokens = spans.tokens()
+        bounds = self._top_level_bounds(tokens)
+        chunks = []
+        regions = []
+        for n, (first, last) in enumerate(bounds):
+            chunk = tokens[first:last]
+            text = self._reconstruct(chunk)
+            key = hashlib.sha256(text.encode('utf-8')).hexdigest()
+            chunks.append((key, chunk, text))
+            end = start + spans.starts[bounds[n + 1][0]] if n + 1 < len(bounds) else stop
+            regions.append((start + spans.starts[first], end, key))
+        return chunks, regions
+
+    def _relex_changed(self, source, old_source, old_regions):
+        """
+        _source_chunks for a source that may share leading and trailing chunks
+        with old_source. Returns (chunks, regions), or (None, None) when the
+        whole source has to be lexed.
+        """
+        cache = self._chunk_cache
+        if not old_regions or source[:old_regions[0][0]] != old_source[:old_regions[0][0]]:
+            return None, None
+        front = 0 # Unchanged chunks from the front
+        while front < len(old_regions):
+            start, end, key = old_regions[front]
+            if key not in cache or source[start:end] != old_source[start:end]:
+                break
+            front += 1
+        shift = len(source) - len(old_source)
+        front_end = old_regions[front - 1][1] if front else old_regions[0][0]
+        back = len(old_regions) # Unchanged chunks from the back: old_regions[back:]
+        while back > front:
+            start, end, key = old_regions[back - 1]
+            if start + shift < front_end or key not in cache or \
+                    source[start + shift:end + shift] != old_source[start:end]:
+                break
+            back -= 1
+        if front == len(old_regions) and shift == 0:
+            return [(key, None, None) for start, end, key in old_regions], old_regions
+
+        # Lex the changed text with one unchanged chunk on each side as a probe
+        before = front - 1 if front else None
+        after = back if back < len(old_regions) else None
+        window_start = old_regions[before][0] if before is not None else old_regions[0][0]
+        window_stop = old_regions[after][1] + shift if after is not None else len(source)
+        chunks, regions = self._lex_chunks(source, window_start, window_stop)
+        probes = (before is not None) + (after is not None)
+        if len(chunks) < probes:
+            return None, None
+        if before is not None and regions[0] != old_regions[before]:
+            return None, None
+        if after is not None:
+            start, end, key = old_regions[after]
+            if regions[-1] != (start + shift, end + shift, key):
+                return None, None
+        self._count('chunks_relexed', len(chunks) - probes)
+
+        kept_front = old_regions[:before] if before is not None else []
+        kept_back = [(start + shift, end + shift, key) for start, end, key in old_regions[back + 1:]] \
+            if after is not None else []
+        chunks = [(key, None, None) for start, end, key in kept_front] + chunks + \
+                 [(key, None, None) for start, end, key in kept_back]
+        return chunks, kept_front + regions + kept_back
+
+    def _top_level_bounds(self, tokens):
+        """
+        Splits a token stream into top-level statements: at line breaks outside
+        every block and bracket, where neither the line before continues an
+        expression nor the line after starts with anything but a name or keyword.
+        Returns the (start, end) token index range of every chunk (blank lines
+        and separating NLs left out). Doubtful breaks stay inside a chunk;
+        merging is harmless, splitting a statement is not.
+        """
+        blocks = self._parse_blocks(tokens)
+        closers = {markers[-1] for markers in blocks.values()}
+        loop_dos = {markers[0] for opener, markers in blocks.items() if tokens[opener][1] in ('while', 'for')}
+        bounds = []
+        start = None  # First token of the current chunk
+        last = None   # Last token before the current line break
+        depth = 0     # Open blocks; one never closed (cut input) stays open to the end
+        brackets = 0
+        for i, token in enumerate(tokens):
+            kind, val = token
+            if kind == 'NL':
+                if start is not None and depth == 0 and brackets == 0 and self._ends_statement(last, tokens, i):
+                    bounds.append((start, i))
+                    start = None
+                continue
+            last = token
+            if start is None:
+                start = i
+            if kind == 'KEYWORD':
+                if i in closers:
+                    depth -= 1
+                elif val in ('if', 'while', 'for', 'function', 'repeat', 'do') and i not in loop_dos:
+                    depth += 1
+            elif kind == 'OP':
+                if val in '([{':
+                    brackets += 1
+                elif val in ')]}' and brackets:
+                    brackets -= 1
+        if start is not None:
+            bounds.append((start, len(tokens)))
+        return bounds
+
+    def _ends_statement(self, last, tokens, nl_index):
+        """True if the line break at nl_index, after token last, ends a statement."""
+        last_kind, last_val = last
+        if (last_kind == 'OP' and last_val not in (')', ']', '}', ';')) or last_val in CONTINUATION_WORDS:
+            return False
+        j = nl_index + 1
+        while j < len(tokens) and tokens[j][0] == 'NL':
+            j += 1
+        if j == len(tokens):
+            return True
+        next_kind, next_val = tokens[j]
+        return next_kind in ('IDENT', 'KEYWORD') and next_val not in ('and', 'or')
+
+    def _chunk_passes(self, tokens):
+        """obfuscate() steps 2, 3 (3b) and 5-7 on one top-level chunk (it has no dispatcher)."""
+        tokens = self._process_logic_inversion(tokens)
+        tokens = self._inject_contextual_predicates(tokens)
+        if self.flatten_functions:
+            tokens = self._flatten_functions(tokens)
+        tokens = self._mangle_booleans(tokens)
+        tokens = self._mangle_numbers(tokens)
+        return self._mangle_strings(tokens)
+
+    def _transform_chunk(self, tokens):
+        """
+        Runs the per-chunk passes of incremental mode (obfuscate() steps 2, 3
+        and 5-8) on one top-level chunk and records what linking needs.
+        """
+        tokens = self._chunk_passes(tokens)
+        counts, assigned = self._global_usage(tokens, self._global_sites(tokens))
+        main_chunk_locals = self._count_main_chunk_locals(tokens)
+        crowded = self._crowded_functions(tokens) if self.hoist_globals else []
+        idents = frozenset(val for kind, val in tokens if kind == 'IDENT')
+        tokens = self._mangle_globals(tokens)
+        return _ChunkResult(tokens, counts, assigned, main_chunk_locals, crowded, idents)
+
+    def _obfuscate_incremental(self, source):
+        """
+        Incremental pipeline. Every top-level chunk is fingerprinted; unchanged
+        chunks come from the cache, changed ones go through _transform_chunk with
+        an RNG seeded from (seed, fingerprint). Linking then wraps the chunks in
+        the control flow flattening dispatcher (whose own tokens get steps 5-8),
+        decides global hoisting for the whole file, and resolves the symbolic
+        pool and global references into final tokens.
+
+        Only the text around a change is lexed again (_source_chunks). Linking,
+        resolving and assembling the output still cover the whole file, since
+        pool indices and hoisted aliases are decided for it as a whole.
+
+        With jobs the changed chunks are transformed in worker processes (see
+        _transform_parallel); without incremental=True nothing is kept in the
+        cache afterwards.
+        """
+        cache = self._chunk_cache if self.incremental else OrderedDict()
+        saved_rng = self.rng
+        self._symbolic = True
+        try:
+            keys = []
+            pending = {} # fingerprint -> (tokens, text) of the chunks to transform
+            for key, chunk, text in self._source_chunks(source):
+                keys.append(key)
+                if key in cache:
+                    cache.move_to_end(key)
+                    self._count('chunks_cached')
+                elif key in pending:
+                    self._count('chunks_cached') # Repeated within the file
+                else:
+                    if self.lazy_functions:
+                        chunk = self._mark_lazy_functions(chunk)
+                    pending[key] = (chunk, text)
+            workers = min(self.jobs, os.cpu_count() or 1) if self.jobs is not None else 1
+            if workers > 1 and sum(len(chunk) for chunk, text in pending.values()) >= PARALLEL_MIN_TOKENS:
+                cache.update(self._transform_parallel(pending, workers))
+                self._check_deadline()
+            else:
+                for key, (chunk, text) in pending.items():
+                    self._check_deadline()
+                    self.rng = random.Random(f"{self._chunk_salt}:{key}")
+                    cache[key] = self._transform_chunk(chunk)
+            self._count('chunks_transformed', len(pending))
+            results = [cache[key] for key in keys]
+            while len(cache) > CHUNK_CACHE_SIZE:
+                cache.popitem(last=False)
+
+            # The dispatcher around a placeholder for the linked chunks
+            self.rng = random.Random(f"{self._chunk_salt}:link")
+            scaffold = self._prepend_junk_library(self._apply_control_flow_flattening([('LINK', None)]))
+            scaffold = self._mangle_booleans(scaffold)
+            scaffold = self._mangle_numbers(scaffold)
+            scaffold = self._mangle_strings(scaffold)
+            scaffold_usage = self._global_usage(scaffold, self._global_sites(scaffold))
+            scaffold = self._mangle_globals(scaffold)
+            self._symbolic = False
+
+            self._hoisted_globals = []
+            aliases = {}
+            if self.hoist_globals:
+                counts, assigned = dict(scaffold_usage[0]), set(scaffold_usage[1])
+                used = set()
+                main_chunk_locals = 0
+                crowded = []
+                for result in results:
+                    for name, count in result.global_counts.items():
+                        counts[name] = counts.get(name, 0) + count
+                    assigned |= result.assigned_globals
+                    used |= result.idents
+                    main_chunk_locals += result.main_chunk_locals
+                    crowded.extend(result.crowded_functions)
+                used.update(val for kind, val in scaffold if kind == 'IDENT')
+                aliases = self._choose_hoisted_globals(counts, assigned, main_chunk_locals, used, crowded)
+                self._count('globals_hoisted', len(aliases))
+
+            linked = []
+            for token in scaffold:
+                if token[0] != 'LINK':
+                    linked.append(token)
+                    continue
+                for n, result in enumerate(results):
+                    if n:
+                        linked.append(NL_TOKEN)
+                    if self.cff_dispatch == 'table':
+                        linked.extend(self._route_main_returns(result.tokens))
+                    else:
+                        linked.extend(result.tokens)
+            return self._resolve_symbols(linked, aliases)
+        finally:
+            self._symbolic = False
+            self.rng = saved_rng
+
+    def _transform_parallel(self, pending, workers):
+        """
+        Transforms the pending chunks ({fingerprint: (tokens, text)}) in a pool of
+        workers processes, as contiguous batches of about equal token counts.
+        Workers get the chunk text and re-lex it, which is cheaper to send than
+        tokens and spreads the lexing too. Every chunk is transformed with the
+        RNG it would get in-process, so the result does not depend on the
+        number of jobs. Returns {fingerprint: _ChunkResult}.
+        """
+        total = sum(len(chunk) for chunk, text in pending.values())
+        batch_size = total / (workers * PARALLEL_BATCHES_PER_JOB)
+        batches = [[]]
+        size = 0
+        for key, (chunk, text) in pending.items():
+            if size >= batch_size:
+                batches.append([])
+                size = 0
+            batches[-1].append((key, text))
+            size += len(chunk)
+
+        work = [(self._options, self._chunk_salt, batch) for batch in batches]
+        with ProcessPoolExecutor(max_workers=min(workers, len(work)), initializer=_warm_worker) as executor:
+            outputs = list(executor.map(_chunk_job, work))
+
+        transformed = {}
+        for results, dispatch_vars, counts, functions in outputs:
+            transformed.update(results)
+            self._dispatch_vars |= dispatch_vars
+            for name, n in counts.items():
+                self._count(name, n)
+            if self.stats is not None:
+                self.stats.functions.extend(functions)
+        self._count('parallel_batches', len(work))
+        return transformed
+
+    def _transform_batch(self, salt, batch):
+        """
+        Worker side of _transform_parallel: [(fingerprint, chunk text)] ->
+        ({fingerprint: _ChunkResult}, dispatcher states, transform counts,
+        flattening reports), with the parent's salt and junk library.
+        """
+        self._chunk_salt = salt
+        self._build_junk_library(random.Random(f"{salt}:library"))
+        self._symbolic = True
+        self._counts = {}
+        self.stats = ObfuscationStats() if self.profile else None
+        results = {}
+        for key, text in batch:
+            self.rng = random.Random(f"{salt}:{key}")
+            tokens = self._tokenize(text)
+            if self.lazy_functions:
+                tokens = self._mark_lazy_functions(tokens)
+            results[key] = self._transform_chunk(tokens)
+        return results, self._dispatch_vars, self._counts, self.stats.functions if self.stats is not None else []
+
+    def _resolve_symbols(self, tokens, aliases):
+        """
+        Link step of incremental mode: GLOBALREF tokens become their hoisted
+        alias or their Ma[...] lookup, NUMREF tokens constant table lookups,
+        then POOLREF tokens get pool indices (in order of first use) and the
+        pool is encrypted in one batch.
+        """
+        expanded = []
+        for token in tokens:
+            if token[0] == 'GLOBALREF':
+                name, lookup = token[1]
+                alias = aliases.get(name)
+                if alias is not None:
+                    expanded.append(('IDENT', alias))
+                else:
+                    expanded.extend(lookup)
+            elif token[0] == 'NUMREF':
+                num_str, value = token[1]
+                expanded.extend(self._number_reference(num_str, value) or [('NUMBER', num_str)])
+            else:
+                expanded.append(token)
+        if self.string_pool is None:
+            return expanded
+
+        literals = [token[1] for token in expanded if token[0] == 'POOLREF']
+        replacements = iter(self._encrypt_literals(literals))
+        resolved = []
+        for token in expanded:
+            if token[0] == 'POOLREF':
+                resolved.extend(next(replacements))
+            else:
+                resolved.append(token)
+        return resolved
+
+    # =========================================================================
+    # STREAMING
+    # =========================================================================
+
+    def obfuscate_stream(self, reader, writer):
+        """
+        Obfuscates Lua read from reader (a text file object, or any iterable of
+        str pieces) and writes the result to writer (anything with .write(str))
+        as it goes, so memory stays bounded by the largest top-level statement
+        rather than the input size.
+
+        The header and the dispatcher prologue are written first, then every
+        top-level chunk as soon as it is complete (obfuscate() steps 2, 3, 5-8
+        per chunk), then the dispatcher epilogue. Pooled strings are appended to
+        the pool right before the first chunk using them. hoist_globals is not
+        applied: choosing the aliases needs the whole file. For the same reason
+        minify=True does not rename variables here.
+        """
+        if self.instrument:
+            raise ValueError("instrument=True needs the whole file at once; use obfuscate()")
+        self._start_guard()
+        if self.seed is not None:
+            self.rng.seed(self.seed)
+        self._pool_index = {}
+        self._pool_entries = []
+        self._number_index = {}
+        self._number_entries = None # The header is out before any literal is seen
+        self._dispatch_vars = set()
+        self._hoisted_globals = []
+        self._lazy_ids = 0
+        self._build_junk_library(self.rng)
+        self.stats = ObfuscationStats() if self.profile else None
+        started = time.perf_counter()
+        self._counts = {}
+        hoist_globals = self.hoist_globals
+        self.hoist_globals = 0
+        try:
+            # The dispatcher around a placeholder for the streamed chunks
+            scaffold = self._prepend_junk_library(self._apply_control_flow_flattening([('LINK', None)]))
+            scaffold = self._mangle_booleans(scaffold)
+            scaffold = self._mangle_numbers(scaffold)
+            scaffold = self._mangle_strings(scaffold)
+            scaffold = self._mangle_globals(scaffold)
+            link = next(i for i, token in enumerate(scaffold) if token[0] == 'LINK')
+
+            prologue = self._minify_text(self._generate_header() + "\n", scaffold[:link])
+            written = _write_text(writer, (BANNER if self.minify else "") + prologue + "\n")
+            for chunk in self._stream_chunks(reader):
+                self._check_deadline()
+                pooled = len(self._pool_entries)
+                if self.lazy_functions:
+                    chunk = self._mark_lazy_functions(chunk)
+                tokens = self._mangle_globals(self._chunk_passes(chunk))
+                if self.lazy_functions:
+                    tokens = self._emit_lazy_stubs(tokens)
+                if self.cff_dispatch == 'table':
+                    tokens = self._route_main_returns(tokens)
+                written += _write_text(writer, self._minify_text(self._generate_pool_additions(pooled), tokens) + "\n")
+            written += _write_text(writer, self._minify_text("", scaffold[link + 1:]))
+        finally:
+            self.hoist_globals = hoist_globals
+
+        if self.stats is not None:
+            self.stats.output_size = written
+            self.stats.seconds = time.perf_counter() - started
+            self.stats.passes.append(PassStats(name='stream', seconds=self.stats.seconds, input_size=self.stats.input_size,
+                                               output_size=written, tokens=0, transforms=dict(self._counts)))
+
+    def _stream_chunks(self, reader):
+        """
+        Yields the tokens of every top-level chunk of the text read from reader.
+
+        Only the unfinished tail is lexed again after each read: the last chunk
+        in the window is held back, since it may continue in the next block (a
+        cut name, an UNFINISHED string or comment, an open block). The read
+        size grows with the tail so a huge statement is not re-lexed per block.
+        """
+        tail = ""
+        pending = []
+        pending_size = 0
+        received = 0
+        for block in _stream_blocks(reader, STREAM_BLOCK_SIZE):
+            received += len(block)
+            self._check_input_size(received)
+            if self.stats is not None:
+                self.stats.input_size += len(block)
+            pending.append(block)
+            pending_size += len(block)
+            if pending_size < max(STREAM_BLOCK_SIZE, len(tail)):
+                continue
+            window = tail + "".join(pending)
+            pending = []
+            pending_size = 0
+            spans = LEXER.scan(window)
+            tokens = spans.tokens()
+            bounds = self._top_level_bounds(tokens)
+            if len(bounds) < 2:
+                tail = window
+                continue
+            for start, end in bounds[:-1]:
+                yield tokens[start:end]
+            cut = spans.starts[bounds[-1][0]]
+            tail = window[cut:]
+
+        window = tail + "".join(pending)
+        tokens = self._tokenize(window)
+        for start, end in self._top_level_bounds(tokens):
+            yield tokens[start:end]
+
+    def _generate_pool_additions(self, first):
+        """Lua adding pool entries first.. to the streamed pool (string pool mode only)."""
+        new_entries = self._pool_entries[first:]
+        if not new_entries:
+            return ""
+        pool, pool_data = self.var_pool, self.var_pool_data
+        lines = []
+        for index, (encrypted, key) in enumerate(new_entries, first + 1):
+            if self.string_pool == 'eager':
+                lines.append(f"{pool}[{index}]={self.var_Ea}('{encrypted}','{key}')\n")
+            else:
+                lines.append(f"{pool_data}[{2 * index - 1}],{pool_data}[{2 * index}]='{encrypted}','{key}'\n")
+        return "".join(lines)
+
+# =========================================================================
+# PROFILE REPORTS
+# =========================================================================
+
+def profile_report(dump, symbol_map, top=None):
+    """
+    Ranks the counted sites of a profile build (WabiSabiObfuscator(instrument=True))
+    by how often they ran, so the hottest injected constructs stand out.
+
+    dump:       the text WabiSabiProfile() returned, or any captured output it was
+                printed into (only the WSPROF lines are read; of several dumps,
+                the last one counts).
+    symbol_map: the obfuscator's symbol_map, or that list loaded back from JSON.
+    top:        keep only the top hottest sites.
+
+    Returns {"clock": seconds since load, "decrypt_seconds": seconds in Ea(),
+    "by_kind": runs per site kind, "sites": [...]}, every site being its symbol
+    map entry plus its "count" and "share" of all counted runs, hottest first.
+    Sites that never ran are left out.
+    """
+    sites = {entry["id"]: entry for entry in symbol_map}
+    clock = decrypt_seconds = None
+    counts = {}
+    for line in dump.splitlines():
+        fields = line.split()
+        if len(fields) < 3 or fields[0] != PROFILE_LINE_PREFIX:
+            continue
+        if fields[1] == "clock":
+            # A new dump: the counters are cumulative, so it replaces the previous one
+            clock, decrypt_seconds = float(fields[2]), float(fields[4])
+            counts = {}
+        else:
+            counts[int(float(fields[1]))] = int(float(fields[2]))
+
+    total = sum(counts.values())
+    by_kind = {}
+    ranked = []
+    for site_id, count in sorted(counts.items(), key=lambda item: (-item[1], item[0])):
+        entry = sites.get(site_id, {"id": site_id, "kind": "unknown", "line": None, "detail": ""})
+        by_kind[entry["kind"]] = by_kind.get(entry["kind"], 0) + count
+        ranked.append({**entry, "count": count, "share": count / total})
+    return {"clock": clock, "decrypt_seconds": decrypt_seconds, "by_kind": by_kind,
+            "sites": ranked[:top] if top is not None else ranked}
+
+# =========================================================================
+# BATCH MODE
+# =========================================================================
+
+_tool_hash = None
+
+def _get_tool_hash():
+    """Hash of this file, so cached outputs are invalidated when the obfuscator changes."""
+    global _tool_hash
+    if _tool_hash is None:
+        with open(os.path.abspath(__file__), "rb") as f:
+            _tool_hash = hashlib.sha256(f.read()).hexdigest()
+    return _tool_hash
+
+def _cache_key(source, options):
+    """Cache key: tool version + obfuscator options (including the seed) + source hash."""
+    h = hashlib.sha256()
+    h.update(_get_tool_hash().encode())
+    # The input guards decide whether there is an output, never what it is
+    options = {name: value for name, value in options.items() if name not in ('max_input_size', 'time_limit')}
+    h.update(json.dumps(options, sort_keys=True, default=sorted).encode())
+    h.update(hashlib.sha256(source.encode("utf-8")).digest())
+    return h.hexdigest()
+
+def _cache_path(cache_dir, key):
+    return os.path.join(cache_dir, key[:2], key + ".lua")
+
+def _read_cache(cache_dir, key):
+    try:
+        with open(_cache_path(cache_dir, key), "r", encoding="utf-8") as f:
+            return f.read()
+    except OSError:
+        return None
+
+def _write_cache(cache_dir, key, output):
+    path = _cache_path(cache_dir, key)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # Write then rename, so a crashed build never leaves a truncated entry behind
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(output)
+    os.replace(tmp_path, path)
+
+def _obfuscate_job(job):
+    """Process pool entry point: (source, options, profile) -> (obfuscated source, stats dict or None)."""
+    source, options, profile = job
+    obfuscator = WabiSabiObfuscator(profile=profile, **options)
+    output = obfuscator.obfuscate(source)
+    return output, obfuscator.stats.to_dict() if profile else None
+
+def _chunk_job(job):
+    """Process pool entry point of WabiSabiObfuscator(jobs=n): (options, salt, batch) -> _transform_batch()."""
+    options, salt, batch = job
+    return WabiSabiObfuscator(**options)._transform_batch(salt, batch)
+
+def obfuscate_many(paths, jobs=None, cache_dir=None, stats=None, **options):
+    """
+    Obfuscates many files, spreading them across a process pool.
+
+    paths:     Lua files to obfuscate.
+    jobs:      Worker processes (default: CPU count). 1 runs everything in-process.
+    cache_dir: Optional on-disk cache. Files whose source and options are unchanged
+               since the last run are served from it without being obfuscated again.
+    stats:     Optional list; filled with one ObfuscationStats dict per file
+               (None for files served from the cache).
+    options:   Passed to WabiSabiObfuscator(...) for every file.
+
+    Returns the obfuscated sources, in the same order as paths.
+    """
+    sources = []
+    for path in paths:
+        with open(path, "r", encoding="utf-8") as f:
+            sources.append(f.read())
+
+    results = [None] * len(sources)
+    keys = [None] * len(sources)
+    pending = []
+    for i, source in enumerate(sources):
+        if cache_dir is not None:
+            keys[i] = _cache_key(source, options)
+            results[i] = _read_cache(cache_dir, keys[i])
+        if results[i] is None:
+            pending.append(i)
+
+    profile = stats is not None
+    if profile:
+        stats[:] = [None] * len(sources)
+    work = [(sources[i], options, profile) for i in pending]
+    if jobs is None:
+        jobs = os.cpu_count() or 1
+    jobs = min(jobs, len(work))
+    if jobs <= 1:
+        outputs = map(_obfuscate_job, work)
+    else:
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            outputs = list(executor.map(_obfuscate_job, work, chunksize=max(1, len(work) // (jobs * 4))))
+
+    for i, (output, file_stats) in zip(pending, outputs):
+        results[i] = output
+        if profile:
+            stats[i] = file_stats
+        if cache_dir is not None:
+            _write_cache(cache_dir, keys[i], output)
+
+    return results
+
+def _collect_lua_files(inputs):
+    """Expands files and directories (recursively, *.lua) into (path, relative output path) pairs."""
+    files = []
+    for item in inputs:
+        if os.path.isdir(item):
+            for root, dirs, names in os.walk(item):
+                dirs.sort()
+                for name in sorted(names):
+                    if name.endswith(".lua"):
+                        path = os.path.join(root, name)
+                        files.append((path, os.path.relpath(path, item)))
+        else:
+            files.append((item, os.path.basename(item)))
+    return files
+
+def _write_stats_json(path, data):
+    text = json.dumps(data, indent=2)
+    if path == "-":
+        print(text)
+    else:
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(text)
+
+# =========================================================================
+# DAEMON MODE
+# =========================================================================
+
+_warm_obfuscators = {}
+
+def _warm_worker():
+    """Process pool initializer: compiles the lexer and lexes the templates up front."""
+    LEXER._compiled()
+    for template in (*JUNK_TEMPLATES, *(template for template, _ in PREDICATE_TEMPLATES)):
+        template.render(a='a', b='b', n=1, m=1)
+
+def _daemon_job(job):
+    """
+    Worker side of a daemon request: (source, options) -> (output, stats dict).
+    Obfuscators are kept per options, so e.g. incremental=True caches stay warm
+    across requests reaching the same worker.
+    """
+    source, options = job
+    key = json.dumps(options, sort_keys=True)
+    obfuscator = _warm_obfuscators.get(key)
+    if obfuscator is None:
+        if len(_warm_obfuscators) >= DAEMON_MAX_OBFUSCATORS:
+            _warm_obfuscators.clear()
+        obfuscator = _warm_obfuscators[key] = WabiSabiObfuscator(profile=True, **options)
+    output = obfuscator.obfuscate(source)
+    return output, obfuscator.stats.to_dict()
+
+class _DaemonHandler(BaseHTTPRequestHandler):
+    """
+    POST /obfuscate  {"source": "...", "options": {...}}  ->  {"output": "...", "stats": {...}}
+    GET  /health     ->  {"status": "ok", "workers": n, "pending": k}
+
+    Bad requests (invalid JSON, options or Content-Length, or any of
+    DAEMON_RESERVED_OPTIONS) get 400. When every queue slot is
+    taken the job is refused with 503 and Retry-After instead of piling up.
+    """
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        if self.path != "/health":
+            return self._reply(404, {"error": "not found"})
+        daemon = self.server.daemon_state
+        self._reply(200, {"status": "ok", "workers": daemon.workers, "pending": daemon.pending})
+
+    def do_POST(self):
+        if self.path != "/obfuscate":
+            return self._reply(404, {"error": "not found"})
+        try:
+            length = int(self.headers.get("Content-Length") or 0)
+            if length < 0:
+                raise ValueError("negative Content-Length")
+            if length > DAEMON_MAX_REQUEST_BYTES:
+                return self._reply(413, {"error": "request too large"})
+            request = json.loads(self.rfile.read(length))
+            source = request["source"]
+            options = request.get("options") or {}
+            if not isinstance(source, str) or not isinstance(options, dict):
+                raise TypeError("source must be a string and options an object")
+            reserved = sorted(set(options) & set(DAEMON_RESERVED_OPTIONS))
+            if reserved:
+                raise ValueError(f"options {reserved} are set by the daemon")
+            WabiSabiObfuscator(**options) # Reject bad options here, not in a worker
+        except (ValueError, TypeError, KeyError) as e:
+            return self._reply(400, {"error": f"bad request: {e}"})
+
+        daemon = self.server.daemon_state
+        if not daemon.slots.acquire(blocking=False):
+            return self._reply(503, {"error": "busy"}, {"Retry-After": "1"})
+        try:
+            with daemon.lock:
+                daemon.pending += 1
+            output, stats = daemon.executor.submit(_daemon_job, (source, options)).result()
+        except Exception as e:
+            return self._reply(500, {"error": f"{type(e).__name__}: {e}"})
+        finally:
+            with daemon.lock:
+                daemon.pending -= 1
+            daemon.slots.release()
+        self._reply(200, {"output": output, "stats": stats})
+
+    def _reply(self, status, payload, headers=None):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass # One line per request would drown the build output
+
+class _DaemonState:
+    """Shared by all request threads: the warm pool and the queue slots."""
+    def __init__(self, workers):
+        self.workers = workers
+        self.executor = ProcessPoolExecutor(max_workers=workers, initializer=_warm_worker)
+        self.slots = threading.BoundedSemaphore(workers * DAEMON_QUEUE_PER_WORKER)
+        self.lock = threading.Lock()
+        self.pending = 0
+
+def serve(host="127.0.0.1", port=8765, jobs=None):
+    """
+    Runs the obfuscation daemon on host:port until interrupted. Workers are
+    started and warmed once, so a request only pays for the obfuscation itself.
+    Listens on localhost by default; the API has no authentication.
+    """
+    workers = jobs or os.cpu_count() or 1
+    daemon = _DaemonState(workers)
+    # Start every worker now rather than on the first requests
+    for future in [daemon.executor.submit(_daemon_job, ("", {})) for _ in range(workers)]:
+        future.result()
+    server = ThreadingHTTPServer((host, port), _DaemonHandler)
+    server.daemon_state = daemon
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        daemon.executor.shutdown()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Wabi Sabi Lua obfuscator")
+    parser.add_argument("inputs", nargs="*", help="Lua files or directories (default: input.lua -> output.lua)")
+    parser.add_argument("-o", "--out-dir", default="obfuscated", help="Output directory for batch mode")
+    parser.add_argument("-j", "--jobs", type=int, default=None,
+                        help="Worker processes (default: CPU count); without inputs, input.lua is split over them")
+    parser.add_argument("--cache-dir", default=None, help="Reuse outputs of unchanged files from this directory")
+    parser.add_argument("--seed", type=int, default=None, help="Seed for reproducible output")
+    parser.add_argument("--string-pool", choices=[mode for mode in STRING_POOL_MODES if mode],
+                        default=None, help="Encrypt each distinct string once into a constant pool")
+    parser.add_argument("--hoist-globals", action="store_true", help="Resolve globals once into local aliases")
+    parser.add_argument("--cff-dispatch", choices=CFF_DISPATCH_MODES, default=None,
+                        help="Control-flow dispatcher: if/elseif ladder or closure table")
+    parser.add_argument("--no-cff-yield", action="store_true", help="Do not wait() after each dispatcher step")
+    parser.add_argument("--loop-budget", default=None,
+                        help="Comma-separated transform rates per loop depth, e.g. 1,0.25,0")
+    parser.add_argument("--target-runtime", choices=TARGET_RUNTIMES, default=None,
+                        help="Runtime the output is for; picks the XOR used by string decryption")
+    parser.add_argument("--flatten-functions", type=int, default=None, metavar="N",
+                        help="Flatten function bodies into dispatched basic blocks of N statements")
+    parser.add_argument("--lazy-functions", type=int, nargs="?", const=LAZY_FUNCTION_MIN_TOKENS, default=None,
+                        metavar="MIN_TOKENS",
+                        help=f"Compile function bodies of at least MIN_TOKENS tokens (default "
+                             f"{LAZY_FUNCTION_MIN_TOKENS}) on first call instead of at load time")
+    parser.add_argument("--minify", action="store_true",
+                        help="Minify the output: no line breaks, shortest escapes and names")
+    parser.add_argument("--instrument", action="store_true",
+                        help="Emit a profile build with runtime counters; its symbol map goes to output.map.json")
+    parser.add_argument("--max-input-size", type=int, default=None, metavar="CHARS",
+                        help="Refuse input files longer than this many characters")
+    parser.add_argument("--time-limit", type=float, default=None, metavar="SECONDS",
+                        help="Stop obfuscating a file that takes longer than this (TimeoutError)")
+    parser.add_argument("--profile-report", nargs=2, default=None, metavar=("DUMP", "MAP"),
+                        help="Rank the sites of a profile build by the counters it printed (DUMP) and exit")
+    parser.add_argument("--stream", action="store_true",
+                        help="Obfuscate each file in bounded memory, writing output as it goes (no cache, one process)")
+    parser.add_argument("--serve", default=None, metavar="[HOST:]PORT",
+                        help="Run as a localhost HTTP daemon with -j warm workers (POST /obfuscate)")
+    parser.add_argument("--stats-json", default=None, metavar="PATH",
+                        help="Write per-pass timing, size and transform counts as JSON ('-' for stdout)")
+    args = parser.parse_args(argv)
+
+    if args.serve is not None:
+        host, _, port = args.serve.rpartition(":")
+        print(f"Serving on http://{host or '127.0.0.1'}:{port} (Ctrl+C to stop)", flush=True)
+        serve(host or "127.0.0.1", int(port), jobs=args.jobs)
+        return
+
+    if args.profile_report is not None:
+        dump_path, map_path = args.profile_report
+        with open(dump_path, "r", encoding="utf-8") as f:
+            dump = f.read()
+        with open(map_path, "r", encoding="utf-8") as f:
+            symbol_map = json.load(f)
+        report = profile_report(dump, symbol_map, top=30)
+        if report["clock"] is None:
+            print(f"No {PROFILE_LINE_PREFIX} lines in {dump_path}", file=sys.stderr)
+            sys.exit(1)
+        print(f"{report['clock']:.3f}s since load, {report['decrypt_seconds']:.3f}s in Ea()")
+        for kind, count in sorted(report["by_kind"].items(), key=lambda item: -item[1]):
+            print(f"{kind:>10}: {count}")
+        for site in report["sites"]:
+            line = site["line"] if site["line"] is not None else "-"
+            print(f"{site['count']:>10} {site['share']:6.1%}  {site['kind']:<9} line {line:<6} {site['detail']}")
+        return
+
+    if args.instrument and (args.inputs or args.stream):
+        parser.error("--instrument writes one symbol map; use it without input paths (input.lua -> output.lua)")
+
+    # Keep stdout clean for the JSON report when it goes there
+    status_out = sys.stderr if args.stats_json == "-" else sys.stdout
+
+    options = {}
+    if args.seed is not None:
+        options["seed"] = args.seed
+    if args.string_pool is not None:
+        options["string_pool"] = args.string_pool
+    if args.hoist_globals:
+        options["hoist_globals"] = True
+    if args.cff_dispatch is not None:
+        options["cff_dispatch"] = args.cff_dispatch
+    if args.no_cff_yield:
+        options["cff_yield"] = False
+    if args.loop_budget is not None:
+        options["loop_budget"] = [float(rate) for rate in args.loop_budget.split(",")]
+    if args.target_runtime is not None:
+        options["target_runtime"] = args.target_runtime
+    if args.flatten_functions is not None:
+        options["flatten_functions"] = args.flatten_functions
+    if args.minify:
+        options["minify"] = True
+    if args.lazy_functions is not None:
+        options["lazy_functions"] = args.lazy_functions
+    if args.instrument:
+        options["instrument"] = True
+    if args.max_input_size is not None:
+        options["max_input_size"] = args.max_input_size
+    if args.time_limit is not None:
+        options["time_limit"] = args.time_limit
+
+    if args.inputs:
+        files = _collect_lua_files(args.inputs)
+        file_stats = [] if args.stats_json else None
+        if args.stream:
+            for path, rel_path in files:
+                out_path = os.path.join(args.out_dir, rel_path)
+                os.makedirs(os.path.dirname(out_path) or ".", exist_ok=True)
+                obfuscator = WabiSabiObfuscator(profile=bool(args.stats_json), **options)
+                with open(path, "r", encoding="utf-8") as reader, open(out_path, "w", encoding="utf-8") as writer:
+                    obfuscator.obfuscate_stream(reader, writer)
+                if file_stats is not None:
+                    file_stats.append(obfuscator.stats.to_dict())
+            if args.stats_json:
+                _write_stats_json(args.stats_json, {path: entry for (path, _), entry in zip(files, file_stats)})
+            print(f"Obfuscation Complete! Saved {len(files)} file(s) to {args.out_dir}", file=status_out)
+            return
+        outputs = obfuscate_many([path for path, _ in files], jobs=args.jobs, cache_dir=args.cache_dir,
+                                 stats=file_stats, **options)
+        for (_, rel_path), protected in zip(files, outputs):
+            out_path = os.path.join(args.out_dir, rel_path)
+            os.makedirs(os.path.dirname(out_path) or ".", exist_ok=True)
+            with open(out_path, "w", encoding="utf-8") as f:
+                f.write(protected)
+        if args.stats_json:
+            _write_stats_json(args.stats_json, {path: entry for (path, _), entry in zip(files, file_stats)})
+        print(f"Obfuscation Complete! Saved {len(files)} file(s) to {args.out_dir}", file=status_out)
+        return
+
     input_code = """
     print("Initializing Matcha Script...")
     local LocalPlayer = game:GetService("Players").LocalPlayer
@@ -639,10 +4005,21 @@ if __name__ == "__main__":
     except:
         pass
 
-    obfuscator = WabiSabiObfuscator()
+    obfuscator = WabiSabiObfuscator(profile=bool(args.stats_json), jobs=args.jobs, **options)
     protected = obfuscator.obfuscate(input_code)
     
     with open("output.lua", "w") as f:
         f.write(protected)
+
+    if obfuscator.symbol_map is not None:
+        with open("output.map.json", "w", encoding="utf-8") as f:
+            json.dump(obfuscator.symbol_map, f, indent=2)
+
+    if args.stats_json:
+        _write_stats_json(args.stats_json, obfuscator.stats.to_dict())
     
-    print("Obfuscation Complete! Saved to output.lua")
+    print("Obfuscation Complete! Saved to output.lua", file=status_out)
+
+# --- Usage ---
+if __name__ == "__main__":
+    main()
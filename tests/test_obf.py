@@ -0,0 +1,446 @@
+"""
+Regression tests for WabiSabiObfuscator. The Lua checks run the original and
+the obfuscated script side by side in lupa and compare what they print.
+"""
+import http.client
+import io
+import json
+import os
+import sys
+import threading
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+import obf
+from obf import JUNK_LIBRARY_SIZE, WabiSabiObfuscator, profile_report, _DaemonHandler, _DaemonState, ThreadingHTTPServer
+
+
+def run_lua(source, version='lua51', prelude=''):
+    """
+    Runs source in a fresh lupa runtime (after the Lua in prelude); returns its
+    printed lines and the types it returned.
+    """
+    lupa = pytest.importorskip('lupa.' + version)
+    runtime = lupa.LuaRuntime(unpack_returned_tuples=True)
+    printed = []
+    runtime.globals().print = lambda *args: printed.append(
+        '\t'.join(runtime.globals().tostring(arg) for arg in args))
+    runtime.execute('wait = function() end ' + prelude)
+    run = runtime.eval('function(s) local function pack(...) return {n = select("#", ...), ...} end '
+                       'return pack(assert((loadstring or load)(s))()) end')
+    results = run(source)
+    return printed, [runtime.globals().type(results[i + 1]) for i in range(results.n)]
+
+
+EARLY_RETURN = """
+print("start")
+local cfg = nil
+if not cfg then
+    print("no config, bailing")
+    return
+end
+print("unreachable")
+"""
+
+MODULE_RETURN = """
+local M = {}
+function M.twice(x) return x * 2 end
+print(M.twice(21))
+if M then return M, select('#', ...), nil end
+print("unreachable")
+"""
+
+
+@pytest.mark.parametrize('dispatch', ['ladder', 'table'])
+@pytest.mark.parametrize('mode', ['whole', 'incremental', 'stream'])
+def test_top_level_return(dispatch, mode):
+    for source in (EARLY_RETURN, MODULE_RETURN):
+        expected = run_lua(source)
+        obfuscator = WabiSabiObfuscator(seed=1, cff_dispatch=dispatch, incremental=(mode == 'incremental'))
+        if mode == 'stream':
+            out = io.StringIO()
+            obfuscator.obfuscate_stream([source], out)
+            obfuscated = out.getvalue()
+        else:
+            obfuscated = obfuscator.obfuscate(source)
+        got = run_lua(obfuscated)
+        assert got == expected
+        assert 'unreachable' not in got[0]
+
+
+def crowded_function_source():
+    """35 outer locals and 30 virtualized globals read by one function: 65 upvalues if all were hoisted."""
+    common = [name for name in sorted(WabiSabiObfuscator().global_targets) if name.islower()][:30]
+    lines = [f"local u{n} = {n}" for n in range(35)]
+    lines.append("local function f()")
+    lines.append("    local s, c = " + " + ".join(f"u{n}" for n in range(35)) + ", 0")
+    lines.extend(f"    if {name} ~= nil then c = c + 1 end" for name in common)
+    lines.append("    print(s, c)")
+    lines.append("end")
+    lines.append("f()")
+    return "\n".join(lines)
+
+
+@pytest.mark.parametrize('incremental', [False, True])
+def test_hoisting_respects_upvalue_limit(incremental):
+    source = crowded_function_source()
+    expected = run_lua(source)
+    obfuscated = WabiSabiObfuscator(seed=1, hoist_globals=True, incremental=incremental).obfuscate(source)
+    assert run_lua(obfuscated) == expected
+
+
+GUARDED_SOURCE = "local t = {}\nfor i = 1, 10 do t[i] = i * 2 end\nprint(#t)\n" * 200
+
+
+@pytest.mark.parametrize('mode', ['whole', 'incremental', 'stream'])
+def test_max_input_size(mode):
+    obfuscator = WabiSabiObfuscator(seed=1, max_input_size=len(GUARDED_SOURCE) - 1,
+                                    incremental=(mode == 'incremental'))
+    with pytest.raises(ValueError, match='max_input_size'):
+        if mode == 'stream':
+            obfuscator.obfuscate_stream([GUARDED_SOURCE], io.StringIO())
+        else:
+            obfuscator.obfuscate(GUARDED_SOURCE)
+    assert WabiSabiObfuscator(seed=1, max_input_size=len(GUARDED_SOURCE)).obfuscate(GUARDED_SOURCE)
+
+
+@pytest.mark.parametrize('mode', ['whole', 'incremental', 'stream'])
+def test_time_limit(mode):
+    obfuscator = WabiSabiObfuscator(seed=1, time_limit=1e-9, incremental=(mode == 'incremental'))
+    with pytest.raises(TimeoutError, match='time_limit'):
+        if mode == 'stream':
+            obfuscator.obfuscate_stream([GUARDED_SOURCE], io.StringIO())
+        else:
+            obfuscator.obfuscate(GUARDED_SOURCE)
+    assert WabiSabiObfuscator(seed=1, time_limit=60).obfuscate(GUARDED_SOURCE)
+
+
+@pytest.mark.parametrize('options', [{'max_input_size': -1}, {'time_limit': 0}])
+def test_guard_options_are_validated(options):
+    with pytest.raises(ValueError):
+        WabiSabiObfuscator(**options)
+
+
+METHOD_NAMES = """
+local obj = {n = 0}
+function obj:print(x) self.n = self.n + 1 print("method print", x, self.n) end
+function obj:wait() print("method wait", self.n) return self end
+obj:print(5)
+obj:wait():print(6)
+print(obj.print == obj["print"], type(wait))
+"""
+
+
+@pytest.mark.parametrize('options', [{}, {'hoist_globals': True}, {'incremental': True}])
+def test_method_names_are_not_globals(options):
+    expected = run_lua(METHOD_NAMES)
+    assert run_lua(WabiSabiObfuscator(seed=1, **options).obfuscate(METHOD_NAMES)) == expected
+
+
+POOLED_STRINGS = r"""
+local greeting = "hello"
+local again = 'hello'
+local escaped = "tab\there \"quoted\" back\\slash\nnew line \65\066\0067 \0 nul"
+local long = [[long
+bracket "string"]]
+for i = 1, 3 do print(greeting .. i, again == greeting) end
+print(escaped, #escaped, escaped:byte(-1))
+print(long, ("hello"):upper(), "" == '')
+"""
+
+
+@pytest.mark.parametrize('pool', ['lazy', 'eager'])
+@pytest.mark.parametrize('options', [{}, {'incremental': True}])
+def test_string_pool(pool, options):
+    expected = run_lua(POOLED_STRINGS)
+    obfuscator = WabiSabiObfuscator(seed=1, string_pool=pool, **options)
+    obfuscated = obfuscator.obfuscate(POOLED_STRINGS)
+    assert run_lua(obfuscated) == expected
+    assert '"hello"' not in obfuscated and "'hello'" not in obfuscated
+    # Repeated literals share one pool entry
+    assert len(obfuscator._pool_entries) == len(obfuscator._pool_index)
+
+
+NESTED_IFS = """
+local function classify(x)
+    if x < 0 then
+        return "negative"
+    elseif x == 0 then
+        return "zero"
+    elseif x < 10 then
+        if x % 2 == 0 then return "small even" else return "small odd" end
+    else
+        return "large"
+    end
+end
+local hits = 0
+for i = -2, 12, 3 do
+    local j = 0
+    while j < 2 do
+        if i > 0 then
+            if j == 1 then hits = hits + 1 end
+        end
+        j = j + 1
+    end
+    repeat
+        if hits > 3 then hits = hits - 1 end
+    until true
+    print(i, classify(i), hits)
+end
+"""
+
+
+def test_inversion_in_nested_blocks():
+    expected = run_lua(NESTED_IFS)
+    obfuscator = WabiSabiObfuscator(seed=1, profile=True)
+    obfuscated = obfuscator.obfuscate(NESTED_IFS)
+    inverted = sum(p.transforms.get('ifs_inverted', 0) for p in obfuscator.stats.passes)
+    # Every if and elseif, at every nesting level ('if ' also matches 'elseif ')
+    assert inverted == NESTED_IFS.count('if ')
+    assert run_lua(obfuscated) == expected
+
+
+ALL_BYTES = "local s = \"" + "".join(f"\\{b}" for b in range(256)) + "\"\n" + """
+local sum = 0
+for i = 1, #s do sum = sum + s:byte(i) * i end
+print(#s, sum, "plain ascii", 'single "quoted"')
+"""
+
+# Luau's bit32.bxor, for running target_runtime='luau' output on Lua 5.1
+BIT32_SHIM = """
+bit32 = {bxor = function(a, b)
+    local r, p = 0, 1
+    while a > 0 or b > 0 do
+        local x, y = a % 2, b % 2
+        if x ~= y then r = r + p end
+        a, b, p = (a - x) / 2, (b - y) / 2, p * 2
+    end
+    return r
+end}
+"""
+
+
+@pytest.mark.parametrize('runtime, version, prelude', [
+    ('lua51', 'lua51', ''),
+    ('lua53', 'lua53', ''),
+    ('luau', 'lua51', BIT32_SHIM),
+    ('auto', 'lua51', ''),
+    ('auto', 'lua51', BIT32_SHIM),
+])
+@pytest.mark.parametrize('pool', [None, 'lazy'])
+def test_string_decryption_per_runtime(runtime, version, prelude, pool):
+    expected = run_lua(ALL_BYTES, version)
+    obfuscated = WabiSabiObfuscator(seed=1, target_runtime=runtime, string_pool=pool).obfuscate(ALL_BYTES)
+    assert run_lua(obfuscated, version, prelude) == expected
+
+
+INCREMENTAL_SOURCE = "".join(f"local v{i} = {i}\nif v{i} > 2 then print('v{i}', v{i}) end\n" for i in range(40))
+
+
+@pytest.mark.parametrize('edit', [
+    lambda s: s.replace("local v20 = 20", "local v20 = 21"),   # one chunk changed
+    lambda s: s.replace("local v20 = 20\n", ""),                # one chunk removed
+    lambda s: s + "print('appended')\n",
+    lambda s: s.replace("local v20 = 20", "local v20 = 20 --[[ unfinished"),  # swallows the rest
+    lambda s: s.replace("local v20 = 20", "local v20 = 20 +"),  # joins onto the next line
+])
+def test_incremental_relex_matches_cold_run(edit):
+    obfuscator = WabiSabiObfuscator(seed=1, incremental=True, profile=True)
+    obfuscator.obfuscate(INCREMENTAL_SOURCE)
+    edited = edit(INCREMENTAL_SOURCE)
+    warm = obfuscator.obfuscate(edited)
+    assert warm == WabiSabiObfuscator(seed=1, incremental=True).obfuscate(edited)
+    relexed = sum(p.transforms.get('chunks_relexed', 0) for p in obfuscator.stats.passes)
+    assert relexed <= 2 or '--[[' in edited
+
+
+@pytest.fixture
+def daemon():
+    """A one-worker daemon on a free localhost port; yields a request function."""
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _DaemonHandler)
+    server.daemon_state = _DaemonState(1)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    def request(body, headers=None):
+        connection = http.client.HTTPConnection(*server.server_address, timeout=60)
+        connection.putrequest("POST", "/obfuscate")
+        for name, value in (headers or {"Content-Length": str(len(body))}).items():
+            connection.putheader(name, value)
+        connection.endheaders(body)
+        response = connection.getresponse()
+        reply = json.loads(response.read())
+        connection.close()
+        return response.status, reply
+    yield request
+    server.shutdown()
+    server.server_close()
+    server.daemon_state.executor.shutdown()
+
+
+@pytest.mark.parametrize('body, headers', [
+    (b'{"source": "print(1)", "options": {"profile": true}}', None),
+    (b'{"source": "print(1)", "options": {"jobs": 2}}', None),
+    (b'{"source": "print(1)"}', {"Content-Length": "twelve"}),
+    (b'{"source": "print(1)"}', {"Content-Length": "-1"}),
+    (b'{"source": 1}', None),
+])
+def test_daemon_rejects_bad_requests(daemon, body, headers):
+    status, reply = daemon(body, headers)
+    assert status == 400 and reply["error"].startswith("bad request")
+
+
+def test_daemon_obfuscates(daemon):
+    status, reply = daemon(json.dumps({"source": "print(1 + 2)", "options": {"seed": 1}}).encode())
+    assert status == 200
+    assert reply["output"] == WabiSabiObfuscator(seed=1).obfuscate("print(1 + 2)")
+    assert reply["stats"]["passes"]
+
+
+NUMBERS = """
+local kind = math.type or type
+local function show(...)
+    for i = 1, select('#', ...) do
+        local x = select(i, ...)
+        print(string.format('%.17g', x), kind(x))
+    end
+end
+show(0, 1, 7, -7, 42, 3.0, 0.1, -0.1, 2.5e-3, 1e300, -1e-300, 0x10, 0xff, 1e3)
+show(9007199254740992, 9007199254740993, -9007199254740992, 2^53, 1/3, 123456.789)
+local function again()
+    show(0, 1, 7, -7, 42, 3.0, 0.1, -0.1, 2.5e-3, 1e300, -1e-300, 0x10, 0xff, 1e3)
+    show(9007199254740992, -9007199254740992, 2^53, 2147483647, 65536, 1/3, 123456.789)
+end
+for i = 1, 2 do again() end
+"""
+
+
+@pytest.mark.parametrize('runtime, version', [('lua51', 'lua51'), ('lua53', 'lua53'), ('auto', 'lua51')])
+@pytest.mark.parametrize('options', [{}, {'incremental': True}])
+def test_number_encodings_round_trip(runtime, version, options):
+    expected = run_lua(NUMBERS, version)
+    obfuscator = WabiSabiObfuscator(seed=1, target_runtime=runtime, profile=True, **options)
+    obfuscated = obfuscator.obfuscate(NUMBERS)
+    assert run_lua(obfuscated, version) == expected
+    used = {name for p in obfuscator.stats.passes for name in p.transforms if name.startswith('numbers_')}
+    # Top-level literals go through the constant table, the ones in functions are folded
+    assert {'numbers_table', 'numbers_additive'} <= used
+    assert ('numbers_xor' in used) == (runtime == 'lua53')
+
+
+PROFILED = """
+local total = 0
+for i = 1, 25 do
+    total = total + #tostring(i) + #"hot"
+end
+print("done", total)
+"""
+
+
+def test_profile_report():
+    expected, _ = run_lua(PROFILED)
+    obfuscator = WabiSabiObfuscator(seed=1, instrument=True)
+    printed, _ = run_lua(obfuscator.obfuscate(PROFILED))
+    assert printed[:-1] == expected # The dump is printed last, when the main chunk ends
+    symbol_map = json.loads(json.dumps(obfuscator.symbol_map))
+    assert [site['id'] for site in symbol_map] == list(range(1, len(symbol_map) + 1))
+
+    # Two dumps in captured output: the counters are cumulative, the last one counts
+    report = profile_report("noise\n" + printed[-1] + "\n" + printed[-1], symbol_map)
+    sites = {(site['kind'], site['detail']): site for site in report['sites']}
+    assert sites[('decrypt', '"hot"')]['line'] == 4 and sites[('decrypt', '"hot"')]['count'] == 25
+    assert sites[('global', 'tostring')]['line'] == 4 and sites[('global', 'tostring')]['count'] == 25
+    assert sites[('decrypt', '"done"')]['line'] == 6 and sites[('decrypt', '"done"')]['count'] == 1
+    counts = [site['count'] for site in report['sites']]
+    assert counts == sorted(counts, reverse=True)
+    assert sum(report['by_kind'].values()) == sum(counts)
+    assert abs(sum(site['share'] for site in report['sites']) - 1) < 1e-9
+    assert report['clock'] >= report['decrypt_seconds'] >= 0
+    assert profile_report(printed[-1], symbol_map, top=2)['sites'] == report['sites'][:2]
+
+
+@pytest.mark.parametrize('options', [{'incremental': True}, {'jobs': 2}])
+def test_instrument_needs_whole_file(options):
+    with pytest.raises(ValueError):
+        WabiSabiObfuscator(instrument=True, **options)
+
+
+@pytest.mark.parametrize('version', ['lua51', 'lua53'])
+@pytest.mark.parametrize('mode', ['whole', 'incremental', 'stream'])
+@pytest.mark.parametrize('size', [True, 2, 5])
+def test_shared_junk(version, mode, size):
+    source = NESTED_IFS * 10
+    expected = run_lua(source, version)
+    obfuscator = WabiSabiObfuscator(seed=1, shared_junk=size, target_runtime=version,
+                                    incremental=(mode == 'incremental'), profile=True)
+    if mode == 'stream':
+        out = io.StringIO()
+        obfuscator.obfuscate_stream([source], out)
+        obfuscated = out.getvalue()
+    else:
+        obfuscated = obfuscator.obfuscate(source)
+        routines = sum(p.transforms.get('library_routines', 0) for p in obfuscator.stats.passes)
+        assert routines == (JUNK_LIBRARY_SIZE if size is True else size)
+    assert run_lua(obfuscated, version) == expected
+    if mode == 'whole' and size is True:
+        # Call sites reuse the library instead of inlining fresh snippets
+        assert len(obfuscated) < len(WabiSabiObfuscator(seed=1, target_runtime=version).obfuscate(source))
+
+
+def test_shared_junk_is_validated():
+    with pytest.raises(ValueError, match='shared_junk'):
+        WabiSabiObfuscator(shared_junk=1)
+
+
+@pytest.mark.parametrize('cpus, pooled', [(1, False), (4, True)])
+def test_jobs_pool_only_pays_with_cpus(monkeypatch, cpus, pooled):
+    monkeypatch.setattr(obf.os, 'cpu_count', lambda: cpus)
+    monkeypatch.setattr(obf, 'PARALLEL_MIN_TOKENS', 100)
+    calls = []
+    transform = WabiSabiObfuscator._transform_parallel
+    monkeypatch.setattr(WabiSabiObfuscator, '_transform_parallel',
+                        lambda self, pending, workers: calls.append(workers) or transform(self, pending, workers))
+    output = WabiSabiObfuscator(seed=1, jobs=8).obfuscate(INCREMENTAL_SOURCE)
+    assert calls == ([4] if pooled else [])
+    # The same output whether or not the pool ran
+    assert output == WabiSabiObfuscator(seed=1, incremental=True).obfuscate(INCREMENTAL_SOURCE)
+    assert run_lua(output) == run_lua(INCREMENTAL_SOURCE)
+
+
+LAZY_SOURCE = """
+local counter, prefix = 0, "n="
+local Account = {balance = 0}
+function Account:deposit(amount, ...)
+    self.balance = self.balance + amount
+    counter = counter + select('#', ...)
+    local extra = {...}
+    local prefix = prefix .. "$"
+    print(prefix .. self.balance, #extra, extra[1], math.floor(amount / 3), type(wait))
+    return self.balance, ...
+end
+local function sum(...)
+    local total = 0
+    for _, v in ipairs({...}) do total = total + v end
+    counter = counter + 1
+    last_sum = total
+    return total, select('#', ...)
+end
+print(Account:deposit(10, "a", "b"))
+print(sum(1, 2, 3))
+print(counter, last_sum, sum())
+prefix = "m="
+print(Account:deposit(1, nil, nil))
+print(counter, Account.balance)
+"""
+
+
+@pytest.mark.parametrize('version', ['lua51', 'lua53'])
+@pytest.mark.parametrize('options', [{}, {'incremental': True}])
+def test_lazy_functions(version, options):
+    expected = run_lua(LAZY_SOURCE, version)
+    obfuscator = WabiSabiObfuscator(seed=1, lazy_functions=5, target_runtime=version, profile=True, **options)
+    obfuscated = obfuscator.obfuscate(LAZY_SOURCE)
+    assert sum(p.transforms.get('functions_lazy', 0) for p in obfuscator.stats.passes) == 2
+    assert 'balance + ' not in obfuscated # The bodies are encrypted blobs
+    assert run_lua(obfuscated, version) == expected